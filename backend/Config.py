@@ -1,18 +1,132 @@
 
-from flask_sqlalchemy import SQLAlchemy
+import os
 import urllib.parse
-db=SQLAlchemy()
 DB_USERNAME = "root"
 DB_PASSWORD = urllib.parse.quote_plus("root@123")  # URL encode the password
 DB_HOST = "localhost"
 DB_PORT = "3306"
 DB_NAME = "credit_rating"
 
-SQLALCHEMY_DATABASE_URI = f"mysql+pymysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+# DATABASE_URL overrides the MySQL settings above, e.g. sqlite:///credit_rating.db for local load tests
+SQLALCHEMY_DATABASE_URI = os.environ.get(
+    "DATABASE_URL", f"mysql+pymysql://{DB_USERNAME}:{DB_PASSWORD}@{DB_HOST}:{DB_PORT}/{DB_NAME}"
+)
 
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Connection pool settings; pre-ping drops connections MySQL closed, recycle
+# retires them before MySQL's wait_timeout does
+SQLALCHEMY_POOL_SIZE = 10
+SQLALCHEMY_MAX_OVERFLOW = 20
+SQLALCHEMY_POOL_TIMEOUT = 30
+SQLALCHEMY_POOL_RECYCLE = 1800
+SQLALCHEMY_POOL_PRE_PING = True
+
+# Async drivers used by the ASGI read path, keyed by the sync driver they replace
+ASYNC_DRIVERS = {
+    'mysql+pymysql': 'mysql+aiomysql',
+    'sqlite': 'sqlite+aiosqlite'
+}
+
+def engine_options(uri):
+    """Return create_engine pool options suited to a database URI"""
+    options = {'pool_pre_ping': SQLALCHEMY_POOL_PRE_PING}
+    # SQLite uses a single-connection or per-thread pool that takes no sizing options
+    if not uri.startswith('sqlite'):
+        options.update(
+            pool_size=SQLALCHEMY_POOL_SIZE,
+            max_overflow=SQLALCHEMY_MAX_OVERFLOW,
+            pool_timeout=SQLALCHEMY_POOL_TIMEOUT,
+            pool_recycle=SQLALCHEMY_POOL_RECYCLE
+        )
+    return options
+
+def async_database_uri(uri):
+    """Return the async-driver form of a database URI"""
+    driver, sep, rest = uri.partition('://')
+    return ASYNC_DRIVERS.get(driver, driver) + sep + rest
+
+# Read replicas, from a comma-separated DATABASE_REPLICA_URLS. Read-only routes query them in turn; writes, and
+# every request from a client that wrote in the last READ_YOUR_WRITES_WINDOW seconds, use the primary. A replica
+# that fails is skipped for REPLICA_RETRY_INTERVAL seconds
+REPLICA_DATABASE_URIS = [uri for uri in os.environ.get("DATABASE_REPLICA_URLS", "").split(",") if uri]
+READ_YOUR_WRITES_WINDOW = 5
+REPLICA_RETRY_INTERVAL = 30
+
+# Rows per transaction for POST /api/mortgages/bulk
+BULK_INSERT_CHUNK_SIZE = 5000
+
+# Largest page for GET /api/mortgages?limit= and rows fetched per server-side cursor batch
+MAX_PAGE_SIZE = 1000
+STREAM_BATCH_SIZE = 1000
+
+# Rows per record batch, row group or insert batch for mortgage export and import
+EXPORT_BATCH_SIZE = 50000
+
+# Entries kept by the /api/calculate-rating result cache
+RATING_CACHE_SIZE = 4096
+
+# Serialized mortgages kept by the GET /api/mortgages/<id> cache, and how long each stays valid in seconds.
+# The TTL bounds staleness from writes made by other processes, which cannot invalidate this one's cache
+MORTGAGE_CACHE_SIZE = 10000
+MORTGAGE_CACHE_TTL = 30
+
+# Seconds GET /api/portfolio/stats reuses its last result before re-running the aggregates
+PORTFOLIO_STATS_TTL = 10
+
+# Largest POST /api/calculate-rating/grid: values per axis and cells in the whole grid
+GRID_MAX_STEPS = 200
+GRID_MAX_CELLS = 20000
+
+# Scenarios accepted by one POST /api/portfolio/stress, and loans scored per chunk while running them
+STRESS_MAX_SCENARIOS = 100
+STRESS_CHUNK_SIZE = 100000
+
+# GET /api/mortgages/changes: each open stream buffers up to CHANGE_FEED_BUFFER_SIZE live events and catches up
+# from the rating history, CHANGE_FEED_REPLAY_BATCH entries per query, when it falls further behind. Idle streams
+# send a comment every CHANGE_FEED_HEARTBEAT seconds so proxies keep them open. Every stream holds a worker thread.
+# A client resuming with Last-Event-ID is also re-sent the entries written up to CHANGE_FEED_REORDER_WINDOW seconds
+# before that event, since a transaction that wrote earlier can commit later with a lower ID
+CHANGE_FEED_BUFFER_SIZE = 1000
+CHANGE_FEED_REPLAY_BATCH = 1000
+CHANGE_FEED_HEARTBEAT = 15
+CHANGE_FEED_MAX_SUBSCRIBERS = 100
+CHANGE_FEED_REORDER_WINDOW = 5
+
+# Seconds a stored Idempotency-Key response is replayed to retries of POST /api/mortgages
+IDEMPOTENCY_KEY_TTL = 86400
+
+# Async rating mode: POST /api/mortgages commits the mortgage unrated and answers 202, and a pool of
+# RATING_WORKERS threads rates queued IDs in batches. When the bounded queue is full, requests rate inline.
+# Pending rows missing from the queue (after a crash, say) are re-queued every RATING_RECOVERY_INTERVAL seconds
+ASYNC_RATING = False
+RATING_QUEUE_SIZE = 10000
+RATING_WORKERS = 2
+RATING_BATCH_SIZE = 500
+RATING_RECOVERY_INTERVAL = 30
+# Longest GET /api/mortgages/<id>/rating?wait= long-poll, in seconds
+RATING_MAX_WAIT = 30
+
+# Hold every mortgage's scoring inputs in memory as NumPy columns, so scoring needs no database round trip.
+# Only for single-process deployments: other processes' writes are not seen until the snapshot is reloaded
+PORTFOLIO_SNAPSHOT = False
+
+# Scoring rule file (JSON, or YAML if PyYAML is installed) and how often to check it for edits, in seconds
+RULES_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'rules.json')
+RULES_RELOAD_INTERVAL = 5
+
+# Write a cProfile of every Nth request to PROFILE_DIR (0 disables profiling), and log a
+# warning for any request running more SQL statements than REQUEST_QUERY_WARN_THRESHOLD
+PROFILE_EVERY_N_REQUESTS = 0
+PROFILE_DIR = 'profiles'
+REQUEST_QUERY_WARN_THRESHOLD = 20
+
 # Logging configuration
 LOG_LEVEL = 'INFO'
 LOG_FORMAT =  '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-LOG_FILE ='app.log'
\ No newline at end of file
+LOG_FILE ='app.log'
+
+# Level of the per-rule scoring trace lines in credit_ratings, and the fraction
+# of scoring calls (0.0 to 1.0) whose trace is logged at INFO anyway
+RULE_TRACE_LEVEL = 'DEBUG'
+RULE_TRACE_SAMPLE_RATE = 0.0
\ No newline at end of file
@@ -1,50 +1,136 @@
-from flask import Flask, request, jsonify
+import json
+import time
+from collections import deque
+import click
+from flask import Blueprint, Flask, Response, current_app, request, jsonify, stream_with_context
 from flask_cors import CORS
+from sqlalchemy import select
+from sqlalchemy.exc import IntegrityError
 from models import db, Mortgage
-from credit_ratings import *
+# Imported up front although they load NumPy: portfolio registers the before_flush listener that
+# keeps the portfolio aggregate in step, so it must be loaded before the first write
+from credit_ratings import calculate_risk_score, calculate_credit_rating, calculate_risk_scores_batch, \
+    calculate_credit_ratings_batch
+from portfolio import get_average_credit_score, rebuild_portfolio_aggregate, create_portfolio_aggregate, \
+    apply_portfolio_delta, backfill_ratings, cached_portfolio_stats
+from portfolio_snapshot import portfolio_snapshot
+from rating_cache import rating_cache
+from mortgage_cache import mortgage_cache
+from serialization import MORTGAGE_COLUMNS, ID_INDEX, encode_mortgages, encode_mortgage, encode_mortgage_lines
+from rules import get_rules, reload_rules
+from idempotency import IDEMPOTENCY_HEADER, MAX_KEY_LENGTH, request_fingerprint, find_response, store_response, \
+    purge_expired_keys
+from mortgage_io import EXPORT_FORMATS, export_partitions, export_stream, import_batches, insert_mortgages
+from rating_queue import rating_queue
+from rating_history import seed_rating_history, parse_as_of, rating_distribution_as_of, \
+    ratings_as_of, mortgage_rating_history, resume_point, changes_since
+from change_feed import change_feed, format_event
+from instrumentation import init_instrumentation, mark_phase, render_metrics
+from db_routing import replica_binds, init_db_routing, read_replica, read_from_replica
 from logger import setup_logger
 import Config as config
 
 # Set up logger for this module
 logger = setup_logger(__name__)
 
-# Initialize Flask app
-app = Flask(__name__)
-CORS(app)  # Enable CORS
+# Routes and CLI commands; create_app registers them on each application it builds
+api = Blueprint('api', __name__, cli_group=None)
 
-# Configure the app
-app.config["SQLALCHEMY_DATABASE_URI"] = config.SQLALCHEMY_DATABASE_URI
-app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = config.SQLALCHEMY_TRACK_MODIFICATIONS
+def create_app(settings=None):
+    """Build and configure the Flask application.
 
-# Initialize the database
-db.init_app(app)
+    `settings` are Flask config values that override the defaults from Config,
+    e.g. {'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'} for tests. Nothing
+    is connected or loaded when this module is imported, only when an app is built.
+    """
+    app = Flask(__name__)
+    CORS(app)  # Enable CORS
+    
+    # Configure the app
+    app.config["SQLALCHEMY_DATABASE_URI"] = config.SQLALCHEMY_DATABASE_URI
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = config.SQLALCHEMY_TRACK_MODIFICATIONS
+    app.config.update(settings or {})
+    app.config.setdefault("SQLALCHEMY_ENGINE_OPTIONS", config.engine_options(app.config["SQLALCHEMY_DATABASE_URI"]))
+    app.config.setdefault("SQLALCHEMY_BINDS", replica_binds(config.REPLICA_DATABASE_URIS))
+    
+    # Initialize the database, and route read-only requests to the replicas if there are any
+    db.init_app(app)
+    init_db_routing(app)
+    
+    # Per-request phase timers, SQL query counts and sampled profiles
+    init_instrumentation(app)
+    
+    app.register_blueprint(api)
+    load_portfolio_snapshot(app)
+    if config.ASYNC_RATING:
+        rating_queue.start(app)
+    return app
 
-@app.route('/api/mortgages', methods=['POST'])
+def load_portfolio_snapshot(app):
+    """Load the in-memory portfolio snapshot if it is enabled"""
+    if not config.PORTFOLIO_SNAPSHOT or portfolio_snapshot.loaded:
+        return
+    with app.app_context():
+        try:
+            portfolio_snapshot.load()
+        except Exception as e:
+            # Scoring falls back to the database aggregate
+            logger.error("Could not load portfolio snapshot: %s", e)
+
+# Fields every mortgage payload must provide
+REQUIRED_FIELDS = ['creditScore', 'loanAmount', 'propertyValue', 'annualIncome', 'debtAmount', 'loanType', 'propertyType']
+NUMERIC_FIELDS = ['creditScore', 'loanAmount', 'propertyValue', 'annualIncome', 'debtAmount']
+
+@api.route('/api/mortgages', methods=['POST'])
 def create_mortgage():
     """Create a new mortgage entry and calculate its credit rating"""
     try:
         data = request.json
-        logger.info(f"Received request to create mortgage: {data}")
+        logger.info("Received request to create mortgage: %s", data)
+        
+        # A retry carrying an already-used Idempotency-Key gets the original response back
+        idempotency_key = request.headers.get(IDEMPOTENCY_HEADER)
+        if idempotency_key is not None:
+            if not idempotency_key or len(idempotency_key) > MAX_KEY_LENGTH:
+                logger.error("Invalid %s header", IDEMPOTENCY_HEADER)
+                return jsonify({"error": f"{IDEMPOTENCY_HEADER} must be 1 to {MAX_KEY_LENGTH} characters"}), 400
+            fingerprint = request_fingerprint(request.method, request.path, data)
+            try:
+                stored = find_response(idempotency_key, fingerprint)
+            except ValueError as e:
+                logger.error(str(e))
+                return jsonify({"error": str(e)}), 422
+            mark_phase('idempotency')
+            if stored is not None:
+                logger.info("Replaying stored response for %s %s", IDEMPOTENCY_HEADER, idempotency_key)
+                return replay_response(*stored)
         
         # Validate required fields
-        required_fields = ['creditScore', 'loanAmount', 'propertyValue', 'annualIncome', 'debtAmount', 'loanType', 'propertyType']
-        for field in required_fields:
+        for field in REQUIRED_FIELDS:
             if field not in data:
-                logger.error(f"Missing required field: {field}")
+                logger.error("Missing required field: %s", field)
                 return jsonify({"error": f"Missing required field: {field}"}), 400
+        mark_phase('validate')
         
-        # Calculate average credit score from all existing mortgages
-        all_mortgages = Mortgage.query.all()
-        if all_mortgages:
-            avg_credit_score = sum(m.credit_score for m in all_mortgages) / len(all_mortgages)
+        # In async rating mode the mortgage is stored unrated and rated by the background workers,
+        # unless their queue is full
+        pending = rating_queue.accepting()
+        if pending:
+            risk_score = credit_rating = rules = None
         else:
-            avg_credit_score = data.get('creditScore')
-        
-        logger.info(f"Average credit score for calculation: {avg_credit_score}")
-        
-        # Calculate risk score and credit rating
-        risk_score = calculate_risk_score(data, avg_credit_score)
-        credit_rating = calculate_credit_rating(risk_score)
+            # Read average credit score of all existing mortgages from the running aggregate
+            avg_credit_score = get_average_credit_score()
+            if avg_credit_score is None:
+                avg_credit_score = data.get('creditScore')
+            mark_phase('db_read')
+            
+            logger.info("Average credit score for calculation: %s", avg_credit_score)
+            
+            # Calculate risk score and credit rating
+            rules = get_rules()
+            risk_score = calculate_risk_score(data, avg_credit_score, rules)
+            credit_rating = calculate_credit_rating(risk_score, rules)
+            mark_phase('score')
         
         # Create new mortgage record
         new_mortgage = Mortgage(
@@ -55,78 +141,537 @@ def create_mortgage():
             debt_amount=data.get('debtAmount'),
             loan_type=data.get('loanType'),
             property_type=data.get('propertyType'),
-            # credit_rating=credit_rating,
-            # risk_score=risk_score
+            credit_rating=credit_rating,
+            risk_score=risk_score
         )
         
-        # Save to database
+        # Flush to assign the ID, so the response can be built (and stored) before committing
         db.session.add(new_mortgage)
-        db.session.commit()
-        logger.info(f"Created new mortgage with ID {new_mortgage.id} and credit rating {credit_rating}")
+        db.session.flush()
+        mortgage_id = new_mortgage.id
+        if pending:
+            status_code = 202
+            result = {
+                "message": "Mortgage created; credit rating pending",
+                "mortgage": new_mortgage.to_dict(),
+                "creditRating": None,
+                "ratingStatus": "pending",
+                "ratingUrl": f"/api/mortgages/{mortgage_id}/rating"
+            }
+        else:
+            status_code = 201
+            result = {
+                "message": "Mortgage created successfully",
+                "mortgage": new_mortgage.to_dict(),
+                "creditRating": credit_rating,
+                "ruleSetVersion": rules.version
+            }
+        
+        # Save to database, together with the stored response for the idempotency key
+        if idempotency_key is not None:
+            store_response(idempotency_key, fingerprint, status_code,
+                           current_app.json.response(result).get_data(as_text=True))
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            if idempotency_key is None:
+                raise
+            # A concurrent request with the same key committed first; return its response instead
+            stored = find_response(idempotency_key, fingerprint)
+            if stored is None:
+                raise
+            logger.info("Concurrent duplicate for %s %s", IDEMPOTENCY_HEADER, idempotency_key)
+            return replay_response(*stored)
+        mark_phase('commit')
+        if pending:
+            # If the queue filled up meanwhile, the recovery sweep picks the row up
+            rating_queue.submit(mortgage_id)
+            logger.info("Created new mortgage with ID %s, rating pending", mortgage_id)
+        else:
+            logger.info("Created new mortgage with ID %s and credit rating %s", mortgage_id, credit_rating)
         
         # Return the created mortgage with its credit rating
-        return jsonify({
-            "message": "Mortgage created successfully",
-            "mortgage": new_mortgage.to_dict(),
-            "creditRating": credit_rating
-        }), 201
+        response = jsonify(result)
+        mark_phase('serialize')
+        return response, status_code
         
     except Exception as e:
-        logger.error(f"Error creating mortgage: {str(e)}")
+        db.session.rollback()
+        logger.error("Error creating mortgage: %s", e)
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/mortgages', methods=['GET'])
+def replay_response(status_code, body):
+    """Rebuild a response stored for an idempotency key"""
+    return Response(body, status=status_code, mimetype='application/json', headers={'Idempotent-Replayed': 'true'})
+
+def _parse_bulk_body():
+    """Parse a bulk request body given as a JSON array or as NDJSON"""
+    body = request.get_data(as_text=True)
+    if request.mimetype != 'application/x-ndjson' and body.lstrip().startswith('['):
+        return json.loads(body)
+    return [json.loads(line) for line in body.splitlines() if line.strip()]
+
+def _validate_bulk_row(row):
+    """Return an error message for an invalid bulk row, or None if it is valid"""
+    if not isinstance(row, dict):
+        return "Row must be a JSON object"
+    for field in REQUIRED_FIELDS:
+        if field not in row:
+            return f"Missing required field: {field}"
+    for field in NUMERIC_FIELDS:
+        try:
+            float(row[field])
+        except (TypeError, ValueError):
+            return f"Invalid numeric value for field: {field}"
+    return None
+
+@api.route('/api/mortgages/bulk', methods=['POST'])
+def create_mortgages_bulk():
+    """Create many mortgage entries at once and calculate their credit ratings"""
+    try:
+        try:
+            rows = _parse_bulk_body()
+        except ValueError as e:
+            logger.error("Invalid bulk request body: %s", e)
+            return jsonify({"error": f"Invalid request body: {str(e)}"}), 400
+        if not isinstance(rows, list):
+            return jsonify({"error": "Request body must be a JSON array or NDJSON"}), 400
+        logger.info("Received request to create %s mortgages in bulk", len(rows))
+        mark_phase('parse')
+        
+        # Validate every row before touching the database
+        results = [{"index": index} for index in range(len(rows))]
+        valid_indexes = []
+        for index, row in enumerate(rows):
+            error = _validate_bulk_row(row)
+            if error:
+                results[index]["error"] = error
+            else:
+                valid_indexes.append(index)
+        valid_rows = [rows[index] for index in valid_indexes]
+        mark_phase('validate')
+        
+        # Read the portfolio average once for the whole batch; an empty portfolio
+        # falls back to each loan's own credit score as create_mortgage does
+        avg_credit_score = get_average_credit_score()
+        logger.info("Average credit score for bulk calculation: %s", avg_credit_score)
+        mark_phase('db_read')
+        
+        # Score all valid rows in one vectorized pass
+        rules = get_rules()
+        scores = calculate_risk_scores_batch(valid_rows, avg_credit_score, rules)
+        risk_scores = scores['total'].tolist()
+        credit_ratings = calculate_credit_ratings_batch(scores['total'], rules).tolist()
+        mark_phase('score')
+        
+        # Insert in chunks, one transaction per chunk
+        inserted = 0
+        chunk_size = config.BULK_INSERT_CHUNK_SIZE
+        for start in range(0, len(valid_rows), chunk_size):
+            chunk = valid_rows[start:start + chunk_size]
+            chunk_indexes = valid_indexes[start:start + chunk_size]
+            try:
+                apply_portfolio_delta(db.session, sum(int(float(row['creditScore'])) for row in chunk), len(chunk))
+                created = insert_mortgages(db.session, [{
+                    'credit_score': row['creditScore'],
+                    'loan_amount': row['loanAmount'],
+                    'property_value': row['propertyValue'],
+                    'annual_income': row['annualIncome'],
+                    'debt_amount': row['debtAmount'],
+                    'loan_type': row['loanType'],
+                    'property_type': row['propertyType'],
+                    'risk_score': risk_scores[start + offset],
+                    'credit_rating': credit_ratings[start + offset]
+                } for offset, row in enumerate(chunk)])
+                db.session.commit()
+                # Core inserts bypass the session events, so pick the new rows up explicitly
+                if portfolio_snapshot.loaded:
+                    portfolio_snapshot.sync_rows([row['id'] for row in created], db.session)
+            except Exception as e:
+                db.session.rollback()
+                logger.error("Error inserting bulk chunk starting at row %s: %s", chunk_indexes[0], e)
+                for index in chunk_indexes:
+                    results[index]["error"] = f"Insert failed: {str(e)}"
+                continue
+            
+            for offset, index in enumerate(chunk_indexes):
+                results[index]["creditRating"] = credit_ratings[start + offset]
+                results[index]["riskScore"] = risk_scores[start + offset]
+            inserted += len(chunk)
+        
+        failed = len(rows) - inserted
+        mark_phase('commit')
+        logger.info("Bulk created %s mortgages, %s rows failed", inserted, failed)
+        
+        response = jsonify({
+            "message": f"Created {inserted} mortgages",
+            "inserted": inserted,
+            "failed": failed,
+            "ruleSetVersion": rules.version,
+            "results": results
+        })
+        mark_phase('serialize')
+        return response, 201 if inserted else 400
+        
+    except Exception as e:
+        db.session.rollback()
+        logger.error("Error creating mortgages in bulk: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+def parse_int_arg(args, name, minimum, maximum=None):
+    """Read an optional integer query parameter, raising ValueError if it is out of range"""
+    value = args.get(name)
+    if value is None:
+        return None
+    try:
+        value = int(value)
+    except ValueError:
+        raise ValueError(f"Query parameter {name} must be an integer")
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ValueError(f"Query parameter {name} is out of range")
+    return value
+
+def mortgage_list_query(rating=None, after_id=None):
+    """Build the id-ordered mortgage query behind GET /api/mortgages.
+
+    Selects plain column tuples rather than Mortgage objects; listings only
+    serialize the rows, so building ORM objects would be wasted work.
+    """
+    query = select(*MORTGAGE_COLUMNS).order_by(Mortgage.id)
+    if rating:
+        query = query.where(Mortgage.credit_rating == rating)
+    if after_id is not None:
+        query = query.where(Mortgage.id > after_id)
+    return query
+
+def _wants_ndjson():
+    """Check whether the client asked for newline-delimited JSON"""
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson']) == 'application/x-ndjson'
+
+def _stream_mortgage_partitions(query):
+    """Yield lists of mortgage rows read through a server-side cursor"""
+    result = db.session.execute(query.execution_options(yield_per=config.STREAM_BATCH_SIZE))
+    count = 0
+    for partition in result.partitions():
+        count += len(partition)
+        yield partition
+    logger.info("Streamed %s mortgages", count)
+
+def _json_array_stream(partitions):
+    """Encode partitions of rows as one JSON array, chunk by chunk"""
+    yield b'['
+    first = True
+    for partition in partitions:
+        if not partition:
+            continue
+        if not first:
+            yield b','
+        # Each partition's array without its brackets
+        yield encode_mortgages(partition)[1:-1]
+        first = False
+    yield b']\n'
+
+def _ndjson_stream(partitions):
+    """Encode partitions of rows as newline-delimited JSON"""
+    for partition in partitions:
+        yield encode_mortgage_lines(partition)
+
+@api.route('/api/mortgages', methods=['GET'])
+@read_replica
 def get_mortgages():
-    """Retrieve all mortgages from the database"""
+    """Retrieve mortgages, optionally filtered by rating, as a keyset-paginated page or a streamed list"""
     try:
-        logger.info("Received request to get all mortgages")
-        mortgages = Mortgage.query.all()
-        logger.info(f"Retrieved {len(mortgages)} mortgages")
-        return jsonify([mortgage.to_dict() for mortgage in mortgages]), 200
+        logger.info("Received request to get mortgages: %s", dict(request.args))
+        try:
+            limit = parse_int_arg(request.args, 'limit', minimum=1, maximum=config.MAX_PAGE_SIZE)
+            after_id = parse_int_arg(request.args, 'after_id', minimum=0)
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({"error": str(e)}), 400
+        ndjson = _wants_ndjson()
+        
+        query = mortgage_list_query(request.args.get('rating'), after_id)
+        mark_phase('validate')
+        
+        # Without a limit, stream the whole table so memory stays flat
+        if limit is None:
+            partitions = _stream_mortgage_partitions(query)
+            if ndjson:
+                return Response(stream_with_context(_ndjson_stream(partitions)), mimetype='application/x-ndjson')
+            return Response(stream_with_context(_json_array_stream(partitions)), mimetype='application/json')
+        
+        # Keyset page: the next page starts after the last id returned
+        rows = db.session.execute(query.limit(limit)).all()
+        mark_phase('db_read')
+        logger.info("Retrieved %s mortgages after ID %s", len(rows), after_id)
+        if ndjson:
+            response = Response(encode_mortgage_lines(rows), mimetype='application/x-ndjson')
+        else:
+            response = Response(encode_mortgages(rows) + b'\n', mimetype='application/json')
+        if len(rows) == limit:
+            response.headers['X-Next-After-Id'] = str(rows[-1][ID_INDEX])
+        mark_phase('serialize')
+        return response, 200
     except Exception as e:
-        logger.error(f"Error retrieving mortgages: {str(e)}")
+        logger.error("Error retrieving mortgages: %s", e)
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/mortgages/<int:id>', methods=['GET'])
+def mortgage_query(id):
+    """Build the column query for one mortgage, as serialized by serialize_mortgage"""
+    return select(*MORTGAGE_COLUMNS).where(Mortgage.id == id)
+
+def serialize_mortgage(row):
+    """Serialize a mortgage row to the same JSON bytes jsonify would produce"""
+    return encode_mortgage(row) + b'\n'
+
+@api.route('/api/mortgages/cache', methods=['GET'])
+def get_mortgage_cache_stats():
+    """Report hit/miss counters for the GET /api/mortgages/<id> cache"""
+    return jsonify(mortgage_cache.stats()), 200
+
+def _replay_changes(after_id):
+    """Yield the stored change events after an event ID, a page at a time"""
+    while True:
+        events = changes_since(after_id, config.CHANGE_FEED_REPLAY_BATCH)
+        # End the read transaction, so an idle stream holds no connection
+        db.session.rollback()
+        yield from events
+        if len(events) < config.CHANGE_FEED_REPLAY_BATCH:
+            return
+        after_id = events[-1]['id']
+
+def _change_stream(subscription, replay_after):
+    """Encode change events as Server-Sent Events: stored ones after `replay_after` (if not None) first, then live ones"""
+    # Sent at once, so the client and any proxy see the stream open before the first change
+    yield b': connected\n\n'
+    replayed = set()
+    while True:
+        if replay_after is not None:
+            # Only the newest replayed IDs can also be waiting in the buffer
+            recent = deque(maxlen=config.CHANGE_FEED_BUFFER_SIZE)
+            for event in _replay_changes(replay_after):
+                yield format_event(event)
+                recent.append(event['id'])
+            replayed = set(recent)
+            replay_after = None
+        events, dropped_from = subscription.get(config.CHANGE_FEED_HEARTBEAT)
+        if dropped_from is not None:
+            # Live events were dropped; read them back from the history table
+            replay_after = dropped_from - 1
+            continue
+        if not events:
+            yield b': keep-alive\n\n'
+            continue
+        for event in events:
+            # Events committed while replaying were already read from the table. IDs do not
+            # commit in order, so this checks each ID rather than comparing with the last one
+            if event['id'] not in replayed:
+                yield format_event(event)
+        replayed = set()
+
+@api.route('/api/mortgages/changes', methods=['GET'])
+def get_mortgage_changes():
+    """Stream mortgage creates, updates, ratings and deletes as Server-Sent Events.
+
+    A client resuming with the Last-Event-ID header (or ?lastEventId=, for a
+    first connection) is sent every change after that event before the live
+    ones, plus any written up to CHANGE_FEED_REORDER_WINDOW seconds before it,
+    which may have committed after it. Events carry the mortgage itself, so
+    clients can apply them to a list they already hold instead of reloading it.
+    """
+    try:
+        try:
+            args = {'lastEventId': request.headers.get('Last-Event-ID', request.args.get('lastEventId'))}
+            last_event_id = parse_int_arg(args, 'lastEventId', minimum=0)
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({"error": str(e)}), 400
+        
+        # Subscribe before reading the history, so every later commit is published to this stream
+        subscription = change_feed.subscribe()
+        if subscription is None:
+            logger.warning("Too many change feed subscribers")
+            return jsonify({"error": "Too many open change streams"}), 503
+        replay_after = None
+        if last_event_id is not None:
+            try:
+                replay_after = resume_point(last_event_id, config.CHANGE_FEED_REORDER_WINDOW)
+                db.session.rollback()
+            except Exception:
+                change_feed.unsubscribe(subscription)
+                raise
+        logger.info("Streaming mortgage changes, replaying after event %s", replay_after)
+        response = Response(stream_with_context(_change_stream(subscription, replay_after)),
+                            mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        # Runs when the client goes away, even if the stream never started
+        response.call_on_close(lambda: change_feed.unsubscribe(subscription))
+        return response
+    except Exception as e:
+        logger.error("Error streaming mortgage changes: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/mortgages/changes/stats', methods=['GET'])
+def get_change_feed_stats():
+    """Report open change streams and published and dropped event counts"""
+    return jsonify(change_feed.stats()), 200
+
+@api.route('/api/mortgages/export', methods=['GET'])
+@read_replica
+def export_mortgages():
+    """Stream every mortgage as CSV, Arrow IPC or Parquet"""
+    try:
+        file_format = request.args.get('format', 'csv')
+        logger.info("Received request to export mortgages as %s", file_format)
+        try:
+            chunks = export_stream(file_format, export_partitions())
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({"error": str(e)}), 400
+        mimetype, extension = EXPORT_FORMATS[file_format]
+        return Response(stream_with_context(chunks), mimetype=mimetype,
+                        headers={'Content-Disposition': f'attachment; filename="mortgages.{extension}"'})
+    except Exception as e:
+        logger.error("Error exporting mortgages: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+def refresh_after_import():
+    """Bring the aggregate, snapshot and read cache in line with rows inserted outside the ORM"""
+    rebuild_portfolio_aggregate()
+    db.session.commit()
+    if portfolio_snapshot.loaded:
+        portfolio_snapshot.reload()
+    mortgage_cache.clear()
+
+@api.route('/api/mortgages/import', methods=['POST'])
+def import_mortgages():
+    """Bulk-load mortgages from an uploaded CSV or Parquet file"""
+    try:
+        upload = request.files.get('file')
+        if upload is None:
+            logger.error("Import request without a file")
+            return jsonify({"error": "Upload the file as multipart field 'file'"}), 400
+        file_format = request.args.get('format') or upload.filename.rsplit('.', 1)[-1].lower()
+        keep_ids = request.args.get('keep_ids', 'false').lower() == 'true'
+        logger.info("Received request to import %s as %s", upload.filename, file_format)
+        imported = 0
+        try:
+            for imported in import_batches(upload.stream, file_format, keep_ids=keep_ids):
+                pass
+        except ValueError as e:
+            logger.error(str(e))
+            # Batches committed before the failure stay imported
+            return jsonify({"error": str(e), "imported": imported}), 400
+        finally:
+            if imported:
+                refresh_after_import()
+        return jsonify({"imported": imported}), 201
+    except Exception as e:
+        db.session.rollback()
+        logger.error("Error importing mortgages: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/mortgages/<int:id>', methods=['GET'])
+@read_replica
 def get_mortgage(id):
     """Retrieve a single mortgage by ID"""
     try:
-        logger.info(f"Received request to get mortgage with ID {id}")
-        mortgage = Mortgage.query.get(id)
-        if not mortgage:
-            logger.warning(f"Mortgage with ID {id} not found")
+        logger.info("Received request to get mortgage with ID %s", id)
+        entry, token = mortgage_cache.get(id)
+        mark_phase('cache')
+        if entry is None:
+            row = db.session.execute(mortgage_query(id)).first()
+            mark_phase('db_read')
+            if not row:
+                logger.warning("Mortgage with ID %s not found", id)
+                return jsonify({"error": "Mortgage not found"}), 404
+            logger.info("Retrieved mortgage with ID %s", id)
+            # A lagging replica could hold a version a write has just invalidated, so only primary reads are cached
+            entry = mortgage_cache.set(id, serialize_mortgage(row), None if read_from_replica(db.session) else token)
+            mark_phase('serialize')
+        
+        # Serve the cached bytes, or 304 with no body if the client already has them
+        body, etag = entry
+        response = current_app.response_class(body, mimetype='application/json')
+        response.set_etag(etag)
+        return response.make_conditional(request)
+    except Exception as e:
+        logger.error("Error retrieving mortgage: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/mortgages/<int:id>/rating', methods=['GET'])
+def get_mortgage_rating(id):
+    """Report whether a mortgage has been rated yet; ?wait=N long-polls up to N seconds for the rating"""
+    try:
+        try:
+            wait = parse_int_arg(request.args, 'wait', minimum=0, maximum=config.RATING_MAX_WAIT) or 0
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({"error": str(e)}), 400
+        deadline = time.monotonic() + wait
+        while True:
+            # Read before checking, so a batch finishing in between is not missed
+            batches_done = rating_queue.batches_done()
+            row = db.session.execute(
+                select(Mortgage.risk_score, Mortgage.credit_rating).where(Mortgage.id == id)
+            ).first()
+            if row is None:
+                logger.warning("Mortgage with ID %s not found", id)
+                return jsonify({"error": "Mortgage not found"}), 404
+            remaining = deadline - time.monotonic()
+            if row.credit_rating is not None or remaining <= 0:
+                break
+            # End the read transaction so the next check sees the workers' commit
+            db.session.rollback()
+            # Wake on any finished batch, and at least every second for ratings stored by other nodes
+            rating_queue.wait(batches_done, min(remaining, 1.0))
+        return jsonify({
+            "id": id,
+            "ratingStatus": "pending" if row.credit_rating is None else "rated",
+            "riskScore": row.risk_score,
+            "creditRating": row.credit_rating
+        }), 200
+    except Exception as e:
+        logger.error("Error retrieving mortgage rating: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/mortgages/<int:id>/history', methods=['GET'])
+@read_replica
+def get_mortgage_history(id):
+    """List every rating a mortgage has had, oldest first; entries outlive the mortgage itself"""
+    try:
+        entries = mortgage_rating_history(id)
+        if not entries:
+            logger.warning("No rating history for mortgage with ID %s", id)
             return jsonify({"error": "Mortgage not found"}), 404
-        logger.info(f"Retrieved mortgage with ID {id}")
-        return jsonify(mortgage.to_dict()), 200
+        return jsonify({"id": id, "history": [entry.to_dict() for entry in entries]}), 200
     except Exception as e:
-        logger.error(f"Error retrieving mortgage: {str(e)}")
+        logger.error("Error retrieving mortgage history: %s", e)
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/mortgages/<int:id>', methods=['PUT'])
+@api.route('/api/ratings/queue', methods=['GET'])
+def get_rating_queue_stats():
+    """Report the background rating queue's depth, capacity and counters"""
+    return jsonify(rating_queue.stats()), 200
+
+@api.route('/api/mortgages/<int:id>', methods=['PUT'])
 def update_mortgage(id):
     """Update an existing mortgage"""
     try:
-        logger.info(f"Received request to update mortgage with ID {id}")
+        logger.info("Received request to update mortgage with ID %s", id)
         mortgage = Mortgage.query.get(id)
         if not mortgage:
-            logger.warning(f"Mortgage with ID {id} not found")
+            logger.warning("Mortgage with ID %s not found", id)
             return jsonify({"error": "Mortgage not found"}), 404
         
         data = request.json
-        logger.info(f"Update data: {data}")
-        
-        # Calculate average credit score (excluding this mortgage)
-        all_mortgages = Mortgage.query.filter(Mortgage.id != id).all()
-        if all_mortgages:
-            avg_credit_score = sum(m.credit_score for m in all_mortgages) / len(all_mortgages)
-        else:
-            avg_credit_score = data.get('creditScore')
+        logger.info("Update data: %s", data)
         
-        logger.info(f"Average credit score for calculation: {avg_credit_score}")
-        
-        # Calculate new risk score and credit rating
-        risk_score = calculate_risk_score(data, avg_credit_score)
-        credit_rating = calculate_credit_rating(risk_score)
+        # Read average credit score (excluding this mortgage) from the running aggregate
+        avg_credit_score = get_average_credit_score(exclude_score=mortgage.credit_score)
+        mark_phase('db_read')
         
         # Update mortgage fields
         mortgage.credit_score = data.get('creditScore', mortgage.credit_score)
@@ -136,78 +681,315 @@ def update_mortgage(id):
         mortgage.debt_amount = data.get('debtAmount', mortgage.debt_amount)
         mortgage.loan_type = data.get('loanType', mortgage.loan_type)
         mortgage.property_type = data.get('propertyType', mortgage.property_type)
+        if avg_credit_score is None:
+            avg_credit_score = mortgage.credit_score
+        
+        logger.info("Average credit score for calculation: %s", avg_credit_score)
+        
+        # Score the whole updated record, not just the fields in the request, as a backfill would
+        rules = get_rules()
+        risk_score = calculate_risk_score(mortgage.to_dict(), avg_credit_score, rules)
+        credit_rating = calculate_credit_rating(risk_score, rules)
+        mark_phase('score')
+        mortgage.risk_score = risk_score
+        mortgage.credit_rating = credit_rating
         
         db.session.commit()
-        logger.info(f"Updated mortgage with ID {id}")
+        mortgage_cache.invalidate(id)
+        mark_phase('commit')
+        logger.info("Updated mortgage with ID %s", id)
         
-        return jsonify({
+        response = jsonify({
             "message": "Mortgage updated successfully",
             "mortgage": mortgage.to_dict(),
-            "creditRating": credit_rating
-        }), 200
+            "creditRating": credit_rating,
+            "ruleSetVersion": rules.version
+        })
+        mark_phase('serialize')
+        return response, 200
     except Exception as e:
-        logger.error(f"Error updating mortgage: {str(e)}")
+        logger.error("Error updating mortgage: %s", e)
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/mortgages/<int:id>', methods=['DELETE'])
+@api.route('/api/mortgages/<int:id>', methods=['DELETE'])
 def delete_mortgage(id):
     """Delete a mortgage by ID"""
     try:
-        logger.info(f"Received request to delete mortgage with ID {id}")
+        logger.info("Received request to delete mortgage with ID %s", id)
         mortgage = Mortgage.query.get(id)
         if not mortgage:
-            logger.warning(f"Mortgage with ID {id} not found")
+            logger.warning("Mortgage with ID %s not found", id)
             return jsonify({"error": "Mortgage not found"}), 404
+        mark_phase('db_read')
         
         db.session.delete(mortgage)
         db.session.commit()
-        logger.info(f"Deleted mortgage with ID {id}")
+        mortgage_cache.invalidate(id)
+        mark_phase('commit')
+        logger.info("Deleted mortgage with ID %s", id)
         
         return jsonify({"message": "Mortgage deleted successfully"}), 200
     except Exception as e:
-        logger.error(f"Error deleting mortgage: {str(e)}")
+        logger.error("Error deleting mortgage: %s", e)
         return jsonify({"error": str(e)}), 500
 
-@app.route('/api/calculate-rating', methods=['POST'])
+@api.route('/api/calculate-rating', methods=['POST'])
+@read_replica
 def calculate_rating():
     """Calculate credit rating without saving to database"""
     try:
         data = request.json
-        logger.info(f"Received request to calculate rating: {data}")
+        logger.info("Received request to calculate rating: %s", data)
         
-        # Calculate average credit score from all existing mortgages
-        all_mortgages = Mortgage.query.all()
-        if all_mortgages:
-            avg_credit_score = sum(m.credit_score for m in all_mortgages) / len(all_mortgages)
-        else:
+        # Read average credit score of all existing mortgages from the running aggregate
+        avg_credit_score = get_average_credit_score()
+        if avg_credit_score is None:
             avg_credit_score = data.get('creditScore')
+        mark_phase('db_read')
         
-        # Calculate risk score and credit rating
-        risk_score = calculate_risk_score(data, avg_credit_score)
-        credit_rating = calculate_credit_rating(risk_score)
+        # Score components and rating in one pass, reusing results for inputs in the same bands
+        rules = get_rules()
+        components, risk_score, credit_rating = rating_cache.get_or_compute(data, avg_credit_score, rules)
+        mark_phase('score')
         
-        logger.info(f"Calculated credit rating: {credit_rating} with risk score: {risk_score}")
+        logger.info("Calculated credit rating: %s with risk score: %s", credit_rating, risk_score)
         
-        return jsonify({
+        response = jsonify({
             "creditRating": credit_rating,
             "riskScore": risk_score,
-            "components": {
-                "loanToValue": loan_to_value(float(data.get('loanAmount', 0)), float(data.get('propertyValue', 0))),
-                "debtToIncome": debt_to_income(float(data.get('debtAmount', 0)), float(data.get('annualIncome', 0))),
-                "creditScore": credit_score_check(int(data.get('creditScore', 0))),
-                "loanType": loan_type_process(data.get('loanType', 'fixed')),
-                "propertyType": property_type_process(data.get('propertyType', 'single_family')),
-                "avgCreditScore": average_credit_process(avg_credit_score)
+            "components": components,
+            "ruleSetVersion": rules.version
+        })
+        mark_phase('serialize')
+        return response, 200
+    except Exception as e:
+        logger.error("Error calculating rating: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/calculate-rating/grid', methods=['POST'])
+@read_replica
+def calculate_rating_grid():
+    """Rate one applicant over a grid of loan amounts, down payments and debts without saving anything"""
+    from rating_grid import parse_grid_axes, score_grid  # Only needed by this route
+    try:
+        payload = request.get_json(silent=True)
+        applicant = payload.get('applicant') if isinstance(payload, dict) else None
+        error = _validate_bulk_row(applicant)
+        if error:
+            logger.error("Invalid grid applicant: %s", error)
+            return jsonify({"error": f"applicant: {error}"}), 400
+        try:
+            axes = parse_grid_axes(payload, applicant)
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({"error": str(e)}), 400
+        mark_phase('validate')
+        
+        # One portfolio average read for the whole grid
+        avg_credit_score = get_average_credit_score()
+        if avg_credit_score is None:
+            avg_credit_score = float(applicant['creditScore'])
+        mark_phase('db_read')
+        
+        rules = get_rules()
+        result = score_grid(applicant, axes, avg_credit_score, rules)
+        result["ruleSetVersion"] = rules.version
+        mark_phase('score')
+        
+        response = jsonify(result)
+        mark_phase('serialize')
+        return response, 200
+    except Exception as e:
+        logger.error("Error calculating rating grid: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/calculate-rating/cache', methods=['GET'])
+def get_rating_cache_stats():
+    """Report hit/miss counters for the calculate-rating cache"""
+    return jsonify(rating_cache.stats()), 200
+
+@api.route('/api/portfolio/stats', methods=['GET'])
+@read_replica
+def get_portfolio_stats():
+    """Summarise the whole portfolio, computed with SQL aggregates"""
+    try:
+        stats = cached_portfolio_stats()
+        logger.info("Computed portfolio stats over %s mortgages", stats["creditScore"]["count"])
+        return jsonify(stats), 200
+    except Exception as e:
+        logger.error("Error computing portfolio stats: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/portfolio/ratings', methods=['GET'])
+@read_replica
+def get_portfolio_ratings_as_of():
+    """Rebuild the book's rating distribution as of ?asOf= from the rating history; ?limit= pages through the loans"""
+    try:
+        try:
+            as_of = parse_as_of(request.args.get('asOf'))
+            limit = parse_int_arg(request.args, 'limit', minimum=1, maximum=config.MAX_PAGE_SIZE)
+            after_id = parse_int_arg(request.args, 'after_id', minimum=0)
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({"error": str(e)}), 400
+        mark_phase('validate')
+        
+        # The distribution reads every loan's history, so pages leave it out and cost only their own rows
+        if limit is None:
+            distribution = rating_distribution_as_of(as_of)
+            result = {"asOf": as_of.isoformat(), "loanCount": sum(distribution.values()), "distribution": distribution}
+        else:
+            entries = ratings_as_of(as_of, limit, after_id)
+            result = {
+                "asOf": as_of.isoformat(),
+                "mortgages": [{
+                    "id": entry.mortgage_id,
+                    "riskScore": entry.risk_score,
+                    "creditRating": entry.credit_rating,
+                    "ratedAt": entry.created_at.isoformat()
+                } for entry in entries],
+                # The next page starts after the last id returned
+                "nextAfterId": entries[-1].mortgage_id if len(entries) == limit else None
             }
-        }), 200
+        mark_phase('db_read')
+        logger.info("Rebuilt ratings as of %s", as_of)
+        
+        response = jsonify(result)
+        mark_phase('serialize')
+        return response, 200
     except Exception as e:
-        logger.error(f"Error calculating rating: {str(e)}")
+        logger.error("Error rebuilding portfolio ratings: %s", e)
         return jsonify({"error": str(e)}), 500
 
+@api.route('/api/portfolio/stress', methods=['POST'])
+@read_replica
+def stress_portfolio():
+    """Re-rate the whole book under shock scenarios and report rating migrations"""
+    from stress import parse_scenarios, run_stress_test  # Only needed by this route
+    try:
+        try:
+            scenarios = parse_scenarios(request.get_json(silent=True))
+        except ValueError as e:
+            logger.error(str(e))
+            return jsonify({"error": str(e)}), 400
+        logger.info("Received request to stress test the portfolio under %s scenarios", len(scenarios))
+        mark_phase('validate')
+        
+        result = run_stress_test(scenarios)
+        mark_phase('score')
+        response = jsonify(result)
+        mark_phase('serialize')
+        return response, 200
+    except Exception as e:
+        logger.error("Error stress testing portfolio: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/portfolio/snapshot', methods=['GET'])
+def get_portfolio_snapshot_stats():
+    """Report the size and memory footprint of the in-memory portfolio snapshot"""
+    return jsonify(portfolio_snapshot.stats()), 200
+
+@api.route('/api/portfolio/snapshot/reload', methods=['POST'])
+def reload_portfolio_snapshot():
+    """Re-read the in-memory portfolio snapshot from the database"""
+    try:
+        if not config.PORTFOLIO_SNAPSHOT:
+            return jsonify({"error": "Portfolio snapshot is disabled"}), 400
+        portfolio_snapshot.reload()
+        return jsonify(portfolio_snapshot.stats()), 200
+    except Exception as e:
+        logger.error("Error reloading portfolio snapshot: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@api.route('/api/database/replicas', methods=['GET'])
+def get_replica_stats():
+    """Report the read replicas' health and how many transactions were routed to them"""
+    return jsonify(current_app.extensions['replica_router'].stats()), 200
+
+@api.route('/metrics', methods=['GET'])
+def get_metrics():
+    """Expose request latency, phase and SQL query histograms and rating queue metrics for Prometheus"""
+    return Response(render_metrics() + rating_queue.render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@api.route('/api/rules', methods=['GET'])
+def get_rule_set():
+    """Report the active scoring rule set version"""
+    return jsonify({"version": get_rules().version, "file": config.RULES_FILE}), 200
+
+@api.route('/api/rules/reload', methods=['POST'])
+def reload_rule_set():
+    """Reload the scoring rules from the rule file immediately"""
+    try:
+        rules = reload_rules()
+        return jsonify({"message": "Rules reloaded", "version": rules.version}), 200
+    except Exception as e:
+        logger.error("Error reloading rules: %s", e)
+        return jsonify({"error": str(e)}), 500
+
+@api.cli.command('rebuild-portfolio-aggregate')
+def rebuild_portfolio_aggregate_command():
+    """Recompute the running credit score aggregate from the mortgages table"""
+    credit_score_sum, mortgage_count = rebuild_portfolio_aggregate()
+    db.session.commit()
+    print(f"Rebuilt portfolio aggregate from {mortgage_count} mortgages (credit score sum {credit_score_sum})")
+
+@api.cli.command('backfill-ratings')
+@click.option('--chunk-size', default=5000, help="Mortgages scored and updated per transaction")
+@click.option('--all', 'rerate_all', is_flag=True, help="Re-rate every mortgage, not only unrated ones")
+def backfill_ratings_command(chunk_size, rerate_all):
+    """Store risk scores and credit ratings for mortgages in bulk"""
+    updated = backfill_ratings(chunk_size=chunk_size, only_missing=not rerate_all)
+    print(f"Backfilled ratings for {updated} mortgages")
+
+@api.cli.command('purge-idempotency-keys')
+def purge_idempotency_keys_command():
+    """Delete stored idempotency keys whose TTL has passed"""
+    purged = purge_expired_keys()
+    db.session.commit()
+    print(f"Purged {purged} expired idempotency keys")
+
+@api.cli.command('seed-rating-history')
+def seed_rating_history_command():
+    """Record a starting rating history entry for mortgages created before the history table existed"""
+    seeded = seed_rating_history()
+    db.session.commit()
+    print(f"Seeded rating history for {seeded} mortgages")
+
+@api.cli.command('export-mortgages')
+@click.argument('path')
+@click.option('--format', 'file_format', type=click.Choice(list(EXPORT_FORMATS)), help="Defaults to the file extension")
+def export_mortgages_command(path, file_format):
+    """Write every mortgage to a CSV, Arrow IPC or Parquet file"""
+    file_format = file_format or path.rsplit('.', 1)[-1].lower()
+    with open(path, 'wb') as file:
+        for chunk in export_stream(file_format, export_partitions()):
+            file.write(chunk)
+    print(f"Exported mortgages to {path}")
+
+@api.cli.command('import-mortgages')
+@click.argument('path')
+@click.option('--format', 'file_format', type=click.Choice(['csv', 'parquet']), help="Defaults to the file extension")
+@click.option('--keep-ids', is_flag=True, help="Keep the file's IDs, e.g. to restore an export into an empty table")
+def import_mortgages_command(path, file_format, keep_ids):
+    """Bulk-load mortgages from a CSV or Parquet file"""
+    file_format = file_format or path.rsplit('.', 1)[-1].lower()
+    imported = 0
+    try:
+        with open(path, 'rb') as file:
+            for imported in import_batches(file, file_format, keep_ids=keep_ids):
+                pass
+    finally:
+        if imported:
+            refresh_after_import()
+        print(f"Imported {imported} mortgages from {path}")
+
 if __name__ == '__main__':
+    app = create_app()
     with app.app_context():
         db.create_all()  # Create database tables if they don't exist
         logger.info("Database tables created")
+        create_portfolio_aggregate()
+    load_portfolio_snapshot(app)
     
     logger.info("Starting Flask application")
     app.run(debug=True)
\ No newline at end of file
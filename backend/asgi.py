@@ -0,0 +1,133 @@
+"""ASGI entry point: `uvicorn asgi:application`.
+
+GET /api/mortgages/<id> and paginated GET /api/mortgages?limit= are served
+natively with SQLAlchemy's asyncio engine, so waiting on the database does not
+hold a worker thread. Single mortgages go through the same cache as the Flask
+route, so both paths see each other's invalidations. Every other request is
+handed to the Flask app, which asgiref runs in its thread pool.
+"""
+import re
+from urllib.parse import parse_qsl
+from asgiref.wsgi import WsgiToAsgi
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from app import create_app, parse_int_arg, mortgage_list_query, mortgage_query, serialize_mortgage
+from mortgage_cache import mortgage_cache
+from serialization import ID_INDEX, encode_mortgages
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+app = create_app()
+wsgi_application = WsgiToAsgi(app)
+
+_engine = None
+_sessionmaker = None
+
+def get_sessionmaker():
+    """Create the async engine and its session factory on first use"""
+    global _engine, _sessionmaker
+    if _sessionmaker is None:
+        uri = config.async_database_uri(config.SQLALCHEMY_DATABASE_URI)
+        _engine = create_async_engine(uri, **config.engine_options(uri))
+        _sessionmaker = async_sessionmaker(_engine, expire_on_commit=False)
+        logger.info("Created async database engine")
+    return _sessionmaker
+
+async def send_json(send, status, payload, headers=()):
+    """Send a complete JSON response, with the same CORS header Flask-CORS adds"""
+    await send_body(send, status, app.json.dumps(payload).encode() + b"\n", headers)
+
+async def send_body(send, status, body, headers=()):
+    """Send an already encoded JSON body"""
+    await send({
+        'type': 'http.response.start',
+        'status': status,
+        'headers': [
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+            (b'access-control-allow-origin', b'*'),
+            *headers
+        ]
+    })
+    await send({'type': 'http.response.body', 'body': body})
+
+async def get_mortgage(send, id, if_none_match):
+    """Retrieve a single mortgage by ID"""
+    logger.info("Received async request to get mortgage with ID %s", id)
+    entry, token = mortgage_cache.get(id)
+    if entry is None:
+        async with get_sessionmaker()() as session:
+            row = (await session.execute(mortgage_query(id))).first()
+        if not row:
+            logger.warning("Mortgage with ID %s not found", id)
+            await send_json(send, 404, {"error": "Mortgage not found"})
+            return
+        entry = mortgage_cache.set(id, serialize_mortgage(row), token)
+
+    body, etag = entry
+    quoted_etag = f'"{etag}"'.encode()
+    if if_none_match and (if_none_match.strip() == b'*' or
+                          quoted_etag in [tag.strip().removeprefix(b'W/') for tag in if_none_match.split(b',')]):
+        await send({'type': 'http.response.start', 'status': 304,
+                    'headers': [(b'etag', quoted_etag), (b'access-control-allow-origin', b'*')]})
+        await send({'type': 'http.response.body', 'body': b''})
+        return
+    await send_body(send, 200, body, [(b'etag', quoted_etag)])
+
+async def get_mortgage_page(send, args):
+    """Retrieve one keyset-paginated page of mortgages"""
+    try:
+        limit = parse_int_arg(args, 'limit', minimum=1, maximum=config.MAX_PAGE_SIZE)
+        after_id = parse_int_arg(args, 'after_id', minimum=0)
+    except ValueError as e:
+        await send_json(send, 400, {"error": str(e)})
+        return
+
+    async with get_sessionmaker()() as session:
+        result = await session.execute(mortgage_list_query(args.get('rating'), after_id).limit(limit))
+        rows = result.all()
+    logger.info("Retrieved %s mortgages after ID %s", len(rows), after_id)
+
+    headers = []
+    if len(rows) == limit:
+        headers.append((b'x-next-after-id', str(rows[-1][ID_INDEX]).encode()))
+    await send_body(send, 200, encode_mortgages(rows) + b"\n", headers)
+
+MORTGAGE_PATH = re.compile(r'^/api/mortgages/(\d+)$')
+
+async def application(scope, receive, send):
+    """Route async read endpoints natively and everything else to Flask"""
+    if scope['type'] == 'lifespan':
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if _engine is not None:
+                    await _engine.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    if scope['type'] == 'http' and scope['method'] == 'GET':
+        try:
+            headers = dict(scope['headers'])
+            match = MORTGAGE_PATH.match(scope['path'])
+            if match:
+                await get_mortgage(send, int(match.group(1)), headers.get(b'if-none-match'))
+                return
+
+            args = dict(parse_qsl(scope['query_string'].decode()))
+            accept = headers.get(b'accept', b'')
+            # Full-table and NDJSON listings stay on Flask's streaming path
+            if scope['path'] == '/api/mortgages' and 'limit' in args and args.get('format') != 'ndjson' \
+                    and b'application/x-ndjson' not in accept:
+                await get_mortgage_page(send, args)
+                return
+        except Exception as e:
+            logger.error("Error serving async request %s: %s", scope['path'], e)
+            await send_json(send, 500, {"error": str(e)})
+            return
+
+    await wsgi_application(scope, receive, send)
\ No newline at end of file
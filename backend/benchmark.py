@@ -0,0 +1,473 @@
+"""Benchmark suite for the scoring functions and the mortgage API.
+
+For each table size the suite seeds a scratch database with synthetic
+mortgages, then times single and batch scoring and every mortgage endpoint
+through the Flask test client. Each benchmark reports throughput, latency
+percentiles and the peak memory traced during one extra call. Results can be
+written as JSON and compared against an earlier run to catch regressions:
+
+    python benchmark.py --output before.json
+    python benchmark.py --output after.json --compare before.json
+"""
+import argparse
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import numpy as np
+from credit_ratings import calculate_risk_score, calculate_credit_rating, \
+    calculate_risk_scores_batch, calculate_credit_ratings_batch
+from rules import get_rules
+
+DEFAULT_SIZES = (1000, 100000, 1000000)
+
+# Scalar benchmarks score at most this many rows; per-call latency does not change with more
+SCALAR_SAMPLE_SIZE = 100000
+
+SEED_CHUNK_SIZE = 50000
+BULK_REQUEST_ROWS = 1000
+
+def synthetic_mortgages(count, seed=0):
+    """Generate random mortgage payloads shaped like the API input"""
+    rng = random.Random(seed)
+    return [{
+        'creditScore': rng.randint(550, 820),
+        'loanAmount': rng.uniform(50000, 900000),
+        'propertyValue': rng.uniform(50000, 900000),
+        'annualIncome': rng.uniform(20000, 250000),
+        'debtAmount': rng.uniform(0, 150000),
+        'loanType': rng.choice(['fixed', 'adjustable']),
+        'propertyType': rng.choice(['single_family', 'condo'])
+    } for _ in range(count)]
+
+def synthetic_columns(count, seed=0):
+    """Generate the same shape of data as NumPy columns, cheap enough for a million rows"""
+    rng = np.random.default_rng(seed)
+    return {
+        'creditScore': rng.integers(550, 821, count),
+        'loanAmount': rng.uniform(50000, 900000, count),
+        'propertyValue': rng.uniform(50000, 900000, count),
+        'annualIncome': rng.uniform(20000, 250000, count),
+        'debtAmount': rng.uniform(0, 150000, count),
+        'loanType': rng.choice(['fixed', 'adjustable'], count),
+        'propertyType': rng.choice(['single_family', 'condo'], count)
+    }
+
+def to_columns(mortgages):
+    """Convert a list of payloads into a column dict"""
+    return {key: [m[key] for m in mortgages] for key in mortgages[0]}
+
+def to_rows(columns, start, stop):
+    """Convert a slice of NumPy columns back into API payloads"""
+    sliced = {key: values[start:stop].tolist() for key, values in columns.items()}
+    return [dict(zip(sliced, values)) for values in zip(*sliced.values())]
+
+def timed(func, *args):
+    """Run func once and return the elapsed wall time in seconds"""
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+def percentile(sorted_values, fraction):
+    """Return a percentile from an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def measure(call, repeat, rows_per_call=1):
+    """Time call(0) .. call(repeat - 1), then trace the peak memory of call(repeat).
+
+    Memory is traced on a separate call because tracemalloc slows down every
+    allocation and would distort the timings.
+    """
+    latencies = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        call(i)
+        latencies.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    try:
+        call(repeat)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    latencies.sort()
+    seconds = sum(latencies)
+    return {
+        'calls': repeat,
+        'rowsPerCall': rows_per_call,
+        'seconds': seconds,
+        'rowsPerSecond': repeat * rows_per_call / seconds if seconds else 0.0,
+        'p50Ms': percentile(latencies, 0.50) * 1000,
+        'p95Ms': percentile(latencies, 0.95) * 1000,
+        'p99Ms': percentile(latencies, 0.99) * 1000,
+        'peakMemoryBytes': peak
+    }
+
+def retained_bytes(call):
+    """Return the bytes still allocated by call() while its result is alive"""
+    tracemalloc.start()
+    try:
+        result = call()
+        current, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    return current
+
+def bench_scalar_scoring(mortgages, avg_credit_score):
+    """Score each mortgage through calculate_risk_score"""
+    for mortgage in mortgages:
+        calculate_credit_rating(calculate_risk_score(mortgage, avg_credit_score))
+
+def bench_batch_scoring(columns, avg_credit_score):
+    """Score all mortgages through calculate_risk_scores_batch"""
+    scores = calculate_risk_scores_batch(columns, avg_credit_score)
+    calculate_credit_ratings_batch(scores['total'])
+
+def branch_ltv_score(ltv):
+    """The hardcoded LTV branches the compiled rules replaced, kept as a baseline"""
+    if ltv > 90:
+        return 2
+    elif ltv > 80:
+        return 1
+    else:
+        return 0
+
+def branch_credit_rating(risk_score):
+    """The hardcoded rating branches the compiled rules replaced, kept as a baseline"""
+    if risk_score <= 2:
+        return "AAA"
+    elif risk_score <= 5:
+        return "BBB"
+    else:
+        return "C"
+
+def bench_rule_lookups(count):
+    """Time hardcoded branches against compiled rule lookups"""
+    rng = random.Random(2)
+    ltvs = [rng.uniform(40, 120) for _ in range(count)]
+    risk_scores = [rng.randint(-3, 9) for _ in range(count)]
+    rules = get_rules()
+    ltv_lookup = rules.loan_to_value.lookup
+    rating_lookup = rules.rating.lookup
+
+    def run(ltv_func, rating_func):
+        for ltv, risk_score in zip(ltvs, risk_scores):
+            ltv_func(ltv)
+            rating_func(risk_score)
+
+    return {
+        'rules.branch_lookups': measure(lambda i: run(branch_ltv_score, branch_credit_rating), 3, count),
+        'rules.compiled_lookups': measure(lambda i: run(ltv_lookup, rating_lookup), 3, count)
+    }
+
+def bench_scoring(columns, avg_credit_score):
+    """Time single-row and batch scoring over the synthetic columns"""
+    size = len(columns['creditScore'])
+    sample = to_rows(columns, 0, min(size, SCALAR_SAMPLE_SIZE))
+    risk_scores = [calculate_risk_score(mortgage, avg_credit_score) for mortgage in sample]
+    batch_repeat = 5 if size <= 100000 else 2
+
+    results = {
+        'scoring.calculate_risk_score': measure(
+            lambda i: calculate_risk_score(sample[i % len(sample)], avg_credit_score), len(sample)),
+        'scoring.calculate_credit_rating': measure(
+            lambda i: calculate_credit_rating(risk_scores[i % len(risk_scores)]), len(risk_scores)),
+        'scoring.batch_arrays': measure(
+            lambda i: bench_batch_scoring(columns, avg_credit_score), batch_repeat, size),
+        'scoring.batch_row_dicts': measure(
+            lambda i: bench_batch_scoring(sample, avg_credit_score), batch_repeat, len(sample))
+    }
+    results.update(bench_rule_lookups(len(sample)))
+    return results
+
+def seed_mortgages(engine, columns, avg_credit_score, chunk_size=SEED_CHUNK_SIZE):
+    """Insert the synthetic columns as mortgages with stored ratings"""
+    from models import Mortgage
+    size = len(columns['creditScore'])
+    with engine.begin() as connection:
+        for start in range(0, size, chunk_size):
+            stop = min(start + chunk_size, size)
+            chunk = {key: values[start:stop] for key, values in columns.items()}
+            risk_scores = calculate_risk_scores_batch(chunk, avg_credit_score)['total']
+            ratings = calculate_credit_ratings_batch(risk_scores)
+            connection.execute(Mortgage.__table__.insert(), [{
+                'credit_score': m['creditScore'],
+                'loan_amount': m['loanAmount'],
+                'property_value': m['propertyValue'],
+                'annual_income': m['annualIncome'],
+                'debt_amount': m['debtAmount'],
+                'loan_type': m['loanType'],
+                'property_type': m['propertyType'],
+                'risk_score': risk_score,
+                'credit_rating': rating
+            } for m, risk_score, rating in zip(to_rows(columns, start, stop), risk_scores.tolist(), ratings.tolist())])
+
+def expect(response, status):
+    """Fail the benchmark rather than time error responses"""
+    if response.status_code != status:
+        raise RuntimeError(f"{response.request.method} {response.request.path} returned "
+                           f"{response.status_code}, expected {status}: {response.get_data(as_text=True)[:200]}")
+    return response
+
+def bench_endpoints(app, size, requests, seed=0):
+    """Time every mortgage endpoint through the test client against a table of `size` rows.
+
+    Expects the table to hold mortgages with IDs 1..size. Reads and updates hit
+    random IDs; deletes remove IDs from the top of the table.
+    """
+    client = app.test_client()
+    rng = random.Random(seed)
+    payloads = synthetic_mortgages(requests + 1, seed=seed + 1)
+    bulk_payloads = synthetic_mortgages(BULK_REQUEST_ROWS, seed=seed + 2)
+    read_ids = [rng.randint(1, size) for _ in range(requests + 1)]
+    update_ids = [rng.randint(1, size - requests - 1) for _ in range(requests + 1)]
+    full_list_repeat = 3 if size <= 100000 else 1
+
+    def get_mortgage(i):
+        expect(client.get(f'/api/mortgages/{read_ids[i]}'), 200)
+
+    def get_hot_mortgage(i):
+        # Dashboards poll the same few loans; these reads are served from the mortgage cache
+        expect(client.get(f'/api/mortgages/{read_ids[i % 20]}'), 200)
+
+    def list_page(i):
+        expect(client.get(f'/api/mortgages?limit=100&after_id={read_ids[i] - 1}'), 200)
+
+    def list_page_by_rating(i):
+        expect(client.get('/api/mortgages?limit=100&rating=BBB'), 200)
+
+    def list_all(i):
+        # Consume the stream without holding the whole body
+        response = expect(client.get('/api/mortgages', buffered=False), 200)
+        for _ in response.response:
+            pass
+        response.close()
+
+    def portfolio_stats(i):
+        expect(client.get('/api/portfolio/stats'), 200)
+
+    def calculate_rating(i):
+        expect(client.post('/api/calculate-rating', json=payloads[i]), 200)
+
+    def create_mortgage(i):
+        expect(client.post('/api/mortgages', json=payloads[i]), 201)
+
+    def create_bulk(i):
+        expect(client.post('/api/mortgages/bulk', json=bulk_payloads), 201)
+
+    def update_mortgage(i):
+        expect(client.put(f'/api/mortgages/{update_ids[i]}', json=payloads[i]), 200)
+
+    def delete_mortgage(i):
+        expect(client.delete(f'/api/mortgages/{size - i}'), 200)
+
+    return {
+        'api.get_mortgage': measure(get_mortgage, requests),
+        'api.get_mortgage_hot': measure(get_hot_mortgage, requests),
+        'api.list_page': measure(list_page, requests),
+        'api.list_page_by_rating': measure(list_page_by_rating, requests),
+        'api.list_all_stream': measure(list_all, full_list_repeat, size),
+        'api.portfolio_stats': measure(portfolio_stats, 5),
+        'api.calculate_rating': measure(calculate_rating, requests),
+        'api.create_mortgage': measure(create_mortgage, requests),
+        'api.create_bulk': measure(create_bulk, 3, BULK_REQUEST_ROWS),
+        'api.update_mortgage': measure(update_mortgage, requests),
+        'api.delete_mortgage': measure(delete_mortgage, requests)
+    }
+
+def bench_serialization(app, rows):
+    """Time reading and encoding `rows` mortgages: ORM objects and to_dict against column tuples"""
+    import serialization
+    from flask import jsonify
+    from sqlalchemy import select
+    from models import db, Mortgage
+
+    orm_query = select(Mortgage).order_by(Mortgage.id).limit(rows)
+    column_query = select(*serialization.MORTGAGE_COLUMNS).order_by(Mortgage.id).limit(rows)
+    orjson = serialization.orjson
+
+    def orm_to_dict(i):
+        jsonify([mortgage.to_dict() for mortgage in db.session.execute(orm_query).scalars()]).get_data()
+        db.session.expunge_all()
+
+    def columns_stdlib(i):
+        serialization.orjson = None
+        try:
+            serialization.encode_mortgages(db.session.execute(column_query).all())
+        finally:
+            serialization.orjson = orjson
+
+    def columns_fast(i):
+        serialization.encode_mortgages(db.session.execute(column_query).all())
+
+    with app.app_context():
+        results = {
+            'serialization.orm_to_dict_jsonify': measure(orm_to_dict, 3, rows),
+            'serialization.columns_stdlib_json': measure(columns_stdlib, 3, rows)
+        }
+        if orjson is not None:
+            results['serialization.columns_orjson'] = measure(columns_fast, 3, rows)
+    return results
+
+def bench_snapshot(app, rows):
+    """Time loading the in-memory portfolio snapshot against loading the same rows as ORM objects"""
+    from models import db, Mortgage
+    from portfolio_snapshot import PortfolioSnapshot
+
+    def load_snapshot(i):
+        PortfolioSnapshot().load(db.session)
+
+    def load_orm_objects(i):
+        Mortgage.query.order_by(Mortgage.id).limit(rows).all()
+        db.session.expunge_all()
+
+    with app.app_context():
+        results = {
+            'snapshot.load': measure(load_snapshot, 3, rows),
+            'snapshot.orm_objects': measure(load_orm_objects, 3, rows)
+        }
+        # What each form keeps once loaded, as opposed to the peak while loading
+        snapshot = PortfolioSnapshot()
+        snapshot.load(db.session)
+        results['snapshot.load']['retainedBytesPerLoan'] = snapshot.memory_bytes() / snapshot.stats()['count']
+        results['snapshot.orm_objects']['retainedBytesPerLoan'] = retained_bytes(
+            lambda: Mortgage.query.order_by(Mortgage.id).limit(rows).all()) / rows
+        db.session.expunge_all()
+    print(f"snapshot.load: {results['snapshot.load']['retainedBytesPerLoan']:,.0f} bytes per loan held "
+          f"by the snapshot's columns, including spare capacity")
+    print(f"snapshot.orm_objects: {results['snapshot.orm_objects']['retainedBytesPerLoan']:,.0f} bytes per loan "
+          f"held by the loaded ORM objects and the session's identity map")
+    for name, result in results.items():
+        print(f"{name}: {result['peakMemoryBytes'] / rows:,.0f} bytes per loan at peak while loading, "
+              f"including the query result and temporary arrays")
+    return results
+
+def run_size(app, size, requests):
+    """Seed a fresh table of `size` mortgages and run every benchmark against it"""
+    from models import db
+    from portfolio import rebuild_portfolio_aggregate
+
+    columns = synthetic_columns(size)
+    avg_credit_score = float(columns['creditScore'].mean())
+    results = bench_scoring(columns, avg_credit_score)
+
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        seconds = timed(seed_mortgages, db.engine, columns, avg_credit_score)
+        print(f"Seeded {size} mortgages in {seconds:.1f}s")
+        rebuild_portfolio_aggregate()
+        db.session.commit()
+    del columns
+
+    results.update(bench_serialization(app, min(size, SCALAR_SAMPLE_SIZE)))
+    if size <= SCALAR_SAMPLE_SIZE:
+        results.update(bench_snapshot(app, size))
+    results.update(bench_endpoints(app, size, requests))
+    return results
+
+def git_commit():
+    """Return the current commit hash, or None outside a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def compare_results(previous, current, tolerance):
+    """Return (size, benchmark, message) for each benchmark that got slower than the tolerance allows"""
+    regressions = []
+    for size, benchmarks in current['results'].items():
+        for name, result in benchmarks.items():
+            before = previous.get('results', {}).get(size, {}).get(name)
+            if before is None:
+                continue
+            if result['rowsPerSecond'] < before['rowsPerSecond'] * (1 - tolerance):
+                regressions.append((size, name, f"throughput {before['rowsPerSecond']:,.0f} -> "
+                                                f"{result['rowsPerSecond']:,.0f} rows/s"))
+            if result['p95Ms'] > before['p95Ms'] * (1 + tolerance):
+                regressions.append((size, name, f"p95 {before['p95Ms']:.3f} -> {result['p95Ms']:.3f} ms"))
+    return regressions
+
+def report(name, result):
+    print(f"{name:<32} {result['calls']:>7} {result['rowsPerSecond']:>14,.0f} {result['p50Ms']:>9.3f} "
+          f"{result['p95Ms']:>9.3f} {result['p99Ms']:>9.3f} {result['peakMemoryBytes'] / 2 ** 20:>9.1f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark credit rating scoring and the mortgage API")
+    parser.add_argument('--sizes', default=','.join(map(str, DEFAULT_SIZES)),
+                        help="comma-separated table sizes to seed and benchmark")
+    parser.add_argument('--requests', type=int, default=200, help="requests per endpoint benchmark")
+    parser.add_argument('--database-url', help="database to benchmark against (default: a scratch SQLite file)")
+    parser.add_argument('--output', help="write the results to this JSON file")
+    parser.add_argument('--compare', help="JSON results from an earlier run to check for regressions")
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help="allowed slowdown against --compare before failing, as a fraction")
+    parser.add_argument('--with-logging', action='store_true', help="keep application logging on while timing")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(',')]
+
+    # Measure the work itself rather than log I/O unless asked otherwise
+    if not args.with_logging:
+        logging.disable(logging.INFO)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        from app import create_app
+        app = create_app({
+            'SQLALCHEMY_DATABASE_URI': args.database_url or f"sqlite:///{os.path.join(workdir, 'benchmark.db')}"
+        })
+
+        results = {}
+        for size in sizes:
+            print(f"\n{size} mortgages")
+            results[str(size)] = run_size(app, size, args.requests)
+            print(f"{'benchmark':<32} {'calls':>7} {'rows/s':>14} {'p50 ms':>9} {'p95 ms':>9} "
+                  f"{'p99 ms':>9} {'peak MiB':>9}")
+            for name, result in results[str(size)].items():
+                report(name, result)
+
+        from models import db
+        with app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+
+    output = {
+        'meta': {
+            'createdAt': datetime.now(timezone.utc).isoformat(),
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'rulesVersion': get_rules().version,
+            'requests': args.requests
+        },
+        'results': results
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+        print(f"\nWrote results to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+        regressions = compare_results(previous, output, args.tolerance)
+        for size, name, message in regressions:
+            print(f"REGRESSION {size} rows {name}: {message}")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions against {args.compare} (commit {previous['meta'].get('commit')})")
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
@@ -0,0 +1,109 @@
+"""In-process fan-out of mortgage change events to GET /api/mortgages/changes streams.
+
+Every rating history entry is a change event, and the entry's ID is the
+event ID. rating_history collects the entries a transaction writes and
+publishes them here once it commits, so streams never see a write that was
+rolled back.
+
+Each subscriber has a bounded buffer, so a slow client never holds up the
+writers. A subscriber whose buffer overflows is marked as lagging and its
+events are dropped, remembering the lowest dropped ID. Its stream then
+reads everything from that ID on back from the history table. Event IDs
+are assigned when entries are written, not when they commit, so they are
+not a gap-free watermark: catching up starts at the lowest event actually
+dropped, not at the highest one delivered. Events are only published
+within one process; writes committed by other processes reach a stream
+when it catches up from the table.
+"""
+import itertools
+import json
+import threading
+from collections import deque
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+class Subscription:
+    """One stream's bounded buffer of change events"""
+
+    def __init__(self, size):
+        self._events = deque()
+        self._size = size
+        self._ready = threading.Condition()
+        self._dropped_from = None
+
+    def push(self, events):
+        """Buffer events, or drop them and mark the subscriber lagging if they do not fit.
+
+        Returns True if this push started the subscriber lagging.
+        """
+        with self._ready:
+            if self._dropped_from is not None:
+                self._dropped_from = min(self._dropped_from, min(event['id'] for event in events))
+                return False
+            overflowed = len(self._events) + len(events) > self._size
+            if overflowed:
+                self._dropped_from = min(event['id'] for event in itertools.chain(self._events, events))
+                self._events.clear()
+            else:
+                self._events.extend(events)
+            self._ready.notify()
+            return overflowed
+
+    def get(self, timeout):
+        """Wait up to `timeout` seconds and return (buffered events, lowest dropped event ID or None)"""
+        with self._ready:
+            self._ready.wait_for(lambda: self._events or self._dropped_from is not None, timeout)
+            events = list(self._events)
+            self._events.clear()
+            dropped_from, self._dropped_from = self._dropped_from, None
+            return events, dropped_from
+
+class ChangeFeed:
+    """Registry of open subscriptions"""
+
+    def __init__(self):
+        self._subscriptions = set()
+        self._lock = threading.Lock()
+        self.counters = {'published': 0, 'lagged': 0}
+
+    def has_subscribers(self):
+        return bool(self._subscriptions)
+
+    def subscribe(self, size=None):
+        """Open a subscription, or return None if CHANGE_FEED_MAX_SUBSCRIBERS are already open"""
+        with self._lock:
+            if len(self._subscriptions) >= config.CHANGE_FEED_MAX_SUBSCRIBERS:
+                return None
+            subscription = Subscription(size or config.CHANGE_FEED_BUFFER_SIZE)
+            self._subscriptions.add(subscription)
+        logger.info("Change feed subscriber joined, %s open", len(self._subscriptions))
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+        logger.info("Change feed subscriber left, %s open", len(self._subscriptions))
+
+    def publish(self, events):
+        """Hand committed events to every subscriber"""
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+            self.counters['published'] += len(events)
+        lagged = sum(subscription.push(events) for subscription in subscriptions)
+        if lagged:
+            with self._lock:
+                self.counters['lagged'] += lagged
+
+    def stats(self):
+        """Report open subscriptions and event counters"""
+        with self._lock:
+            return {"subscribers": len(self._subscriptions), **self.counters}
+
+change_feed = ChangeFeed()
+
+def format_event(event):
+    """Encode a change event as a Server-Sent Events message"""
+    return f"id: {event['id']}\ndata: {json.dumps(event, separators=(',', ':'))}\n\n".encode()
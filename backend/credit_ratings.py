@@ -1,130 +1,268 @@
+import contextvars
+import logging
+import random
+from collections.abc import Mapping
+import numpy as np
+from rules import get_rules
 from logger import setup_logger
+import Config as config
 
 # Set up logger for this module
 logger = setup_logger(__name__)
 
-def loan_to_value(loan_amount, property_value):
+# Per-rule trace lines go out at RULE_TRACE_LEVEL, except for the sampled
+# fraction of scoring calls whose whole trace is logged at INFO
+TRACE_LEVEL = getattr(logging, config.RULE_TRACE_LEVEL.upper())
+_trace_sampled = contextvars.ContextVar('trace_sampled', default=False)
+
+def _trace(msg, *args):
+    """Log a per-rule scoring trace line"""
+    if _trace_sampled.get():
+        logger.info(msg, *args)
+    elif logger.isEnabledFor(TRACE_LEVEL):
+        logger.log(TRACE_LEVEL, msg, *args)
+
+def loan_to_value(loan_amount, property_value, rules=None):
     """Calculate risk score based on loan-to-value ratio"""
+    rule = (rules or get_rules()).loan_to_value
     try:
         ltv = (loan_amount / property_value) * 100
-        logger.info(f"Calculated LTV: {ltv:.2f}%")
+        _trace("Calculated LTV: %.2f%%", ltv)
         
-        if ltv > 90:
-            logger.info("LTV > 90%: Adding 2 points to risk score")
-            return 2
-        elif ltv > 80:
-            logger.info("LTV > 80%: Adding 1 point to risk score")
-            return 1
-        else:
-            logger.info("LTV <= 80%: No points added to risk score")
-            return 0
+        score = rule.lookup(ltv)
+        _trace("LTV rule: adding %s points to risk score", score)
+        return score
     except ZeroDivisionError:
         logger.error("Property value cannot be zero when calculating LTV")
-        return 2  # Assign maximum risk if property value is zero
+        return rule.zero_denominator_score  # Assign maximum risk if property value is zero
 
-def debt_to_income(debt_amount, annual_income):
+def debt_to_income(debt_amount, annual_income, rules=None):
     """Calculate risk score based on debt-to-income ratio"""
+    rule = (rules or get_rules()).debt_to_income
     try:
         dti = (debt_amount / annual_income) * 100
-        logger.info(f"Calculated DTI: {dti:.2f}%")
+        _trace("Calculated DTI: %.2f%%", dti)
         
-        if dti > 50:
-            logger.info("DTI > 50%: Adding 2 points to risk score")
-            return 2
-        elif dti > 40:
-            logger.info("DTI > 40%: Adding 1 point to risk score")
-            return 1
-        else:
-            logger.info("DTI <= 40%: No points added to risk score")
-            return 0
+        score = rule.lookup(dti)
+        _trace("DTI rule: adding %s points to risk score", score)
+        return score
     except ZeroDivisionError:
         logger.error("Annual income cannot be zero when calculating DTI")
-        return 2  # Assign maximum risk if annual income is zero
+        return rule.zero_denominator_score  # Assign maximum risk if annual income is zero
 
-def credit_score_check(credit_score):
+def credit_score_check(credit_score, rules=None):
     """Calculate risk score based on credit score"""
-    if credit_score >= 700:
-        logger.info("Credit score >= 700: Subtracting 1 point from risk score")
-        return -1
-    elif credit_score >= 650:
-        logger.info("650 <= Credit score < 700: No change to risk score")
-        return 0
-    else:
-        logger.info("Credit score < 650: Adding 1 point to risk score")
-        return 1
-
-def loan_type_process(loan_type):
+    rule = (rules or get_rules()).credit_score
+    score = rule.lookup(credit_score)
+    _trace("Credit score %s: adding %s points to risk score", credit_score, score)
+    return score
+
+def loan_type_process(loan_type, rules=None):
     """Calculate risk score based on loan type"""
-    if loan_type == 'fixed':
-        logger.info("Fixed-rate loan: Subtracting 1 point from risk score")
-        return -1
-    else:  # 'adjustable'
-        logger.info("Adjustable-rate loan: Adding 1 point to risk score")
-        return 1
-
-def property_type_process(property_type):
+    score = (rules or get_rules()).loan_type.lookup(loan_type)
+    _trace("Loan type %s: adding %s points to risk score", loan_type, score)
+    return score
+
+def property_type_process(property_type, rules=None):
     """Calculate risk score based on property type"""
-    if property_type == 'single_family':
-        logger.info("Single-family home: No change to risk score")
-        return 0
-    else:  # 'condo'
-        logger.info("Condo: Adding 1 point to risk score")
-        return 1
-
-def average_credit_process(avg_credit_score):
+    score = (rules or get_rules()).property_type.lookup(property_type)
+    _trace("Property type %s: adding %s points to risk score", property_type, score)
+    return score
+
+def average_credit_process(avg_credit_score, rules=None):
     """Calculate risk score adjustment based on average credit score"""
-    if avg_credit_score >= 700:
-        logger.info("Average credit score >= 700: Subtracting 1 point from risk score")
-        return -1
-    elif avg_credit_score < 650:
-        logger.info("Average credit score < 650: Adding 1 point to risk score")
-        return 1
-    else:
-        logger.info("650 <= Average credit score < 700: No change to risk score")
-        return 0
-
-def calculate_credit_rating(risk_score):
+    rule = (rules or get_rules()).avg_credit_score
+    score = rule.lookup(avg_credit_score)
+    _trace("Average credit score %s: adding %s points to risk score", avg_credit_score, score)
+    return score
+
+def calculate_credit_rating(risk_score, rules=None):
     """Determine credit rating based on risk score"""
-    if risk_score <= 2:
-        logger.info(f"Risk score {risk_score} <= 2: Assigning AAA rating")
-        return "AAA"
-    elif risk_score <= 5:
-        logger.info(f"Risk score 3 <= {risk_score} <= 5: Assigning BBB rating")
-        return "BBB"
-    else:
-        logger.info(f"Risk score {risk_score} > 5: Assigning C rating")
-        return "C"
-
-def calculate_risk_score(data, avg_credit_score=None):
-    """Calculate the total risk score for a mortgage"""
-    logger.info("Starting risk score calculation")
+    rule = (rules or get_rules()).rating
+    rating = rule.lookup(risk_score)
+    _trace("Risk score %s: assigning %s rating", risk_score, rating)
+    return rating
+
+def _extract_fields(data):
+    """Read the scoring inputs from a mortgage payload, applying defaults"""
+    return (
+        float(data.get('loanAmount', 0)),
+        float(data.get('propertyValue', 0)),
+        int(data.get('creditScore', 0)),
+        float(data.get('annualIncome', 0)),
+        float(data.get('debtAmount', 0)),
+        data.get('loanType', 'fixed'),
+        data.get('propertyType', 'single_family')
+    )
+
+def _ratio_band(rule, numerator, denominator):
+    """Return the band of a percentage ratio, or None for a zero denominator"""
+    if denominator == 0:
+        return None
+    return rule.band((numerator / denominator) * 100)
+
+def average_credit_band(avg_credit_score, rules=None):
+    """Return the band of the portfolio average credit score"""
+    return (rules or get_rules()).avg_credit_score.band(avg_credit_score)
+
+def risk_bands(data, rules=None):
+    """Return the rule bands a mortgage falls into, without scoring or logging.
+
+    Two payloads with the same bands (and the same average credit band) always
+    get the same risk score components under one rule set.
+    """
+    rules = rules or get_rules()
+    loan_amount, property_value, credit_score, annual_income, debt_amount, loan_type, property_type = _extract_fields(data)
+    return (
+        _ratio_band(rules.loan_to_value, loan_amount, property_value),
+        _ratio_band(rules.debt_to_income, debt_amount, annual_income),
+        rules.credit_score.band(credit_score),
+        loan_type,
+        property_type
+    )
+
+def calculate_risk_components(data, avg_credit_score=None, rules=None):
+    """Calculate each risk score component and the total for a mortgage in one pass"""
+    rules = rules or get_rules()
+    sampled = config.RULE_TRACE_SAMPLE_RATE > 0 and random.random() < config.RULE_TRACE_SAMPLE_RATE
+    token = _trace_sampled.set(sampled)
+    try:
+        return _calculate_risk_components(data, avg_credit_score, rules)
+    finally:
+        _trace_sampled.reset(token)
+
+def _calculate_risk_components(data, avg_credit_score, rules):
+    """Score every component of a mortgage with the given rules"""
+    _trace("Starting risk score calculation with rule set %s", rules.version)
     
     # Extract data
-    loan_amount = float(data.get('loanAmount', 0))
-    property_value = float(data.get('propertyValue', 0))
-    credit_score = int(data.get('creditScore', 0))
-    annual_income = float(data.get('annualIncome', 0))
-    debt_amount = float(data.get('debtAmount', 0))
-    loan_type = data.get('loanType', 'fixed')
-    property_type = data.get('propertyType', 'single_family')
+    loan_amount, property_value, credit_score, annual_income, debt_amount, loan_type, property_type = _extract_fields(data)
     
     # Use the provided credit score as average if not specified
     if avg_credit_score is None:
         avg_credit_score = credit_score
     
     # Calculate individual risk scores
-    ltv_score = loan_to_value(loan_amount, property_value)
-    dti_score = debt_to_income(debt_amount, annual_income)
-    credit_score_adjustment = credit_score_check(credit_score)
-    loan_type_adjustment = loan_type_process(loan_type)
-    property_type_adjustment = property_type_process(property_type)
-    avg_credit_adjustment = average_credit_process(avg_credit_score)
+    components = {
+        'loanToValue': loan_to_value(loan_amount, property_value, rules),
+        'debtToIncome': debt_to_income(debt_amount, annual_income, rules),
+        'creditScore': credit_score_check(credit_score, rules),
+        'loanType': loan_type_process(loan_type, rules),
+        'propertyType': property_type_process(property_type, rules),
+        'avgCreditScore': average_credit_process(avg_credit_score, rules)
+    }
     
     # Calculate total risk score
-    total_score = ltv_score + dti_score + credit_score_adjustment + loan_type_adjustment + property_type_adjustment + avg_credit_adjustment
+    total_score = sum(components.values())
     
-    logger.info(f"Risk score components: LTV={ltv_score}, DTI={dti_score}, Credit={credit_score_adjustment}, "
-                f"Loan={loan_type_adjustment}, Property={property_type_adjustment}, AvgCredit={avg_credit_adjustment}")
-    logger.info(f"Total risk score: {total_score}")
+    _trace("Risk score components: LTV=%s, DTI=%s, Credit=%s, Loan=%s, Property=%s, AvgCredit=%s",
+           components['loanToValue'], components['debtToIncome'], components['creditScore'],
+           components['loanType'], components['propertyType'], components['avgCreditScore'])
+    _trace("Total risk score: %s", total_score)
     
-    return total_score
\ No newline at end of file
+    return components, total_score
+
+def calculate_risk_score(data, avg_credit_score=None, rules=None):
+    """Calculate the total risk score for a mortgage"""
+    components, total_score = calculate_risk_components(data, avg_credit_score, rules)
+    return total_score
+
+# Column names and defaults shared with calculate_risk_score
+BATCH_DEFAULTS = {
+    'loanAmount': 0,
+    'propertyValue': 0,
+    'creditScore': 0,
+    'annualIncome': 0,
+    'debtAmount': 0,
+    'loanType': 'fixed',
+    'propertyType': 'single_family'
+}
+
+def _batch_columns(data):
+    """Turn a column dict or a list of row dicts into equal-length NumPy columns"""
+    if not isinstance(data, Mapping):
+        rows = list(data)
+        data = {key: [row.get(key, default) for row in rows] for key, default in BATCH_DEFAULTS.items()}
+
+    # Row count comes from the first column that is not a scalar
+    length = 0
+    for value in data.values():
+        if np.ndim(value) > 0:
+            length = len(value)
+            break
+
+    columns = {}
+    for key, default in BATCH_DEFAULTS.items():
+        columns[key] = np.broadcast_to(np.asarray(data.get(key, default)), (length,))
+
+    return {
+        'loanAmount': columns['loanAmount'].astype(np.float64),
+        'propertyValue': columns['propertyValue'].astype(np.float64),
+        'creditScore': columns['creditScore'].astype(np.float64).astype(np.int64),
+        'annualIncome': columns['annualIncome'].astype(np.float64),
+        'debtAmount': columns['debtAmount'].astype(np.float64),
+        'loanType': columns['loanType'],
+        'propertyType': columns['propertyType']
+    }
+
+def _ratio_scores_batch(rule, numerator, denominator):
+    """Score arrays of percentage ratios, giving zero denominators the rule's fallback score"""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = (numerator / denominator) * 100
+    return np.where(denominator == 0, rule.zero_denominator_score, rule.lookup_batch(ratio))
+
+def loan_to_value_batch(loan_amount, property_value, rules=None):
+    """Calculate loan-to-value risk scores for arrays of loans"""
+    return _ratio_scores_batch((rules or get_rules()).loan_to_value, loan_amount, property_value)
+
+def debt_to_income_batch(debt_amount, annual_income, rules=None):
+    """Calculate debt-to-income risk scores for arrays of loans"""
+    return _ratio_scores_batch((rules or get_rules()).debt_to_income, debt_amount, annual_income)
+
+def credit_score_check_batch(credit_score, rules=None):
+    """Calculate credit score risk adjustments for an array of scores"""
+    return (rules or get_rules()).credit_score.lookup_batch(credit_score)
+
+def loan_type_process_batch(loan_type, rules=None):
+    """Calculate loan type risk adjustments for an array of loan types"""
+    return (rules or get_rules()).loan_type.lookup_batch(loan_type)
+
+def property_type_process_batch(property_type, rules=None):
+    """Calculate property type risk adjustments for an array of property types"""
+    return (rules or get_rules()).property_type.lookup_batch(property_type)
+
+def average_credit_process_batch(avg_credit_score, rules=None):
+    """Calculate average credit score risk adjustments for an array of averages"""
+    return (rules or get_rules()).avg_credit_score.lookup_batch(avg_credit_score)
+
+def calculate_risk_scores_batch(data, avg_credit_score=None, rules=None):
+    """Calculate risk score components and totals for many mortgages at once.
+
+    data is either a dict of columns keyed like the API payload (values may be
+    arrays or scalars) or an iterable of payload dicts. avg_credit_score may be
+    a scalar or an array; when None each loan's own credit score is used.
+    """
+    rules = rules or get_rules()
+    columns = _batch_columns(data)
+    credit_score = columns['creditScore']
+
+    if avg_credit_score is None:
+        avg_credit_score = credit_score
+    avg_credit_score = np.broadcast_to(np.asarray(avg_credit_score, dtype=np.float64), credit_score.shape)
+
+    components = {
+        'loanToValue': loan_to_value_batch(columns['loanAmount'], columns['propertyValue'], rules),
+        'debtToIncome': debt_to_income_batch(columns['debtAmount'], columns['annualIncome'], rules),
+        'creditScore': credit_score_check_batch(credit_score, rules),
+        'loanType': loan_type_process_batch(columns['loanType'], rules),
+        'propertyType': property_type_process_batch(columns['propertyType'], rules),
+        'avgCreditScore': average_credit_process_batch(avg_credit_score, rules)
+    }
+    components['total'] = sum(components.values())
+
+    logger.info("Calculated batch risk scores for %s mortgages with rule set %s", len(credit_score), rules.version)
+    return components
+
+def calculate_credit_ratings_batch(risk_scores, rules=None):
+    """Determine credit ratings for an array of risk scores"""
+    return (rules or get_rules()).rating.lookup_batch(np.asarray(risk_scores))
\ No newline at end of file
@@ -0,0 +1,169 @@
+"""Read/write splitting between the primary database and read replicas.
+
+Replicas are Flask-SQLAlchemy binds named replica_0, replica_1, ... built from
+REPLICA_DATABASE_URIS. RoutingSession sends a SELECT to a replica only from a
+view marked @read_replica, in a request that has not written anything, from a
+client that has not written within READ_YOUR_WRITES_WINDOW seconds. A cookie
+set on every response to a write tracks that window. Everything else,
+including work outside requests such as the rating workers and CLI commands,
+uses the primary. A transaction keeps the replica it started on; successive
+transactions take the replicas in turn.
+
+A replica whose query fails with an operational error, such as a refused
+connection, is skipped for REPLICA_RETRY_INTERVAL seconds and then tried
+again. The @read_replica view that hit the failure runs once more on the
+primary. With every replica down, reads go to the primary.
+"""
+import itertools
+import threading
+import time
+from functools import partial, wraps
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event
+from sqlalchemy.exc import OperationalError
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+REPLICA_PREFIX = 'replica_'
+PRIMARY_COOKIE = 'db_primary_until'
+
+def replica_binds(uris):
+    """SQLALCHEMY_BINDS entries for replica URIs, each with the pool options for its database"""
+    return {f"{REPLICA_PREFIX}{index}": {'url': uri, **config.engine_options(uri)} for index, uri in enumerate(uris)}
+
+class ReplicaRouter:
+    """Round-robin choice among the replicas that are not marked down"""
+
+    def __init__(self, keys):
+        self.keys = list(keys)
+        self._turn = itertools.count()
+        self._down_until = {}
+        self._lock = threading.Lock()
+        self.counters = {'replicaTransactions': 0, 'primaryFallbacks': 0, 'failures': 0, 'retries': 0}
+
+    def choose(self):
+        """Return the next healthy replica's bind key, or None if every replica is down"""
+        now = time.monotonic()
+        with self._lock:
+            start = next(self._turn)
+            for offset in range(len(self.keys)):
+                key = self.keys[(start + offset) % len(self.keys)]
+                if self._down_until.get(key, 0) <= now:
+                    self.counters['replicaTransactions'] += 1
+                    return key
+            self.counters['primaryFallbacks'] += 1
+            return None
+
+    def mark_down(self, key):
+        with self._lock:
+            self._down_until[key] = time.monotonic() + config.REPLICA_RETRY_INTERVAL
+            self.counters['failures'] += 1
+        logger.warning("Replica %s failed; reading from other databases for %s seconds", key,
+                       config.REPLICA_RETRY_INTERVAL)
+
+    def count_retry(self):
+        with self._lock:
+            self.counters['retries'] += 1
+
+    def stats(self):
+        """Report each replica's health and the routing counters"""
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "replicas": [{"bind": key, "healthy": self._down_until.get(key, 0) <= now} for key in self.keys],
+                **self.counters
+            }
+
+def _router():
+    return current_app.extensions.get('replica_router')
+
+class RoutingSession(Session):
+    """Session that sends the reads of @read_replica views to a replica"""
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and has_request_context():
+            if self._flushing or getattr(clause, 'is_dml', False):
+                # The response pins this client to the primary, so its next reads see the write
+                g.db_wrote = True
+            elif g.get('read_replica') and getattr(clause, 'is_select', False) and \
+                    not g.get('db_wrote') and not g.get('db_pinned'):
+                engine = self._replica_engine()
+                if engine is not None:
+                    return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+    def _replica_engine(self):
+        key = self.info.get('replica_bind')
+        if key is None:
+            router = _router()
+            if router is None or not router.keys:
+                return None
+            key = router.choose()
+            if key is None:
+                return None
+            self.info['replica_bind'] = key
+        return self._db.engines[key]
+
+@event.listens_for(RoutingSession, "after_transaction_end")
+def _release_replica(session, transaction):
+    # The next transaction takes the next replica in turn
+    if transaction.parent is None:
+        session.info.pop('replica_bind', None)
+
+def read_from_replica(session):
+    """Whether the session's current transaction reads from a replica"""
+    return 'replica_bind' in session.info
+
+def read_replica(view):
+    """Let a read-only view's queries go to a replica, rerunning it on the primary if the replica fails"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_replica = True
+        response = view(*args, **kwargs)
+        if g.pop('replica_failed', False):
+            current_app.extensions['sqlalchemy'].session.rollback()
+            g.read_replica = False
+            _router().count_retry()
+            logger.info("Retrying %s on the primary", request.path)
+            response = view(*args, **kwargs)
+        return response
+    return wrapper
+
+def _replica_error(router, key, context):
+    """Mark a replica down when a query or connection attempt on it fails operationally"""
+    if context.is_disconnect or isinstance(context.sqlalchemy_exception, OperationalError):
+        router.mark_down(key)
+        if has_request_context():
+            g.replica_failed = True
+
+def _check_primary_pin():
+    try:
+        g.db_pinned = float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        g.db_pinned = False
+
+def _set_primary_pin(response):
+    if g.get('db_wrote'):
+        window = config.READ_YOUR_WRITES_WINDOW
+        response.set_cookie(PRIMARY_COOKIE, f"{time.time() + window:.3f}", max_age=window, httponly=True,
+                            samesite='Lax')
+    return response
+
+def init_db_routing(app):
+    """Set up replica routing for an app whose SQLALCHEMY_BINDS include replicas"""
+    keys = sorted(key for key in app.config.get('SQLALCHEMY_BINDS') or {} if key.startswith(REPLICA_PREFIX))
+    router = ReplicaRouter(keys)
+    app.extensions['replica_router'] = router
+    if not keys:
+        return
+    with app.app_context():
+        engines = app.extensions['sqlalchemy'].engines
+        for key in keys:
+            event.listen(engines[key], 'handle_error', partial(_replica_error, router, key))
+    app.before_request(_check_primary_pin)
+    app.after_request(_set_primary_pin)
+    logger.info("Routing read-only requests to %s replicas", len(keys))
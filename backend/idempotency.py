@@ -0,0 +1,60 @@
+import hashlib
+import json
+from datetime import datetime, timedelta
+from sqlalchemy import delete
+from models import db, IdempotencyKey
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+
+def request_fingerprint(method, path, data):
+    """Hash a request so a key reused for a different request can be told apart from a retry"""
+    body = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(f"{method} {path} {body}".encode()).hexdigest()
+
+def find_response(key, fingerprint, session=None):
+    """Return the stored (status code, body) for a key, or None if the key is new or expired.
+
+    Raises ValueError if the key was used for a different request.
+    """
+    session = session or db.session
+    stored = session.get(IdempotencyKey, key)
+    if stored is None:
+        return None
+    if stored.expires_at <= datetime.utcnow():
+        # Free the key within the caller's transaction so it can be stored again
+        session.delete(stored)
+        session.flush()
+        return None
+    if stored.request_hash != fingerprint:
+        raise ValueError(f"{IDEMPOTENCY_HEADER} {key} was already used for a different request")
+    return stored.status_code, stored.response_body
+
+def store_response(key, fingerprint, status_code, body, session=None):
+    """Record a response in the caller's transaction, so it commits together with the write it describes.
+
+    A concurrent request with the same key fails the commit on the primary key
+    instead of inserting a second mortgage.
+    """
+    session = session or db.session
+    now = datetime.utcnow()
+    session.add(IdempotencyKey(
+        key=key,
+        request_hash=fingerprint,
+        status_code=status_code,
+        response_body=body,
+        created_at=now,
+        expires_at=now + timedelta(seconds=config.IDEMPOTENCY_KEY_TTL)
+    ))
+
+def purge_expired_keys(session=None):
+    """Delete expired keys and return how many were removed; the caller commits"""
+    session = session or db.session
+    result = session.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at <= datetime.utcnow()))
+    logger.info("Purged %s expired idempotency keys", result.rowcount)
+    return result.rowcount
\ No newline at end of file
@@ -0,0 +1,172 @@
+"""Per-request timing, Prometheus metrics, SQL query counting and sampled profiling.
+
+Views call mark_phase(name) at the end of each phase (validation, database
+reads, scoring, commit, serialization); the time since the previous mark is
+charged to that phase. Every response gets a Server-Timing header with the
+phases, the SQL time and query count, and the total. The same numbers feed
+the histograms rendered by render_metrics() for GET /metrics.
+
+Durations are measured until the view returns, so the body of a streamed
+response is not included.
+"""
+import cProfile
+import os
+import threading
+import time
+from bisect import bisect_left
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+class Histogram:
+    """Cumulative-bucket histogram keyed by label values, in the Prometheus text format"""
+
+    def __init__(self, name, help_text, label_names, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            series[0][bisect_left(self.buckets, value)] += 1
+            series[1] += value
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for labels, (counts, total) in sorted(self._series.items()):
+                label_text = ','.join(f'{name}="{value}"' for name, value in zip(self.label_names, labels))
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), counts):
+                    cumulative += count
+                    lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {cumulative}')
+                lines.append(f'{self.name}_sum{{{label_text}}} {total}')
+                lines.append(f'{self.name}_count{{{label_text}}} {cumulative}')
+        return '\n'.join(lines)
+
+request_duration = Histogram('http_request_duration_seconds', "Time spent handling a request",
+                             ('route', 'method', 'status'), LATENCY_BUCKETS)
+phase_duration = Histogram('http_request_phase_seconds', "Time spent in each phase of a request",
+                           ('route', 'phase'), LATENCY_BUCKETS)
+query_count = Histogram('http_request_db_queries', "SQL statements executed per request",
+                        ('route',), QUERY_COUNT_BUCKETS)
+query_duration = Histogram('http_request_db_seconds', "Time spent executing SQL per request",
+                           ('route',), LATENCY_BUCKETS)
+HISTOGRAMS = (request_duration, phase_duration, query_count, query_duration)
+
+_request_counter = 0
+_counter_lock = threading.Lock()
+# Held while a sampled request is profiled; only one profiler can be active per process
+_profile_lock = threading.Lock()
+
+def render_metrics():
+    """Render every histogram in the Prometheus text exposition format"""
+    return '\n'.join(histogram.render() for histogram in HISTOGRAMS) + '\n'
+
+def mark_phase(name):
+    """Charge the time since the previous mark (or the start of the request) to a phase"""
+    timing = g.get('request_timing')
+    if timing is None:
+        return
+    now = time.perf_counter()
+    timing['phases'].append((name, now - timing['last_mark']))
+    timing['last_mark'] = now
+
+def _route():
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+def _start_request():
+    global _request_counter
+    now = time.perf_counter()
+    g.request_timing = {'start': now, 'last_mark': now, 'phases': [], 'queries': 0, 'query_seconds': 0.0}
+
+    # Profile every Nth request when enabled, skipping it while another request is being profiled
+    if config.PROFILE_EVERY_N_REQUESTS:
+        with _counter_lock:
+            _request_counter += 1
+            number = _request_counter
+        if number % config.PROFILE_EVERY_N_REQUESTS == 0 and _profile_lock.acquire(blocking=False):
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError as e:
+                # Another profiling tool is active in this process
+                _profile_lock.release()
+                logger.warning("Skipped profiling request %s: %s", number, e)
+                return
+            g.profile_number = number
+            g.profiler = profiler
+
+def _finish_request(response):
+    timing = g.pop('request_timing', None)
+    if timing is None:
+        return response
+    total = time.perf_counter() - timing['start']
+    route = _route()
+
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        _profile_lock.release()
+        _write_profile(profiler, route, g.pop('profile_number'))
+
+    request_duration.observe((route, request.method, str(response.status_code)), total)
+    for phase, seconds in timing['phases']:
+        phase_duration.observe((route, phase), seconds)
+    query_count.observe((route,), timing['queries'])
+    query_duration.observe((route,), timing['query_seconds'])
+
+    # A request running many statements usually means a query inside a loop
+    if timing['queries'] > config.REQUEST_QUERY_WARN_THRESHOLD:
+        logger.warning("%s %s ran %s SQL statements", request.method, route, timing['queries'])
+
+    entries = [f"{phase};dur={seconds * 1000:.3f}" for phase, seconds in timing['phases']]
+    entries.append(f'sql;desc="{timing["queries"]} queries";dur={timing["query_seconds"] * 1000:.3f}')
+    entries.append(f"total;dur={total * 1000:.3f}")
+    response.headers['Server-Timing'] = ', '.join(entries)
+    return response
+
+def _write_profile(profiler, route, number):
+    os.makedirs(config.PROFILE_DIR, exist_ok=True)
+    name = route.strip('/').replace('/', '_').replace('<', '').replace('>', '').replace(':', '-') or 'root'
+    path = os.path.join(config.PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}-{number}-{name}.prof")
+    profiler.dump_stats(path)
+    logger.info("Wrote request profile to %s", path)
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    start = conn.info['query_start'].pop()
+    if has_request_context():
+        timing = g.get('request_timing')
+        if timing is not None:
+            timing['queries'] += 1
+            timing['query_seconds'] += time.perf_counter() - start
+
+@event.listens_for(Engine, "handle_error")
+def _handle_error(context):
+    # A failed statement never reaches after_cursor_execute
+    if context.connection is not None and context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+def init_instrumentation(app):
+    """Time every request handled by the app"""
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
\ No newline at end of file
@@ -0,0 +1,131 @@
+import argparse
+import http.client
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from sqlalchemy import create_engine, insert
+from benchmark import synthetic_mortgages
+from models import db, Mortgage
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# How each serving mode is started; {port} is filled in per run
+SERVER_COMMANDS = {
+    'sync': [sys.executable, '-c', "from app import create_app; create_app().run(port={port}, threaded=True)"],
+    'asgi': [sys.executable, '-m', 'uvicorn', 'asgi:application', '--port', '{port}', '--log-level', 'warning']
+}
+
+def seed_database(database_url, rows):
+    """Create the tables and fill them with synthetic mortgages"""
+    engine = create_engine(database_url)
+    db.metadata.drop_all(engine)
+    db.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(insert(Mortgage.__table__), [{
+            'credit_score': m['creditScore'],
+            'loan_amount': m['loanAmount'],
+            'property_value': m['propertyValue'],
+            'annual_income': m['annualIncome'],
+            'debt_amount': m['debtAmount'],
+            'loan_type': m['loanType'],
+            'property_type': m['propertyType']
+        } for m in synthetic_mortgages(rows)])
+    engine.dispose()
+
+def start_server(mode, port, database_url, workdir):
+    """Start a server process and wait until it answers"""
+    command = [part.format(port=port) for part in SERVER_COMMANDS[mode]]
+    env = dict(os.environ, DATABASE_URL=database_url, PYTHONPATH=BACKEND_DIR)
+    # Run from a scratch directory so the servers' app.log does not land in the repo
+    process = subprocess.Popen(command, cwd=workdir, env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    deadline = time.monotonic() + 30
+    while time.monotonic() < deadline:
+        try:
+            connection = http.client.HTTPConnection('127.0.0.1', port, timeout=1)
+            connection.request('GET', '/api/mortgages/1')
+            connection.getresponse().read()
+            return process
+        except OSError:
+            time.sleep(0.2)
+    process.kill()
+    raise RuntimeError(f"{mode} server did not start on port {port}")
+
+def run_load(port, rows, concurrency, duration):
+    """Hit the read endpoints from many keep-alive clients and collect latencies"""
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(seed):
+        rng = random.Random(seed)
+        connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        local_latencies = []
+        local_errors = 0
+        while time.monotonic() < deadline:
+            if rng.random() < 0.8:
+                path = f'/api/mortgages/{rng.randint(1, rows)}'
+            else:
+                path = f'/api/mortgages?limit=50&after_id={rng.randint(0, rows)}'
+            start = time.perf_counter()
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                response.read()
+                if response.status != 200:
+                    local_errors += 1
+            except (OSError, http.client.HTTPException):
+                local_errors += 1
+                connection.close()
+                connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+            local_latencies.append(time.perf_counter() - start)
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), errors[0]
+
+def percentile(sorted_values, fraction):
+    """Return a percentile from an already sorted list"""
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the sync Flask server with the ASGI server under load")
+    parser.add_argument('--database-url', help="database to test against (default: a scratch SQLite file)")
+    parser.add_argument('--rows', type=int, default=10000, help="synthetic mortgages to seed")
+    parser.add_argument('--concurrency', type=int, default=32, help="concurrent client connections")
+    parser.add_argument('--duration', type=float, default=10, help="seconds of load per server")
+    parser.add_argument('--modes', default='sync,asgi', help="comma-separated servers to test")
+    parser.add_argument('--port', type=int, default=5055)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as workdir:
+        database_url = args.database_url or f"sqlite:///{os.path.join(workdir, 'loadtest.db')}"
+        seed_database(database_url, args.rows)
+
+        print(f"{'mode':<6} {'requests':>9} {'req/s':>9} {'p50 ms':>8} {'p99 ms':>8} {'errors':>7}")
+        for mode in args.modes.split(','):
+            process = start_server(mode, args.port, database_url, workdir)
+            try:
+                latencies, errors = run_load(args.port, args.rows, args.concurrency, args.duration)
+            finally:
+                process.terminate()
+                process.wait()
+            print(f"{mode:<6} {len(latencies):>9} {len(latencies) / args.duration:>9.0f} "
+                  f"{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.99) * 1000:>8.1f} {errors:>7}")
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
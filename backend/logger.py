@@ -1,7 +1,64 @@
+import atexit
 import logging
 import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
 from Config import LOG_LEVEL, LOG_FORMAT, LOG_FILE
 
+# One queue and one background writer shared by every module logger, so file
+# and console I/O happen off the request path
+_log_queue = queue.SimpleQueue()
+_listener = None
+_listener_lock = threading.Lock()
+
+def _start_listener(log_level):
+    """Start the background thread that writes queued records to the file and console"""
+    global _listener
+    
+    # Create formatter
+    formatter = logging.Formatter(LOG_FORMAT)
+    
+    # Create file handler; the file is only opened when the first record is written
+    file_handler = logging.FileHandler(LOG_FILE, delay=True)
+    file_handler.setLevel(log_level)
+    file_handler.setFormatter(formatter)
+    
+    # Create console handler
+    console_handler = logging.StreamHandler()
+    console_handler.setLevel(log_level)
+    console_handler.setFormatter(formatter)
+    
+    _listener = QueueListener(_log_queue, file_handler, console_handler, respect_handler_level=True)
+    _listener.start()
+    # Flush whatever is still queued when the process exits
+    atexit.register(stop_logging)
+
+class _LazyQueueHandler(QueueHandler):
+    """Queue handler that starts the background writer when the first record arrives.
+
+    Importing a module that sets up a logger therefore opens no files and
+    starts no threads; a process that never logs never pays for either.
+    """
+
+    def __init__(self, log_level):
+        super().__init__(_log_queue)
+        self.log_level = log_level
+
+    def enqueue(self, record):
+        if _listener is None:
+            with _listener_lock:
+                if _listener is None:
+                    _start_listener(self.log_level)
+        super().enqueue(record)
+
+def stop_logging():
+    """Stop the background writer after it has drained the queue"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
 def setup_logger(name):
     """Set up and return a logger with the given name"""
     # Convert string log level to logging constant
@@ -13,21 +70,7 @@ def setup_logger(name):
     
     # Check if logger already has handlers to avoid duplicates
     if not logger.handlers:
-        # Create formatter
-        formatter = logging.Formatter(LOG_FORMAT)
-        
-        # Create file handler
-        file_handler = logging.FileHandler(LOG_FILE)
-        file_handler.setLevel(log_level)
-        file_handler.setFormatter(formatter)
-        
-        # Create console handler
-        console_handler = logging.StreamHandler()
-        console_handler.setLevel(log_level)
-        console_handler.setFormatter(formatter)
-        
-        # Add handlers to logger
-        logger.addHandler(file_handler)
-        logger.addHandler(console_handler)
+        # Records are only enqueued here; the listener thread formats and writes them
+        logger.addHandler(_LazyQueueHandler(log_level))
     
     return logger
\ No newline at end of file
@@ -1,19 +1,32 @@
 from flask_sqlalchemy import SQLAlchemy
 from datetime import datetime
+from db_routing import RoutingSession
 
-db = SQLAlchemy()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
 class Mortgage(db.Model):
     __tablename__ = "mortgages"
+    __table_args__ = (
+        # Serves rating filters with keyset pagination: WHERE credit_rating = ? AND id > ? ORDER BY id
+        db.Index('ix_mortgages_credit_rating_id', 'credit_rating', 'id'),
+        # Covering indexes for GET /api/portfolio/stats, so each aggregate scans a narrow index instead of the table
+        db.Index('ix_mortgages_credit_score', 'credit_score'),
+        db.Index('ix_mortgages_loan_type_property_type', 'loan_type', 'property_type'),
+        db.Index('ix_mortgages_ltv_inputs', 'property_value', 'loan_amount'),
+        db.Index('ix_mortgages_dti_inputs', 'annual_income', 'debt_amount'),
+    )
     
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
-    credit_score = db.Column(db.Integer, nullable=False)
+    # active_history keeps the old score available to the portfolio aggregate on update
+    credit_score = db.column_property(db.Column(db.Integer, nullable=False), active_history=True)
     loan_amount = db.Column(db.Float, nullable=False)
     property_value = db.Column(db.Float, nullable=False)
     annual_income = db.Column(db.Float, nullable=False)
     debt_amount = db.Column(db.Float, nullable=False)
     loan_type = db.Column(db.String(10), nullable=False)  # 'fixed' or 'adjustable'
     property_type = db.Column(db.String(20), nullable=False)  # 'single_family' or 'condo'
+    risk_score = db.Column(db.Integer, nullable=True)  # NULL until rated or backfilled
+    credit_rating = db.Column(db.String(3), nullable=True)  # 'AAA', 'BBB' or 'C'
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     
     def to_dict(self):
@@ -27,5 +40,58 @@ class Mortgage(db.Model):
             'debtAmount': self.debt_amount,
             'loanType': self.loan_type,
             'propertyType': self.property_type,
+            'riskScore': self.risk_score,
+            'creditRating': self.credit_rating,
+            'createdAt': self.created_at.isoformat()
+        }
+
+class PortfolioAggregate(db.Model):
+    __tablename__ = "portfolio_aggregate"
+    
+    # Single-row table holding the running totals used for the average credit score
+    id = db.Column(db.Integer, primary_key=True)
+    credit_score_sum = db.Column(db.BigInteger, nullable=False, default=0)
+    mortgage_count = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+class IdempotencyKey(db.Model):
+    __tablename__ = "idempotency_keys"
+    __table_args__ = (
+        # Lets expired keys be purged without scanning the table
+        db.Index('ix_idempotency_keys_expires_at', 'expires_at'),
+    )
+    
+    # The primary key is the unique constraint that settles concurrent duplicates
+    key = db.Column(db.String(255), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)  # Method, path and body of the original request
+    status_code = db.Column(db.Integer, nullable=False)
+    response_body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False)
+
+class MortgageRatingHistory(db.Model):
+    __tablename__ = "mortgage_rating_history"
+    __table_args__ = (
+        # One loan's history in time order, and its latest entry as of a point in time
+        db.Index('ix_mortgage_rating_history_mortgage_id_created_at', 'mortgage_id', 'created_at'),
+        # Entries written in a time range
+        db.Index('ix_mortgage_rating_history_created_at', 'created_at'),
+    )
+    
+    # Append-only: rows are never updated, and outlive the mortgage they describe
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    mortgage_id = db.Column(db.Integer, nullable=False)
+    event = db.Column(db.String(10), nullable=False)  # 'created', 'updated', 'rated' or 'deleted'
+    risk_score = db.Column(db.Integer, nullable=True)
+    credit_rating = db.Column(db.String(3), nullable=True)  # NULL while pending and after deletion
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    def to_dict(self):
+        """Convert a history entry to a dictionary"""
+        return {
+            'mortgageId': self.mortgage_id,
+            'event': self.event,
+            'riskScore': self.risk_score,
+            'creditRating': self.credit_rating,
             'createdAt': self.created_at.isoformat()
         }
\ No newline at end of file
@@ -0,0 +1,117 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+class LRUTTLBackend:
+    """In-process storage for the mortgage cache: least recently used entries are
+    evicted past max_size and entries older than ttl seconds are treated as missing.
+
+    Any object with the same get/set/delete/clear/__len__ methods can be plugged
+    into MortgageCache instead, e.g. one backed by a shared cache server.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.expirations = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            self.expirations += 1
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def delete(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class MortgageCache:
+    """Read-through cache of serialized mortgages, keyed on mortgage ID.
+
+    Entries are (JSON body bytes, ETag). Writers call invalidate() after
+    committing; a read that started before an invalidation does not store its
+    result, so a slow reader cannot put a pre-write body back into the cache.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return (entry or None, token); pass the token to set() after a miss"""
+        with self._lock:
+            entry = self.backend.get(key)
+            if entry is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return entry, self.invalidations
+
+    def set(self, key, body, token):
+        """Cache a serialized body and return its (body, ETag) entry"""
+        entry = (body, make_etag(body))
+        with self._lock:
+            if token == self.invalidations:
+                self.backend.set(key, entry)
+        return entry
+
+    def invalidate(self, key):
+        """Drop one mortgage after it was updated or deleted"""
+        with self._lock:
+            self.backend.delete(key)
+            self.invalidations += 1
+
+    def clear(self):
+        """Drop every cached mortgage"""
+        with self._lock:
+            self.backend.clear()
+            self.invalidations += 1
+        logger.info("Cleared mortgage cache")
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "expirations": getattr(self.backend, 'expirations', None),
+                "size": len(self.backend),
+                "maxSize": getattr(self.backend, 'max_size', None),
+                "ttlSeconds": getattr(self.backend, 'ttl', None)
+            }
+
+def make_etag(body):
+    """Strong ETag for a serialized body"""
+    return hashlib.blake2b(body, digest_size=16).hexdigest()
+
+mortgage_cache = MortgageCache(LRUTTLBackend(config.MORTGAGE_CACHE_SIZE, config.MORTGAGE_CACHE_TTL))
\ No newline at end of file
@@ -0,0 +1,229 @@
+"""Columnar export and import of the mortgages table.
+
+Exports read the table through a server-side cursor in EXPORT_BATCH_SIZE
+partitions and encode each partition as it arrives, so memory stays flat
+however large the book is. CSV needs only the standard library; Arrow IPC
+and Parquet need pyarrow. Imports insert each file batch with a single
+executemany in its own transaction, bypassing the ORM.
+
+Files use the table's own column names. Imports let the database assign IDs
+unless asked to keep the file's, which restores an export into an empty table.
+"""
+import csv
+import io
+from datetime import datetime
+from sqlalchemy import select
+from models import db, Mortgage
+from rating_history import insert_returning, record_ratings
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+mortgage_table = Mortgage.__table__
+EXPORT_COLUMNS = [column.name for column in mortgage_table.columns]
+
+# Type of each exported column, for parsing CSV and building Arrow schemas
+COLUMN_TYPES = {
+    'id': int,
+    'credit_score': int,
+    'loan_amount': float,
+    'property_value': float,
+    'annual_income': float,
+    'debt_amount': float,
+    'loan_type': str,
+    'property_type': str,
+    'risk_score': int,
+    'credit_rating': str,
+    'created_at': datetime
+}
+
+EXPORT_FORMATS = {
+    'csv': ('text/csv', 'csv'),
+    'arrow': ('application/vnd.apache.arrow.stream', 'arrows'),
+    'parquet': ('application/vnd.apache.parquet', 'parquet')
+}
+
+def _require_pyarrow(file_format):
+    """Import pyarrow, which only the Arrow and Parquet formats need"""
+    try:
+        import pyarrow
+    except ImportError:
+        raise ValueError(f"The {file_format} format requires pyarrow to be installed")
+    return pyarrow
+
+def arrow_schema():
+    """Arrow schema matching the mortgages table"""
+    pa = _require_pyarrow('arrow')
+    arrow_types = {int: pa.int64(), float: pa.float64(), str: pa.string(), datetime: pa.timestamp('us')}
+    return pa.schema([(name, arrow_types[COLUMN_TYPES[name]]) for name in EXPORT_COLUMNS])
+
+def export_partitions(session=None, batch_size=None):
+    """Yield lists of table rows in ID order, read through a server-side cursor"""
+    session = session or db.session
+    batch_size = batch_size or config.EXPORT_BATCH_SIZE
+    result = session.execute(
+        select(mortgage_table).order_by(mortgage_table.c.id).execution_options(yield_per=batch_size)
+    )
+    count = 0
+    for partition in result.partitions():
+        count += len(partition)
+        yield partition
+    logger.info("Exported %s mortgages", count)
+
+class _ChunkSink(io.RawIOBase):
+    """Write-only file that hands back whatever was written since the last drain"""
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+def _csv_stream(partitions):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(EXPORT_COLUMNS)
+    for partition in partitions:
+        writer.writerows(
+            [value.isoformat() if isinstance(value, datetime) else value for value in row] for row in partition
+        )
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    yield buffer.getvalue().encode()
+
+def _record_batch(schema, partition):
+    pa = _require_pyarrow('arrow')
+    columns = zip(*partition) if partition else [[] for _ in schema]
+    return pa.RecordBatch.from_arrays(
+        [pa.array(values, type=field.type) for values, field in zip(columns, schema)], schema=schema
+    )
+
+def _arrow_stream(partitions):
+    pa = _require_pyarrow('arrow')
+    schema = arrow_schema()
+    sink = _ChunkSink()
+    with pa.ipc.new_stream(sink, schema) as writer:
+        for partition in partitions:
+            writer.write_batch(_record_batch(schema, partition))
+            yield sink.drain()
+    yield sink.drain()
+
+def _parquet_stream(partitions):
+    _require_pyarrow('parquet')
+    import pyarrow.parquet as pq
+    schema = arrow_schema()
+    sink = _ChunkSink()
+    # Each partition becomes one row group; the footer is written on close
+    with pq.ParquetWriter(sink, schema, compression='zstd') as writer:
+        for partition in partitions:
+            writer.write_batch(_record_batch(schema, partition))
+            yield sink.drain()
+    yield sink.drain()
+
+def export_stream(file_format, partitions):
+    """Encode row partitions in the given format, yielding bytes chunk by chunk"""
+    if file_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown export format: {file_format}")
+    if file_format != 'csv':
+        _require_pyarrow(file_format)
+    return {'csv': _csv_stream, 'arrow': _arrow_stream, 'parquet': _parquet_stream}[file_format](partitions)
+
+def _parse_csv_value(name, value):
+    if value == '':
+        return None
+    column_type = COLUMN_TYPES[name]
+    if column_type is datetime:
+        return datetime.fromisoformat(value)
+    if column_type is int:
+        return int(float(value))
+    return column_type(value)
+
+def _csv_batches(file, batch_size):
+    reader = csv.DictReader(io.TextIOWrapper(file, encoding='utf-8', newline=''))
+    unknown = set(reader.fieldnames or []) - set(COLUMN_TYPES)
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(sorted(unknown))}")
+    batch = []
+    for row in reader:
+        batch.append({name: _parse_csv_value(name, value) for name, value in row.items()})
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _parquet_batches(file, batch_size):
+    _require_pyarrow('parquet')
+    import pyarrow.parquet as pq
+    parquet_file = pq.ParquetFile(file)
+    unknown = set(parquet_file.schema_arrow.names) - set(COLUMN_TYPES)
+    if unknown:
+        raise ValueError(f"Unknown columns: {', '.join(sorted(unknown))}")
+    for batch in parquet_file.iter_batches(batch_size=batch_size):
+        yield batch.to_pylist()
+
+# Columns the rating history needs from each inserted mortgage
+INSERTED_COLUMNS = (mortgage_table.c.id, mortgage_table.c.risk_score, mortgage_table.c.credit_rating)
+
+def insert_mortgages(session, rows):
+    """Insert mortgage rows with one executemany and give each a 'created' rating history entry.
+
+    Rows are dicts keyed by column name. Runs in the caller's transaction.
+    Returns the ID, risk score and credit rating of each inserted row.
+    """
+    inserted = insert_returning(session, mortgage_table, rows, INSERTED_COLUMNS)
+    record_ratings(session, inserted, 'created')
+    return inserted
+
+def import_batches(file, file_format, session=None, batch_size=None, keep_ids=False):
+    """Insert every row of a CSV or Parquet file, yielding the running row count after each batch commits.
+
+    Each batch is one executemany and one transaction, so when a batch fails
+    the batches before it stay imported; the session is rolled back and the
+    error raised, and the last count yielded is what was imported. Core
+    inserts bypass the portfolio aggregate and snapshot, so the caller
+    rebuilds them afterwards, whether or not the import finished. Rows
+    without a rating stay unrated until backfill_ratings runs. Every row gets
+    a 'created' rating history entry in its batch's transaction.
+    """
+    session = session or db.session
+    batch_size = batch_size or config.EXPORT_BATCH_SIZE
+    if file_format == 'csv':
+        batches = _csv_batches(file, batch_size)
+    elif file_format == 'parquet':
+        batches = _parquet_batches(file, batch_size)
+    else:
+        raise ValueError(f"Unknown import format: {file_format}")
+
+    imported = 0
+    try:
+        for batch in batches:
+            if not keep_ids:
+                for row in batch:
+                    row.pop('id', None)
+            insert_mortgages(session, batch)
+            session.commit()
+            imported += len(batch)
+            logger.info("Imported %s mortgages", imported)
+            yield imported
+    except Exception:
+        session.rollback()
+        logger.error("Import stopped after %s mortgages", imported)
+        raise
@@ -0,0 +1,365 @@
+import math
+import threading
+import time
+import numpy as np
+from sqlalchemy import case, event, func, inspect, select, update
+from sqlalchemy.exc import IntegrityError
+from models import db, Mortgage, PortfolioAggregate
+from credit_ratings import calculate_risk_scores_batch, calculate_credit_ratings_batch
+from portfolio_snapshot import portfolio_snapshot
+from rating_history import record_ratings
+from rules import get_rules
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+# The aggregate table only ever holds this one row
+AGGREGATE_ID = 1
+
+aggregate_table = PortfolioAggregate.__table__
+
+def _table_totals(connection):
+    """Scan the mortgages table for the credit score sum and count"""
+    credit_score_sum, mortgage_count = connection.execute(
+        select(func.coalesce(func.sum(Mortgage.credit_score), 0), func.count(Mortgage.id))
+    ).one()
+    return int(credit_score_sum), mortgage_count
+
+def _stored_totals(connection):
+    row = connection.execute(
+        select(aggregate_table.c.credit_score_sum, aggregate_table.c.mortgage_count)
+        .where(aggregate_table.c.id == AGGREGATE_ID)
+    ).first()
+    return None if row is None else (int(row[0]), row[1])
+
+def rebuild_portfolio_aggregate(session=None):
+    """Recompute the credit score sum and count from the mortgages table"""
+    session = session or db.session
+
+    credit_score_sum, mortgage_count = _table_totals(session)
+
+    result = session.execute(
+        update(aggregate_table)
+        .where(aggregate_table.c.id == AGGREGATE_ID)
+        .values(credit_score_sum=credit_score_sum, mortgage_count=mortgage_count)
+    )
+    if result.rowcount == 0:
+        session.execute(
+            aggregate_table.insert().values(
+                id=AGGREGATE_ID, credit_score_sum=credit_score_sum, mortgage_count=mortgage_count
+            )
+        )
+
+    logger.info("Rebuilt portfolio aggregate: sum=%s, count=%s", credit_score_sum, mortgage_count)
+    return credit_score_sum, mortgage_count
+
+def create_portfolio_aggregate(engine=None):
+    """Insert the aggregate row, computed from the mortgages table, if it is missing.
+
+    Runs in its own committed transaction, so the table is scanned once
+    rather than by every read until the next write. Called at startup, and
+    by the first read that finds the row missing. Returns the stored totals.
+    """
+    engine = engine or db.engine
+    try:
+        with engine.begin() as connection:
+            totals = _stored_totals(connection)
+            if totals is None:
+                totals = _table_totals(connection)
+                connection.execute(aggregate_table.insert().values(
+                    id=AGGREGATE_ID, credit_score_sum=totals[0], mortgage_count=totals[1]
+                ))
+                logger.info("Created portfolio aggregate: sum=%s, count=%s", *totals)
+            return totals
+    except IntegrityError:
+        # Another process created the row first
+        with engine.connect() as connection:
+            return _stored_totals(connection)
+
+def apply_portfolio_delta(session, score_delta, count_delta):
+    """Add a change to the running totals within the caller's transaction.
+
+    Must be called before the matching mortgage rows are written, so that a
+    missing aggregate row is rebuilt from the table without them.
+    """
+    if score_delta == 0 and count_delta == 0:
+        return
+
+    increment = (
+        update(aggregate_table)
+        .where(aggregate_table.c.id == AGGREGATE_ID)
+        .values(
+            credit_score_sum=aggregate_table.c.credit_score_sum + score_delta,
+            mortgage_count=aggregate_table.c.mortgage_count + count_delta
+        )
+    )
+    if session.execute(increment).rowcount:
+        return
+
+    credit_score_sum, mortgage_count = _table_totals(session)
+    try:
+        # A savepoint, so losing the race to create the row leaves the caller's transaction usable
+        with session.begin_nested():
+            session.execute(aggregate_table.insert().values(
+                id=AGGREGATE_ID, credit_score_sum=credit_score_sum + score_delta,
+                mortgage_count=mortgage_count + count_delta
+            ))
+    except IntegrityError:
+        # A concurrent first write created the row; add to its totals instead
+        session.execute(increment)
+
+def get_portfolio_totals(session=None):
+    """Return the (credit score sum, mortgage count) pair, creating the aggregate row if missing"""
+    session = session or db.session
+    totals = _stored_totals(session)
+    if totals is None:
+        return create_portfolio_aggregate(session.get_bind(Mortgage))
+    return totals
+
+def get_average_credit_score(exclude_score=None, session=None):
+    """Return the portfolio average credit score, or None if there are no other mortgages"""
+    # The in-memory snapshot, when loaded, answers without a database round trip
+    if portfolio_snapshot.loaded and session is None:
+        credit_score_sum, mortgage_count = portfolio_snapshot.totals()
+    else:
+        credit_score_sum, mortgage_count = get_portfolio_totals(session)
+
+    # Leave out the mortgage being re-rated, as update_mortgage always has
+    if exclude_score is not None:
+        credit_score_sum -= exclude_score
+        mortgage_count -= 1
+
+    if mortgage_count <= 0:
+        return None
+    return credit_score_sum / mortgage_count
+
+# Columns needed to re-score a stored mortgage, in the order score_stored_rows expects
+SCORING_COLUMNS = (
+    Mortgage.id, Mortgage.credit_score, Mortgage.loan_amount, Mortgage.property_value,
+    Mortgage.annual_income, Mortgage.debt_amount, Mortgage.loan_type, Mortgage.property_type
+)
+
+def score_stored_rows(rows, credit_score_sum, mortgage_count, rules):
+    """Score rows selected with SCORING_COLUMNS and return bulk-update parameters.
+
+    Each loan is rated against the average of all other loans, matching what
+    update_mortgage stores.
+    """
+    ids, credit_scores, loan_amounts, property_values, annual_incomes, debt_amounts, \
+        loan_types, property_types = zip(*rows)
+    credit_scores = np.asarray(credit_scores, dtype=np.int64)
+
+    # Average of every other loan; a lone loan falls back to its own score
+    if mortgage_count > 1:
+        avg_credit_scores = (credit_score_sum - credit_scores) / (mortgage_count - 1)
+    else:
+        avg_credit_scores = credit_scores
+
+    scores = calculate_risk_scores_batch({
+        'creditScore': credit_scores,
+        'loanAmount': loan_amounts,
+        'propertyValue': property_values,
+        'annualIncome': annual_incomes,
+        'debtAmount': debt_amounts,
+        'loanType': loan_types,
+        'propertyType': property_types
+    }, avg_credit_scores, rules)
+    ratings = calculate_credit_ratings_batch(scores['total'], rules)
+
+    return [
+        {'id': mortgage_id, 'risk_score': risk_score, 'credit_rating': rating}
+        for mortgage_id, risk_score, rating in zip(ids, scores['total'].tolist(), ratings.tolist())
+    ]
+
+def backfill_ratings(chunk_size=5000, only_missing=True, session=None):
+    """Score stored mortgages in id-ordered chunks and write their ratings back in bulk.
+
+    Returns the number of mortgages updated.
+    """
+    session = session or db.session
+    credit_score_sum, mortgage_count = get_portfolio_totals(session)
+    # Score the whole run with one rule set even if the rule file changes meanwhile
+    rules = get_rules()
+
+    updated = 0
+    last_id = 0
+    while True:
+        query = select(*SCORING_COLUMNS).where(Mortgage.id > last_id).order_by(Mortgage.id).limit(chunk_size)
+        if only_missing:
+            query = query.where(Mortgage.credit_rating.is_(None))
+        rows = session.execute(query).all()
+        if not rows:
+            break
+
+        ratings = score_stored_rows(rows, credit_score_sum, mortgage_count, rules)
+        session.execute(update(Mortgage), ratings)
+        record_ratings(session, ratings, 'rated')
+        session.commit()
+
+        updated += len(rows)
+        last_id = rows[-1].id
+        logger.info("Backfilled ratings for %s mortgages (through ID %s)", updated, last_id)
+
+    return updated
+
+def rate_pending_mortgages(ids, session=None):
+    """Score the still-unrated mortgages among `ids`, store their ratings and commit.
+
+    Rows rated meanwhile by another worker or node are skipped. Returns the
+    update parameters written, one dict per rated mortgage.
+    """
+    session = session or db.session
+    rows = session.execute(
+        select(*SCORING_COLUMNS).where(Mortgage.id.in_(ids), Mortgage.credit_rating.is_(None))
+    ).all()
+    if not rows:
+        return []
+
+    credit_score_sum, mortgage_count = get_portfolio_totals(session)
+    ratings = score_stored_rows(rows, credit_score_sum, mortgage_count, get_rules())
+    session.execute(update(Mortgage), ratings)
+    record_ratings(session, ratings, 'rated')
+    session.commit()
+    return ratings
+
+# Credit score percentiles reported by portfolio_stats
+STATS_PERCENTILES = (10, 25, 50, 75, 90, 95, 99)
+
+def _credit_score_stats(session):
+    """Count, average, range and percentiles of credit score from a GROUP BY credit_score histogram"""
+    histogram = session.execute(
+        select(Mortgage.credit_score, func.count()).group_by(Mortgage.credit_score).order_by(Mortgage.credit_score)
+    ).all()
+    count = sum(n for _, n in histogram)
+    if not count:
+        return {"count": 0, "average": None, "min": None, "max": None,
+                "percentiles": {f"p{p}": None for p in STATS_PERCENTILES}}
+
+    # Nearest-rank percentiles: the smallest score with at least p% of loans at or below it
+    percentiles = {}
+    ranks = iter((p, math.ceil(p / 100 * count)) for p in STATS_PERCENTILES)
+    p, rank = next(ranks)
+    seen = 0
+    for score, n in histogram:
+        seen += n
+        while rank is not None and seen >= rank:
+            percentiles[f"p{p}"] = score
+            p, rank = next(ranks, (None, None))
+
+    return {
+        "count": count,
+        "average": sum(score * n for score, n in histogram) / count,
+        "min": histogram[0][0],
+        "max": histogram[-1][0],
+        "percentiles": percentiles
+    }
+
+def _ratio_distribution(session, rule, numerator, denominator):
+    """Count loans per band of a ratio rule, matching how scoring bands them.
+
+    One pass over the table: a conditional count of loans above each
+    breakpoint, differenced into per-band counts. Cheaper than GROUP BY on a
+    CASE expression, which needs a temporary sort.
+    """
+    ratio = numerator / denominator * 100
+    above = [ratio > breakpoint if rule.side == 'left' else ratio >= breakpoint for breakpoint in rule.breakpoints]
+    counts = session.execute(select(
+        func.count(),
+        func.coalesce(func.sum(case((denominator == 0, 1), else_=0)), 0),
+        *[func.coalesce(func.sum(case((denominator != 0, case((condition, 1), else_=0)), else_=0)), 0)
+          for condition in above]
+    )).one()
+    total, zero_denominator, above_counts = counts[0], int(counts[1]), [int(n) for n in counts[2:]]
+
+    # Loans above breakpoint i, minus those above breakpoint i + 1, are in band i + 1
+    cumulative = [total - zero_denominator] + above_counts + [0]
+    bounds = [None] + rule.breakpoints + [None]
+    return {
+        "buckets": [
+            {"min": bounds[index], "max": bounds[index + 1], "score": rule.outcomes[index],
+             "count": cumulative[index] - cumulative[index + 1]}
+            for index in range(len(rule.outcomes))
+        ],
+        "zeroDenominator": zero_denominator
+    }
+
+def portfolio_stats(session=None, rules=None):
+    """Summarise the portfolio with SQL aggregates: credit score statistics, LTV and DTI
+    distributions over the scoring rule bands, and counts by type and rating
+    """
+    session = session or db.session
+    rules = rules or get_rules()
+
+    by_loan_type = {}
+    by_property_type = {}
+    type_counts = session.execute(
+        select(Mortgage.loan_type, Mortgage.property_type, func.count())
+        .group_by(Mortgage.loan_type, Mortgage.property_type)
+    ).all()
+    for loan_type, property_type, n in type_counts:
+        by_loan_type[loan_type] = by_loan_type.get(loan_type, 0) + n
+        by_property_type[property_type] = by_property_type.get(property_type, 0) + n
+
+    rating_counts = session.execute(
+        select(Mortgage.credit_rating, func.count()).group_by(Mortgage.credit_rating)
+    ).all()
+
+    return {
+        "creditScore": _credit_score_stats(session),
+        "loanToValue": _ratio_distribution(session, rules.loan_to_value, Mortgage.loan_amount, Mortgage.property_value),
+        "debtToIncome": _ratio_distribution(session, rules.debt_to_income, Mortgage.debt_amount, Mortgage.annual_income),
+        "byLoanType": by_loan_type,
+        "byPropertyType": by_property_type,
+        "byCreditRating": {rating or "unrated": n for rating, n in rating_counts},
+        "ruleSetVersion": rules.version
+    }
+
+_stats = None
+_stats_computed_at = 0.0
+_stats_lock = threading.Lock()
+
+def cached_portfolio_stats():
+    """Return portfolio_stats, recomputed at most once per PORTFOLIO_STATS_TTL seconds.
+
+    Concurrent requests after expiry wait for a single recomputation rather
+    than each scanning the table.
+    """
+    global _stats, _stats_computed_at
+    with _stats_lock:
+        now = time.monotonic()
+        if _stats is None or now - _stats_computed_at >= config.PORTFOLIO_STATS_TTL:
+            _stats = portfolio_stats()
+            _stats_computed_at = now
+        return _stats
+
+def _committed_credit_score(mortgage):
+    """Return the credit score currently stored in the database for a mortgage"""
+    history = inspect(mortgage).attrs.credit_score.history
+    if history.deleted:
+        return int(history.deleted[0])
+    return int(mortgage.credit_score)
+
+@event.listens_for(db.session, "before_flush")
+def _track_mortgage_changes(session, flush_context, instances):
+    """Keep the portfolio aggregate in step with every ORM insert, update and delete"""
+    score_delta = 0
+    count_delta = 0
+
+    for obj in session.new:
+        if isinstance(obj, Mortgage):
+            score_delta += int(obj.credit_score)
+            count_delta += 1
+
+    for obj in session.deleted:
+        if isinstance(obj, Mortgage):
+            score_delta -= _committed_credit_score(obj)
+            count_delta -= 1
+
+    for obj in session.dirty:
+        if isinstance(obj, Mortgage) and obj not in session.deleted:
+            if inspect(obj).attrs.credit_score.history.has_changes():
+                score_delta += int(obj.credit_score) - _committed_credit_score(obj)
+
+    apply_portfolio_delta(session, score_delta, count_delta)
\ No newline at end of file
@@ -0,0 +1,297 @@
+import threading
+import numpy as np
+from sqlalchemy import event, select
+from models import db, Mortgage
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+# Columns held in memory, in the order rows are passed to PortfolioSnapshot
+SNAPSHOT_COLUMNS = (
+    Mortgage.id, Mortgage.credit_score, Mortgage.loan_amount, Mortgage.property_value,
+    Mortgage.annual_income, Mortgage.debt_amount, Mortgage.loan_type, Mortgage.property_type
+)
+
+# Typed array per numeric column; loan and property types are stored as codes into interned tables
+NUMERIC_DTYPES = (
+    ('id', np.int64),
+    ('credit_score', np.int16),
+    ('loan_amount', np.float64),
+    ('property_value', np.float64),
+    ('annual_income', np.float64),
+    ('debt_amount', np.float64)
+)
+CODE_DTYPE = np.uint16
+
+class CategoryTable:
+    """Interns category strings as small integer codes"""
+
+    def __init__(self):
+        self.values = []
+        self.codes = {}
+
+    def code(self, value):
+        """Return the code for a value, adding it to the table if it is new"""
+        code = self.codes.get(value)
+        if code is None:
+            code = self.codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def encode(self, values):
+        """Return codes for a sequence of values"""
+        uniques, inverse = np.unique(np.asarray(values, dtype=object), return_inverse=True)
+        return np.asarray([self.code(value) for value in uniques], dtype=CODE_DTYPE)[inverse]
+
+    def decode(self, codes):
+        """Return the values for an array of codes"""
+        return np.asarray(self.values, dtype=object)[codes]
+
+class PortfolioSnapshot:
+    """The scoring inputs of every stored mortgage, held as typed NumPy columns.
+
+    Rows are kept in ID order so a mortgage can be found with a binary search.
+    Deletes only clear a row's `alive` flag; the columns are compacted once
+    enough rows are dead. The credit score sum and count are maintained
+    alongside, so the portfolio average needs no database round trip.
+
+    Changes committed through this process's session are applied
+    automatically; writes from other processes are only seen after reload().
+    """
+
+    def __init__(self):
+        self.loaded = False
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self.loan_types = CategoryTable()
+        self.property_types = CategoryTable()
+        self._size = 0
+        self._dead = 0
+        self._credit_score_sum = 0
+        self._columns = {name: np.empty(0, dtype=dtype) for name, dtype in NUMERIC_DTYPES}
+        self._columns['loan_type'] = np.empty(0, dtype=CODE_DTYPE)
+        self._columns['property_type'] = np.empty(0, dtype=CODE_DTYPE)
+        self._columns['alive'] = np.empty(0, dtype=bool)
+
+    def load(self, session=None, chunk_size=None):
+        """Read every mortgage's scoring inputs in one id-ordered, columnar pass"""
+        session = session or db.session
+        chunk_size = chunk_size or config.STREAM_BATCH_SIZE
+        with self._lock:
+            self._reset()
+            result = session.execute(
+                select(*SNAPSHOT_COLUMNS).order_by(Mortgage.id).execution_options(yield_per=chunk_size)
+            )
+            for partition in result.partitions():
+                self._append_rows(partition)
+            self.loaded = True
+        logger.info("Loaded portfolio snapshot of %s mortgages (%s bytes)", self._size, self.memory_bytes())
+
+    def unload(self):
+        """Drop the snapshot; scoring falls back to the database aggregate"""
+        with self._lock:
+            self.loaded = False
+            self._reset()
+
+    def reload(self, session=None):
+        """Re-read the snapshot from the database"""
+        self.load(session)
+
+    def _reserve(self, extra):
+        """Grow the columns so `extra` more rows fit, doubling to keep appends amortised"""
+        capacity = len(self._columns['id'])
+        if self._size + extra <= capacity:
+            return
+        new_capacity = max(self._size + extra, capacity * 2, 1024)
+        for name, column in self._columns.items():
+            grown = np.empty(new_capacity, dtype=column.dtype)
+            grown[:self._size] = column[:self._size]
+            self._columns[name] = grown
+
+    def _append_rows(self, rows):
+        """Append rows of SNAPSHOT_COLUMNS with IDs above every stored ID"""
+        if not rows:
+            return
+        ids, credit_scores, loan_amounts, property_values, annual_incomes, debt_amounts, \
+            loan_types, property_types = zip(*rows)
+        self._reserve(len(rows))
+        start, stop = self._size, self._size + len(rows)
+        columns = self._columns
+        columns['id'][start:stop] = ids
+        columns['credit_score'][start:stop] = credit_scores
+        columns['loan_amount'][start:stop] = loan_amounts
+        columns['property_value'][start:stop] = property_values
+        columns['annual_income'][start:stop] = annual_incomes
+        columns['debt_amount'][start:stop] = debt_amounts
+        columns['loan_type'][start:stop] = self.loan_types.encode(loan_types)
+        columns['property_type'][start:stop] = self.property_types.encode(property_types)
+        columns['alive'][start:stop] = True
+        self._size = stop
+        self._credit_score_sum += sum(credit_scores)
+
+    def _position(self, mortgage_id):
+        """Return the row index holding an ID, or None"""
+        ids = self._columns['id'][:self._size]
+        index = int(np.searchsorted(ids, mortgage_id))
+        if index < self._size and ids[index] == mortgage_id:
+            return index
+        return None
+
+    def _upsert(self, row):
+        """Insert or overwrite one row of SNAPSHOT_COLUMNS"""
+        mortgage_id = row[0]
+        index = self._position(mortgage_id)
+        if index is None and (self._size == 0 or mortgage_id > self._columns['id'][self._size - 1]):
+            self._append_rows([row])
+            return
+        if index is None:
+            # An ID below the current maximum, committed late; keep the columns sorted
+            index = int(np.searchsorted(self._columns['id'][:self._size], mortgage_id))
+            self._reserve(1)
+            for column in self._columns.values():
+                column[index + 1:self._size + 1] = column[index:self._size]
+            self._size += 1
+            self._columns['alive'][index] = False
+            self._dead += 1
+
+        columns = self._columns
+        if columns['alive'][index]:
+            self._credit_score_sum -= int(columns['credit_score'][index])
+        else:
+            self._dead -= 1
+        columns['id'][index] = mortgage_id
+        columns['credit_score'][index] = row[1]
+        columns['loan_amount'][index] = row[2]
+        columns['property_value'][index] = row[3]
+        columns['annual_income'][index] = row[4]
+        columns['debt_amount'][index] = row[5]
+        columns['loan_type'][index] = self.loan_types.code(row[6])
+        columns['property_type'][index] = self.property_types.code(row[7])
+        columns['alive'][index] = True
+        self._credit_score_sum += int(row[1])
+
+    def _remove(self, mortgage_id):
+        """Mark one mortgage as deleted"""
+        index = self._position(mortgage_id)
+        if index is None or not self._columns['alive'][index]:
+            return
+        self._columns['alive'][index] = False
+        self._credit_score_sum -= int(self._columns['credit_score'][index])
+        self._dead += 1
+        # Drop dead rows once they make up a quarter of the columns
+        if self._dead * 4 > self._size:
+            alive = self._columns['alive'][:self._size].copy()
+            for name, column in self._columns.items():
+                self._columns[name] = column[:self._size][alive]
+            self._size = len(self._columns['id'])
+            self._dead = 0
+
+    def apply(self, changes):
+        """Apply committed (upserts, deleted IDs) to the snapshot"""
+        upserts, deletes = changes
+        with self._lock:
+            for row in upserts:
+                self._upsert(row)
+            for mortgage_id in deletes:
+                self._remove(mortgage_id)
+
+    def sync_rows(self, ids, session=None):
+        """Read the given mortgages into the snapshot, e.g. after a Core bulk insert.
+
+        Takes the inserted IDs rather than reading above the highest stored ID:
+        a concurrent create with a higher ID may already have been applied.
+        """
+        if not ids:
+            return 0
+        session = session or db.session
+        with self._lock:
+            rows = session.execute(
+                select(*SNAPSHOT_COLUMNS).where(Mortgage.id.in_(ids)).order_by(Mortgage.id)
+            ).all()
+            if rows and (self._size == 0 or rows[0].id > self._columns['id'][self._size - 1]):
+                self._append_rows(rows)
+            else:
+                for row in rows:
+                    self._upsert(row)
+        return len(rows)
+
+    def totals(self):
+        """Return (credit score sum, mortgage count)"""
+        with self._lock:
+            return self._credit_score_sum, self._size - self._dead
+
+    def credit_score(self, mortgage_id):
+        """Return the stored credit score of a mortgage, or None"""
+        with self._lock:
+            index = self._position(mortgage_id)
+            if index is None or not self._columns['alive'][index]:
+                return None
+            return int(self._columns['credit_score'][index])
+
+    def scoring_columns(self):
+        """Return the live rows as a column dict accepted by calculate_risk_scores_batch"""
+        with self._lock:
+            alive = self._columns['alive'][:self._size]
+            columns = {name: self._columns[name][:self._size][alive] for name in self._columns}
+            return {
+                'id': columns['id'],
+                'creditScore': columns['credit_score'],
+                'loanAmount': columns['loan_amount'],
+                'propertyValue': columns['property_value'],
+                'annualIncome': columns['annual_income'],
+                'debtAmount': columns['debt_amount'],
+                'loanType': self.loan_types.decode(columns['loan_type']),
+                'propertyType': self.property_types.decode(columns['property_type'])
+            }
+
+    def memory_bytes(self):
+        """Bytes held by the columns, including spare capacity"""
+        return sum(column.nbytes for column in self._columns.values())
+
+    def stats(self):
+        """Report the snapshot's size and memory footprint"""
+        with self._lock:
+            count = self._size - self._dead
+            memory = self.memory_bytes()
+            return {
+                "loaded": self.loaded,
+                "count": count,
+                "capacity": len(self._columns['id']),
+                "memoryBytes": memory,
+                "bytesPerLoan": sum(column.dtype.itemsize for column in self._columns.values()),
+                "loanTypes": list(self.loan_types.values),
+                "propertyTypes": list(self.property_types.values)
+            }
+
+portfolio_snapshot = PortfolioSnapshot()
+
+def _snapshot_row(mortgage):
+    return (mortgage.id, mortgage.credit_score, mortgage.loan_amount, mortgage.property_value,
+            mortgage.annual_income, mortgage.debt_amount, mortgage.loan_type, mortgage.property_type)
+
+@event.listens_for(db.session, "after_flush")
+def _record_snapshot_changes(session, flush_context):
+    """Collect flushed mortgage changes; they reach the snapshot only if the transaction commits"""
+    if not portfolio_snapshot.loaded:
+        return
+    upserts, deletes = session.info.setdefault('snapshot_changes', ([], []))
+    for obj in session.deleted:
+        if isinstance(obj, Mortgage):
+            deletes.append(obj.id)
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, Mortgage) and obj not in session.deleted:
+            upserts.append(_snapshot_row(obj))
+
+@event.listens_for(db.session, "after_commit")
+def _apply_snapshot_changes(session):
+    changes = session.info.pop('snapshot_changes', None)
+    if changes and portfolio_snapshot.loaded:
+        portfolio_snapshot.apply(changes)
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_snapshot_changes(session):
+    session.info.pop('snapshot_changes', None)
\ No newline at end of file
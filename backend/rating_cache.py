@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+from credit_ratings import risk_bands, average_credit_band, calculate_risk_components, calculate_credit_rating
+from rules import get_rules
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+class RatingCache:
+    """Bounded LRU cache of rating results keyed on the rule bands of the inputs.
+
+    All entries are computed against one rule set and one portfolio-average
+    band; when the rules are reloaded or the average moves into a different
+    band the cache is cleared.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()
+        self._avg_band = None
+        self._rules = None
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, data, avg_credit_score, rules=None):
+        """Return (components, risk score, credit rating) for a payload, scoring it only on a miss"""
+        rules = rules or get_rules()
+        key = risk_bands(data, rules)
+        avg_band = average_credit_band(avg_credit_score, rules)
+
+        with self._lock:
+            if avg_band != self._avg_band or rules is not self._rules:
+                if self._entries:
+                    logger.info("Rule set %s / average credit band %s in effect, clearing %s cached ratings",
+                                rules.version, avg_band, len(self._entries))
+                    self.invalidations += 1
+                self._entries.clear()
+                self._avg_band = avg_band
+                self._rules = rules
+
+            result = self._entries.get(key)
+            if result is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return result
+            self.misses += 1
+
+        components, risk_score = calculate_risk_components(data, avg_credit_score, rules)
+        result = (components, risk_score, calculate_credit_rating(risk_score, rules))
+
+        with self._lock:
+            # Only keep the result if the rules and average band have not moved in the meantime
+            if avg_band == self._avg_band and rules is self._rules:
+                self._entries[key] = result
+                self._entries.move_to_end(key)
+                if len(self._entries) > self.max_size:
+                    self._entries.popitem(last=False)
+        return result
+
+    def clear(self):
+        """Drop every cached result"""
+        with self._lock:
+            self._entries.clear()
+            self.invalidations += 1
+
+    def stats(self):
+        """Return hit/miss counters and current size"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations,
+                "size": len(self._entries),
+                "maxSize": self.max_size
+            }
+
+rating_cache = RatingCache(config.RATING_CACHE_SIZE)
\ No newline at end of file
@@ -0,0 +1,69 @@
+import numpy as np
+from credit_ratings import calculate_risk_scores_batch, calculate_credit_ratings_batch
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+# Grid axes in response order; the property value of a cell is its loan amount plus its down payment
+GRID_AXES = ('loanAmount', 'downPayment', 'debtAmount')
+
+def _axis_values(name, spec):
+    """Turn {"min", "max", "steps"} into evenly spaced values, raising ValueError if it is invalid"""
+    if not isinstance(spec, dict) or set(spec) != {'min', 'max', 'steps'}:
+        raise ValueError(f"{name} must be an object with min, max and steps")
+    low, high, steps = spec['min'], spec['max'], spec['steps']
+    for value in (low, high):
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+            raise ValueError(f"{name}: min and max must be non-negative numbers")
+    if low > high:
+        raise ValueError(f"{name}: min must not exceed max")
+    if isinstance(steps, bool) or not isinstance(steps, int) or not 1 <= steps <= config.GRID_MAX_STEPS:
+        raise ValueError(f"{name}: steps must be an integer from 1 to {config.GRID_MAX_STEPS}")
+    return np.linspace(low, high, steps)
+
+def parse_grid_axes(payload, applicant):
+    """Return the value array of every axis; an axis left out holds the applicant's own value"""
+    defaults = {
+        'loanAmount': float(applicant['loanAmount']),
+        'downPayment': float(applicant['propertyValue']) - float(applicant['loanAmount']),
+        'debtAmount': float(applicant['debtAmount'])
+    }
+    axes = {}
+    for name in GRID_AXES:
+        spec = payload.get(name)
+        axes[name] = np.asarray([defaults[name]]) if spec is None else _axis_values(name, spec)
+    cells = int(np.prod([len(values) for values in axes.values()]))
+    if cells > config.GRID_MAX_CELLS:
+        raise ValueError(f"Grid has {cells} cells; at most {config.GRID_MAX_CELLS} are allowed")
+    return axes
+
+def score_grid(applicant, axes, avg_credit_score, rules):
+    """Score every combination of the axes for one applicant in a single batch.
+
+    Cells are flattened in row-major order over GRID_AXES, so the cell for
+    axis indexes (i, j, k) is at i * len(downPayment) * len(debtAmount) + j * len(debtAmount) + k.
+    """
+    loan_amount, down_payment, debt_amount = (
+        grid.ravel() for grid in np.meshgrid(*(axes[name] for name in GRID_AXES), indexing='ij')
+    )
+    components = calculate_risk_scores_batch({
+        'creditScore': applicant['creditScore'],
+        'loanAmount': loan_amount,
+        'propertyValue': loan_amount + down_payment,
+        'annualIncome': applicant['annualIncome'],
+        'debtAmount': debt_amount,
+        'loanType': applicant['loanType'],
+        'propertyType': applicant['propertyType']
+    }, avg_credit_score, rules)
+    total = components.pop('total')
+    logger.info("Scored a rating grid of %s cells", len(total))
+    return {
+        "axes": {name: axes[name].tolist() for name in GRID_AXES},
+        "shape": [len(axes[name]) for name in GRID_AXES],
+        "creditRating": calculate_credit_ratings_batch(total, rules).tolist(),
+        "riskScore": total.tolist(),
+        "components": {name: values.tolist() for name, values in components.items()},
+        "averageCreditScore": avg_credit_score
+    }
\ No newline at end of file
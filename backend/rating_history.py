@@ -0,0 +1,265 @@
+"""Append-only history of every mortgage's rating.
+
+Each create, update, rating and delete appends a row to
+mortgage_rating_history in the same transaction as the change itself. ORM
+writes are recorded by a session event; Core bulk writes (bulk create,
+import, backfill and the rating queue) call record_ratings themselves. The
+new entries are kept on the session and published to change feed streams
+as change events once their transaction commits.
+
+The book as of a point in time is, per mortgage, its latest entry written
+at or before that time, unless that entry is a deletion. Entries of one
+mortgage are written by transactions that each change the mortgage row, so
+its highest ID is also its latest entry.
+"""
+from datetime import datetime, timedelta, timezone
+from operator import itemgetter
+from sqlalchemy import event, func, literal, select
+from models import db, Mortgage, MortgageRatingHistory
+from change_feed import change_feed
+from logger import setup_logger
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+history_table = MortgageRatingHistory.__table__
+
+DELETED = 'deleted'
+
+# Columns returned by history inserts, to build change events from
+EVENT_COLUMNS = (history_table.c.id, history_table.c.mortgage_id, history_table.c.event, history_table.c.risk_score,
+                 history_table.c.credit_rating, history_table.c.created_at)
+
+def change_event(entry, mortgage=None):
+    """Build a change event from a history row mapping and, when known, the mortgage's to_dict()"""
+    return {
+        'id': entry['id'],
+        'mortgageId': entry['mortgage_id'],
+        'event': entry['event'],
+        'riskScore': entry['risk_score'],
+        'creditRating': entry['credit_rating'],
+        'createdAt': entry['created_at'].isoformat(),
+        'mortgage': mortgage
+    }
+
+def insert_returning(session, table, rows, columns):
+    """Insert rows within the session's transaction and return the given columns of each as a mapping.
+
+    Uses executemany RETURNING where the database has it. Otherwise, as on
+    MySQL, a single row takes its ID from the cursor, and more rows are
+    read back by ID range: the max(id) read and the read back share the
+    transaction's snapshot under REPEATABLE READ, MySQL's default, so rows
+    other writers insert meanwhile are not picked up, and a count check
+    catches it if they are. Rows that carry their own ID need no lookup.
+    Rows come back in no particular order.
+    """
+    if not rows:
+        return []
+    insert = table.insert()
+    if session.get_bind(clause=insert).dialect.insert_executemany_returning:
+        return [row._mapping for row in session.execute(insert.returning(*columns), rows)]
+
+    id_column = table.c.id
+    explicit = [row for row in rows if row.get('id') is not None]
+    if len(rows) == 1 and not explicit:
+        row = dict(rows[0], id=session.execute(insert, rows[0]).inserted_primary_key[0])
+        return [{column.key: row.get(column.key) for column in columns}]
+
+    last_id = None
+    if len(explicit) < len(rows):
+        last_id = session.execute(select(func.coalesce(func.max(id_column), 0))).scalar()
+    session.execute(insert, rows)
+    inserted = [{column.key: row.get(column.key) for column in columns} for row in explicit]
+    if last_id is not None:
+        explicit_ids = {row['id'] for row in explicit}
+        assigned = [row._mapping for row in session.execute(select(*columns).where(id_column > last_id))
+                    if row.id not in explicit_ids]
+        if len(assigned) != len(rows) - len(explicit):
+            raise RuntimeError(f"Could not read back the IDs of rows inserted into {table.name}; "
+                               "another writer inserted rows concurrently")
+        inserted += assigned
+    return inserted
+
+def _insert_entries(session, entries, mortgages=None):
+    """Insert history rows and keep them on the session, to publish as change events after commit"""
+    rows = insert_returning(session, history_table, entries, EVENT_COLUMNS)
+    session.info.setdefault('change_events', []).append((rows, mortgages or {}))
+
+def record_ratings(session, ratings, event_name):
+    """Append one entry per rating within the caller's transaction.
+
+    `ratings` holds dicts with 'id', 'risk_score' and 'credit_rating', as
+    passed to bulk updates of the mortgages table. Their change events carry
+    no mortgage, only the rating.
+    """
+    if not ratings:
+        return
+    now = datetime.utcnow()
+    _insert_entries(session, [{
+        'mortgage_id': rating['id'],
+        'event': event_name,
+        'risk_score': rating['risk_score'],
+        'credit_rating': rating['credit_rating'],
+        'created_at': now
+    } for rating in ratings])
+
+def _history_entry(mortgage, event_name, now):
+    deleted = event_name == DELETED
+    return {
+        'mortgage_id': mortgage.id,
+        'event': event_name,
+        'risk_score': None if deleted else mortgage.risk_score,
+        'credit_rating': None if deleted else mortgage.credit_rating,
+        'created_at': now
+    }
+
+@event.listens_for(db.session, "after_flush")
+def _record_mortgage_changes(session, flush_context):
+    """Append history for every mortgage the flush inserted, changed or deleted"""
+    now = datetime.utcnow()
+    entries = []
+    mortgages = {}
+    for obj in session.new:
+        if isinstance(obj, Mortgage):
+            entries.append(_history_entry(obj, 'created', now))
+            mortgages[obj.id] = obj.to_dict()
+    for obj in session.dirty:
+        if isinstance(obj, Mortgage) and obj not in session.deleted and session.is_modified(obj):
+            entries.append(_history_entry(obj, 'updated', now))
+            mortgages[obj.id] = obj.to_dict()
+    for obj in session.deleted:
+        if isinstance(obj, Mortgage):
+            entries.append(_history_entry(obj, DELETED, now))
+    # IDs are assigned by now, and the insert joins the flush's transaction
+    if entries:
+        _insert_entries(session, entries, mortgages)
+
+@event.listens_for(db.session, "after_commit")
+def _publish_changes(session):
+    # Entries are kept whether or not anyone is subscribed, so a stream opened between
+    # the write and the commit still gets them
+    batches = session.info.pop('change_events', None)
+    if batches and change_feed.has_subscribers():
+        change_feed.publish([change_event(row, mortgages.get(row['mortgage_id']))
+                             for rows, mortgages in batches for row in sorted(rows, key=itemgetter('id'))])
+
+@event.listens_for(db.session, "after_rollback")
+def _discard_changes(session):
+    session.info.pop('change_events', None)
+
+def resume_point(last_event_id, window, session=None):
+    """Return the event ID to replay after for a client that last saw `last_event_id`.
+
+    IDs are assigned when entries are written, not when they commit, so a
+    transaction that wrote an entry before the one the client saw can commit
+    after it. Replaying from the first entry written up to `window` seconds
+    before the one the client saw picks those up; the client may get some
+    events twice, each carrying the mortgage as it is now.
+    """
+    session = session or db.session
+    seen_at = session.execute(
+        select(MortgageRatingHistory.created_at).where(MortgageRatingHistory.id == last_event_id)
+    ).scalar()
+    if seen_at is None:
+        return last_event_id
+    first_id = session.execute(
+        select(func.min(MortgageRatingHistory.id))
+        .where(MortgageRatingHistory.id < last_event_id,
+               MortgageRatingHistory.created_at >= seen_at - timedelta(seconds=window))
+    ).scalar()
+    return last_event_id if first_id is None else first_id - 1
+
+def changes_since(after_id, limit, session=None):
+    """Return up to `limit` change events after an event ID, in ID order.
+
+    Each event carries the mortgage as it is now, or None once it is deleted.
+    """
+    session = session or db.session
+    rows = session.execute(
+        select(*EVENT_COLUMNS, Mortgage)
+        .outerjoin(Mortgage, Mortgage.id == history_table.c.mortgage_id)
+        .where(history_table.c.id > after_id)
+        .order_by(history_table.c.id)
+        .limit(limit)
+    ).all()
+    return [change_event(row._mapping, row.Mortgage.to_dict() if row.Mortgage is not None else None) for row in rows]
+
+def seed_rating_history(session=None):
+    """Give every mortgage without history a 'created' entry dated at its creation; the caller commits.
+
+    Books that predate the history table need this once, or as-of queries
+    would not see their existing loans.
+    """
+    session = session or db.session
+    has_history = select(MortgageRatingHistory.id).where(MortgageRatingHistory.mortgage_id == Mortgage.id).exists()
+    result = session.execute(history_table.insert().from_select(
+        ['mortgage_id', 'event', 'risk_score', 'credit_rating', 'created_at'],
+        select(Mortgage.id, literal('created'), Mortgage.risk_score, Mortgage.credit_rating,
+               func.coalesce(Mortgage.created_at, func.current_timestamp())).where(~has_history)
+    ))
+    logger.info("Seeded rating history for %s mortgages", result.rowcount)
+    return result.rowcount
+
+def parse_as_of(value):
+    """Parse an ISO 8601 timestamp into naive UTC, as stored; raises ValueError if it is invalid"""
+    if not value:
+        raise ValueError("Query parameter asOf is required")
+    try:
+        as_of = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    except ValueError:
+        raise ValueError(f"Query parameter asOf is not an ISO 8601 timestamp: {value}")
+    if as_of.tzinfo is not None:
+        as_of = as_of.astimezone(timezone.utc).replace(tzinfo=None)
+    return as_of
+
+def _latest_entry_ids(as_of):
+    """Each mortgage's latest entry ID as of a time, read from the (mortgage_id, created_at) index"""
+    return (
+        select(func.max(MortgageRatingHistory.id))
+        .where(MortgageRatingHistory.created_at <= as_of)
+        .group_by(MortgageRatingHistory.mortgage_id)
+    )
+
+def rating_distribution_as_of(as_of, session=None):
+    """Count the mortgages in the book at a point in time by the rating they had then"""
+    session = session or db.session
+    rows = session.execute(
+        select(MortgageRatingHistory.credit_rating, func.count())
+        .where(MortgageRatingHistory.id.in_(_latest_entry_ids(as_of)), MortgageRatingHistory.event != DELETED)
+        .group_by(MortgageRatingHistory.credit_rating)
+    ).all()
+    # Mortgages not yet rated at the time count as pending
+    return {rating or 'pending': count for rating, count in rows}
+
+def ratings_as_of(as_of, limit, after_id=None, session=None):
+    """Return a page of the book's ratings at a point in time, in mortgage ID order.
+
+    Walks the (mortgage_id, created_at) index in order and looks up each
+    mortgage's latest entry, so a page costs about `limit` index seeks
+    however long the history is.
+    """
+    session = session or db.session
+    latest = history_table.alias('latest')
+    latest_id = (
+        select(func.max(latest.c.id))
+        .where(latest.c.mortgage_id == MortgageRatingHistory.mortgage_id, latest.c.created_at <= as_of)
+        .scalar_subquery()
+    )
+    query = (
+        select(MortgageRatingHistory)
+        .where(MortgageRatingHistory.id == latest_id, MortgageRatingHistory.event != DELETED)
+        .order_by(MortgageRatingHistory.mortgage_id)
+        .limit(limit)
+    )
+    if after_id is not None:
+        query = query.where(MortgageRatingHistory.mortgage_id > after_id)
+    return session.execute(query).scalars().all()
+
+def mortgage_rating_history(mortgage_id, session=None):
+    """Return one mortgage's history entries, oldest first"""
+    session = session or db.session
+    return session.execute(
+        select(MortgageRatingHistory)
+        .where(MortgageRatingHistory.mortgage_id == mortgage_id)
+        .order_by(MortgageRatingHistory.created_at, MortgageRatingHistory.id)
+    ).scalars().all()
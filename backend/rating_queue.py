@@ -0,0 +1,212 @@
+"""Background rating of mortgages created in async rating mode.
+
+POST /api/mortgages commits the row unrated and hands its ID to a bounded
+in-process queue; a small pool of worker threads drains it in batches and
+stores the ratings. A full queue is the backpressure signal: the request then
+rates inline as it does in the default mode.
+
+The mortgages table itself is the durable queue. A row is pending exactly
+while its credit_rating is NULL, so a sweeper thread periodically enqueues
+pending rows nobody is working on. That recovers rows whose IDs were lost in
+a crash or a full queue, and lets several nodes share the work: a row rated
+by one node is skipped by the others.
+"""
+import queue
+import threading
+import time
+from sqlalchemy import select
+from models import db, Mortgage
+from portfolio import rate_pending_mortgages
+from mortgage_cache import mortgage_cache
+from instrumentation import Histogram, LATENCY_BUCKETS
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+rating_delay = Histogram('rating_queue_delay_seconds', "Time from enqueueing a mortgage to storing its rating",
+                         ('source',), LATENCY_BUCKETS + (30.0, 60.0, 300.0))
+
+class RatingQueue:
+    """Bounded queue of mortgage IDs awaiting a rating, with its worker and sweeper threads"""
+
+    def __init__(self):
+        self._queue = None
+        self._queued = set()  # IDs in the queue or being rated, so the sweeper skips them
+        self._lock = threading.Lock()
+        self._rated = threading.Condition(self._lock)
+        self._batches_done = 0
+        self._threads = []
+        self._stopping = threading.Event()
+        self.counters = {'submitted': 0, 'overflowed': 0, 'rejected': 0, 'recovered': 0, 'rated': 0, 'failed': 0}
+
+    @property
+    def running(self):
+        return bool(self._threads)
+
+    def start(self, app, workers=None, size=None):
+        """Start the worker pool and the recovery sweeper for an app"""
+        if self.running:
+            return
+        workers = config.RATING_WORKERS if workers is None else workers
+        self._queue = queue.Queue(maxsize=size or config.RATING_QUEUE_SIZE)
+        self._stopping.clear()
+        for number in range(workers):
+            self._start_thread(f"rating-worker-{number}", self._work, app)
+        self._start_thread("rating-sweeper", self._sweep, app)
+        logger.info("Started %s rating workers", workers)
+
+    def _start_thread(self, name, target, app):
+        thread = threading.Thread(target=target, args=(app,), name=name, daemon=True)
+        thread.start()
+        self._threads.append(thread)
+
+    def stop(self, timeout=5):
+        """Stop the threads; IDs still queued stay pending in the database"""
+        self._stopping.set()
+        # Wake idle workers; busy ones see the stop flag after their batch
+        for _ in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except queue.Full:
+                break
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        with self._lock:
+            self._queued.clear()
+            self._rated.notify_all()
+
+    def accepting(self):
+        """Whether a new mortgage can be left pending instead of being rated inline"""
+        if not self.running:
+            return False
+        if self._queue.full():
+            with self._lock:
+                self.counters['overflowed'] += 1
+            return False
+        return True
+
+    def submit(self, mortgage_id, source='request'):
+        """Queue a committed, unrated mortgage; returns False if the queue is full"""
+        with self._lock:
+            if mortgage_id in self._queued:
+                return True
+            try:
+                self._queue.put_nowait((mortgage_id, time.monotonic(), source))
+            except queue.Full:
+                self.counters['rejected'] += 1
+                return False
+            self._queued.add(mortgage_id)
+            self.counters['submitted' if source == 'request' else 'recovered'] += 1
+        return True
+
+    def _next_batch(self):
+        """Block briefly for one queued ID, then take whatever else is waiting up to the batch size"""
+        try:
+            item = self._queue.get(timeout=1.0)
+        except queue.Empty:
+            return []
+        batch = []
+        # None is the stop signal
+        while item is not None:
+            batch.append(item)
+            if len(batch) == config.RATING_BATCH_SIZE:
+                break
+            try:
+                item = self._queue.get_nowait()
+            except queue.Empty:
+                break
+        return batch
+
+    def _work(self, app):
+        while not self._stopping.is_set():
+            batch = self._next_batch()
+            if not batch:
+                continue
+            ids = [mortgage_id for mortgage_id, _, _ in batch]
+            try:
+                with app.app_context():
+                    ratings = rate_pending_mortgages(ids)
+                rated = len(ratings)
+                failed = 0
+            except Exception as e:
+                # The rows stay pending; the sweeper queues them again
+                logger.error("Error rating mortgages %s: %s", ids, e)
+                rated, failed = 0, len(ids)
+            now = time.monotonic()
+            for mortgage_id, enqueued_at, source in batch:
+                mortgage_cache.invalidate(mortgage_id)
+                if not failed:
+                    rating_delay.observe((source,), now - enqueued_at)
+            with self._lock:
+                self._queued.difference_update(ids)
+                self.counters['rated'] += rated
+                self.counters['failed'] += failed
+                self._batches_done += 1
+                self._rated.notify_all()
+
+    def _sweep(self, app):
+        while not self._stopping.is_set():
+            try:
+                self.recover(app)
+            except Exception as e:
+                logger.error("Error sweeping pending mortgages: %s", e)
+            self._stopping.wait(config.RATING_RECOVERY_INTERVAL)
+
+    def recover(self, app):
+        """Queue pending mortgages that are not already queued, as far as the queue has room"""
+        room = self._queue.maxsize - self._queue.qsize()
+        if room <= 0:
+            return 0
+        with self._lock:
+            skip = len(self._queued)
+        with app.app_context():
+            ids = db.session.execute(
+                select(Mortgage.id).where(Mortgage.credit_rating.is_(None)).order_by(Mortgage.id).limit(room + skip)
+            ).scalars().all()
+        queued = 0
+        for mortgage_id in ids:
+            if mortgage_id not in self._queued and self.submit(mortgage_id, 'recovery'):
+                queued += 1
+        if queued:
+            logger.info("Queued %s pending mortgages for rating", queued)
+        return queued
+
+    def batches_done(self):
+        """Count of finished batches, to pass to wait()"""
+        with self._lock:
+            return self._batches_done
+
+    def wait(self, batches_done, timeout):
+        """Block until a batch finishes after `batches_done` was read, or the timeout passes"""
+        with self._lock:
+            self._rated.wait_for(lambda: self._batches_done != batches_done, timeout)
+
+    def stats(self):
+        """Report queue depth, capacity and counters"""
+        with self._lock:
+            return {
+                "running": self.running,
+                "depth": self._queue.qsize() if self._queue else 0,
+                "capacity": self._queue.maxsize if self._queue else 0,
+                "inFlight": len(self._queued),
+                "workers": max(len(self._threads) - 1, 0),
+                **self.counters
+            }
+
+    def render_metrics(self):
+        """Queue gauges and counters in the Prometheus text format"""
+        stats = self.stats()
+        lines = []
+        for name, key, kind in (('rating_queue_depth', 'depth', 'gauge'),
+                                ('rating_queue_capacity', 'capacity', 'gauge'),
+                                ('rating_queue_in_flight', 'inFlight', 'gauge')):
+            lines += [f"# TYPE {name} {kind}", f"{name} {stats[key]}"]
+        lines.append("# TYPE rating_queue_events_total counter")
+        for key in self.counters:
+            lines.append(f'rating_queue_events_total{{event="{key}"}} {stats[key]}')
+        return '\n'.join(lines) + '\n' + rating_delay.render() + '\n'
+
+rating_queue = RatingQueue()
\ No newline at end of file
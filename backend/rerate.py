@@ -0,0 +1,133 @@
+import argparse
+import json
+import os
+import time
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from sqlalchemy import create_engine, func, select, update
+from sqlalchemy.orm import Session
+from models import Mortgage
+from portfolio import SCORING_COLUMNS, get_portfolio_totals, score_stored_rows
+from rating_history import record_ratings
+from rules import get_rules
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+# Each worker process opens its own engine; connections must not cross a fork
+_worker_engine = None
+
+def _init_worker(database_uri):
+    """Create the worker process's database engine"""
+    global _worker_engine
+    _worker_engine = create_engine(database_uri, **config.engine_options(database_uri))
+
+def rerate_range(first_id, last_id, credit_score_sum, mortgage_count, rules_version):
+    """Score mortgages with first_id <= id <= last_id and write their ratings back.
+
+    Runs in a worker process. Returns (first_id, last_id, rows, seconds, pid).
+    """
+    start = time.perf_counter()
+    rules = get_rules()
+    if rules.version != rules_version:
+        raise RuntimeError(f"Rule set changed from {rules_version} to {rules.version} during the run")
+
+    with Session(_worker_engine) as session:
+        rows = session.execute(
+            select(*SCORING_COLUMNS).where(Mortgage.id >= first_id, Mortgage.id <= last_id)
+        ).all()
+        if rows:
+            ratings = score_stored_rows(rows, credit_score_sum, mortgage_count, rules)
+            session.execute(update(Mortgage), ratings)
+            # Same transaction as the update, so as-of queries never miss a new rating
+            record_ratings(session, ratings, 'rated')
+            session.commit()
+
+    return first_id, last_id, len(rows), time.perf_counter() - start, os.getpid()
+
+def load_checkpoint(path, rules_version):
+    """Return the id the previous run completed through, or 0 to start over"""
+    if not os.path.exists(path):
+        return 0
+    with open(path) as f:
+        checkpoint = json.load(f)
+    # A checkpoint from another rule set does not count; those rows need re-rating
+    if checkpoint.get('rulesVersion') != rules_version:
+        logger.info("Ignoring checkpoint for rule set %s", checkpoint.get('rulesVersion'))
+        return 0
+    return checkpoint['completedThrough']
+
+def save_checkpoint(path, rules_version, completed_through):
+    """Atomically record that every id up to completed_through has been re-rated"""
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump({'rulesVersion': rules_version, 'completedThrough': completed_through}, f)
+    os.replace(temp_path, path)
+
+def rerate_portfolio(database_uri, workers, chunk_size, checkpoint_path):
+    """Re-rate the whole book in id-range chunks across a process pool"""
+    engine = create_engine(database_uri, **config.engine_options(database_uri))
+    with Session(engine) as session:
+        credit_score_sum, mortgage_count = get_portfolio_totals(session)
+        session.commit()
+        min_id, max_id = session.execute(select(func.min(Mortgage.id), func.max(Mortgage.id))).one()
+    engine.dispose()
+
+    rules_version = get_rules().version
+    if max_id is None:
+        print("No mortgages to re-rate")
+        return
+
+    completed_through = max(load_checkpoint(checkpoint_path, rules_version), min_id - 1)
+    ranges = [(first_id, min(first_id + chunk_size - 1, max_id))
+              for first_id in range(completed_through + 1, max_id + 1, chunk_size)]
+    logger.info("Re-rating IDs %s-%s in %s chunks with rule set %s",
+                completed_through + 1, max_id, len(ranges), rules_version)
+
+    # Chunks finish out of order; the checkpoint only advances over a contiguous prefix
+    finished = {}
+    rows_by_worker = defaultdict(int)
+    seconds_by_worker = defaultdict(float)
+    total_rows = 0
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(database_uri,)) as executor:
+        futures = [
+            executor.submit(rerate_range, first_id, last_id, credit_score_sum, mortgage_count, rules_version)
+            for first_id, last_id in ranges
+        ]
+        for future in as_completed(futures):
+            first_id, last_id, rows, seconds, pid = future.result()
+            finished[first_id] = last_id
+            rows_by_worker[pid] += rows
+            seconds_by_worker[pid] += seconds
+            total_rows += rows
+
+            while completed_through + 1 in finished:
+                completed_through = finished.pop(completed_through + 1)
+            save_checkpoint(checkpoint_path, rules_version, completed_through)
+
+    elapsed = time.perf_counter() - start
+    print(f"Re-rated {total_rows} mortgages in {elapsed:.2f}s ({total_rows / elapsed:,.0f} rows/s) "
+          f"with {len(rows_by_worker)} workers")
+    for pid in sorted(rows_by_worker):
+        rows = rows_by_worker[pid]
+        print(f"  worker {pid}: {rows} rows, {rows / seconds_by_worker[pid]:,.0f} rows/s while busy")
+
+def main():
+    parser = argparse.ArgumentParser(description="Re-rate every stored mortgage with the current rules")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument('--chunk-size', type=int, default=10000, help="mortgage IDs per chunk")
+    parser.add_argument('--checkpoint', default='rerate.checkpoint.json', help="checkpoint file for resuming")
+    parser.add_argument('--restart', action='store_true', help="ignore any existing checkpoint")
+    parser.add_argument('--database-url', default=config.SQLALCHEMY_DATABASE_URI)
+    args = parser.parse_args()
+
+    if args.restart and os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+    rerate_portfolio(args.database_url, args.workers, args.chunk_size, args.checkpoint)
+
+if __name__ == '__main__':
+    main()
\ No newline at end of file
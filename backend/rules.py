@@ -0,0 +1,180 @@
+import json
+import math
+import os
+import threading
+import time
+from bisect import bisect_left, bisect_right
+import numpy as np
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+# Tables up to this many breakpoints are compiled into an inline comparison chain,
+# which beats a bisect call for the short tables the scoring rules use
+INLINE_BREAKPOINT_LIMIT = 8
+
+class ThresholdRule:
+    """Maps a number to a score through sorted breakpoints.
+
+    With side 'left' a value equal to a breakpoint stays in the lower band
+    (value > breakpoint moves up); with side 'right' it moves to the upper band
+    (value >= breakpoint moves up). This matches bisect_left/bisect_right and
+    numpy.searchsorted.
+    """
+
+    def __init__(self, name, breakpoints, outcomes, side, zero_denominator_score=None):
+        if list(breakpoints) != sorted(breakpoints):
+            raise ValueError(f"Rule {name}: breakpoints must be sorted ascending")
+        if len(outcomes) != len(breakpoints) + 1:
+            raise ValueError(f"Rule {name}: expected {len(breakpoints) + 1} outcomes, got {len(outcomes)}")
+        if side not in ('left', 'right'):
+            raise ValueError(f"Rule {name}: side must be 'left' or 'right'")
+        if not all(isinstance(b, (int, float)) and not isinstance(b, bool) and b == b for b in breakpoints):
+            raise ValueError(f"Rule {name}: breakpoints must be numbers, not NaN")
+        if not all(isinstance(o, (int, float, str)) and not isinstance(o, bool) for o in outcomes):
+            raise ValueError(f"Rule {name}: outcomes must be numbers or strings")
+        self.name = name
+        self.breakpoints = list(breakpoints)
+        self.outcomes = list(outcomes)
+        self.side = side
+        self.zero_denominator_score = zero_denominator_score
+        self._bisect = bisect_left if side == 'left' else bisect_right
+        self._breakpoint_array = np.asarray(self.breakpoints, dtype=np.float64)
+        self._outcome_array = np.asarray(self.outcomes)
+        self.lookup = self._compile_lookup()
+
+    def _compile_lookup(self):
+        """Build the scalar lookup function returning the outcome for a single value"""
+        if len(self.breakpoints) > INLINE_BREAKPOINT_LIMIT:
+            bisect, breakpoints, outcomes = self._bisect, tuple(self.breakpoints), tuple(self.outcomes)
+            return lambda value: outcomes[bisect(breakpoints, value)]
+
+        # Unrolled equivalent of outcomes[bisect(breakpoints, value)], highest band first
+        operator = '>' if self.side == 'left' else '>='
+        constants = {}
+
+        def literal(value):
+            # repr() of inf or nan is not valid source, so pass those in by name
+            if isinstance(value, float) and not math.isfinite(value):
+                name = f'c{len(constants)}'
+                constants[name] = value
+                return name
+            return repr(value)
+
+        lines = ['def lookup(value):']
+        for index in range(len(self.breakpoints) - 1, -1, -1):
+            lines.append(f'    if value {operator} {literal(self.breakpoints[index])}: '
+                         f'return {literal(self.outcomes[index + 1])}')
+        lines.append(f'    return {literal(self.outcomes[0])}')
+        namespace = dict(constants)
+        exec('\n'.join(lines), namespace)
+        return namespace['lookup']
+
+    def band(self, value):
+        """Return the index of the band a value falls in"""
+        return self._bisect(self.breakpoints, value)
+
+    def band_batch(self, values):
+        """Return the band index of each value in an array"""
+        if len(self.breakpoints) > INLINE_BREAKPOINT_LIMIT:
+            return np.searchsorted(self._breakpoint_array, values, side=self.side)
+        # For short tables one vectorized comparison per breakpoint beats a binary search per value.
+        # Negated comparisons put NaN in the top band, as searchsorted does
+        values = np.asarray(values)
+        bands = np.zeros(values.shape, dtype=np.intp)
+        for breakpoint in self.breakpoints:
+            bands += ~(values <= breakpoint) if self.side == 'left' else ~(values < breakpoint)
+        return bands
+
+    def lookup_batch(self, values):
+        """Return the outcomes for an array of values"""
+        return self._outcome_array[self.band_batch(values)]
+
+class CategoryRule:
+    """Maps a category to a score, with a default for anything unlisted"""
+
+    def __init__(self, name, scores, default):
+        self.name = name
+        self.scores = dict(scores)
+        self.default = default
+
+    def lookup(self, value):
+        """Return the score for a single category"""
+        return self.scores.get(value, self.default)
+
+    def lookup_batch(self, values):
+        """Return the scores for an array of categories"""
+        result = np.full(len(values), self.default)
+        for category, score in self.scores.items():
+            result[values == category] = score
+        return result
+
+class RuleSet:
+    """A compiled, versioned set of scoring rules"""
+
+    def __init__(self, spec):
+        self.version = str(spec['version'])
+        self.loan_to_value = self._threshold('loanToValue', spec)
+        self.debt_to_income = self._threshold('debtToIncome', spec)
+        self.credit_score = self._threshold('creditScore', spec)
+        self.avg_credit_score = self._threshold('avgCreditScore', spec)
+        self.loan_type = CategoryRule('loanType', spec['loanType']['scores'], spec['loanType']['default'])
+        self.property_type = CategoryRule('propertyType', spec['propertyType']['scores'], spec['propertyType']['default'])
+        rating = spec['rating']
+        self.rating = ThresholdRule('rating', rating['breakpoints'], rating['labels'], rating.get('side', 'left'))
+
+    @staticmethod
+    def _threshold(name, spec):
+        rule = spec[name]
+        return ThresholdRule(name, rule['breakpoints'], rule['scores'], rule.get('side', 'left'),
+                             rule.get('zeroDenominatorScore'))
+
+def load_rules(path):
+    """Read a JSON or YAML rule file and compile it into a RuleSet"""
+    with open(path) as f:
+        if path.endswith(('.yaml', '.yml')):
+            import yaml  # Only needed for YAML rule files
+            spec = yaml.safe_load(f)
+        else:
+            spec = json.load(f)
+    return RuleSet(spec)
+
+_rules = None
+_rules_mtime = None
+_last_check = 0.0
+_lock = threading.Lock()
+
+def reload_rules(path=None):
+    """Load the rule file now and make it the active rule set"""
+    global _rules, _rules_mtime, _last_check
+    path = path or config.RULES_FILE
+    with _lock:
+        mtime = os.path.getmtime(path)
+        _rules = load_rules(path)
+        _rules_mtime = mtime
+        _last_check = time.monotonic()
+    logger.info("Loaded rule set version %s from %s", _rules.version, path)
+    return _rules
+
+def get_rules():
+    """Return the active rule set, picking up edits to the rule file without a restart"""
+    global _last_check
+    if _rules is None:
+        return reload_rules()
+
+    # Check the file's modification time at most once per interval
+    now = time.monotonic()
+    if now - _last_check < config.RULES_RELOAD_INTERVAL:
+        return _rules
+    _last_check = now
+
+    try:
+        if os.path.getmtime(config.RULES_FILE) != _rules_mtime:
+            return reload_rules()
+    except Exception as e:
+        # Keep scoring with the last good rules if the new file is broken, however it fails
+        # to parse or compile (a null list raises TypeError, bad YAML a YAMLError)
+        logger.error("Failed to reload rules from %s: %s", config.RULES_FILE, e)
+    return _rules
\ No newline at end of file
@@ -0,0 +1,60 @@
+import json
+from models import Mortgage
+
+try:
+    import orjson  # Optional; much faster than the stdlib encoder for large listings
+except ImportError:
+    orjson = None
+
+# Columns selected for read endpoints, keyed like Mortgage.to_dict and in sorted key
+# order, which is the order jsonify writes them in
+MORTGAGE_FIELDS = sorted([
+    ('id', Mortgage.id),
+    ('creditScore', Mortgage.credit_score),
+    ('loanAmount', Mortgage.loan_amount),
+    ('propertyValue', Mortgage.property_value),
+    ('annualIncome', Mortgage.annual_income),
+    ('debtAmount', Mortgage.debt_amount),
+    ('loanType', Mortgage.loan_type),
+    ('propertyType', Mortgage.property_type),
+    ('riskScore', Mortgage.risk_score),
+    ('creditRating', Mortgage.credit_rating),
+    ('createdAt', Mortgage.created_at)
+], key=lambda field: field[0])
+
+MORTGAGE_KEYS = tuple(key for key, _ in MORTGAGE_FIELDS)
+MORTGAGE_COLUMNS = tuple(column for _, column in MORTGAGE_FIELDS)
+CREATED_AT_INDEX = MORTGAGE_KEYS.index('createdAt')
+ID_INDEX = MORTGAGE_KEYS.index('id')
+
+def mortgage_dicts(rows):
+    """Turn rows of MORTGAGE_COLUMNS into dicts with the same keys and values as to_dict"""
+    keys = MORTGAGE_KEYS
+    if orjson is not None:
+        # orjson writes naive datetimes exactly as isoformat() does
+        return [dict(zip(keys, row)) for row in rows]
+    dicts = [dict(zip(keys, row)) for row in rows]
+    for item in dicts:
+        item['createdAt'] = item['createdAt'].isoformat()
+    return dicts
+
+def encode_mortgages(rows):
+    """Encode rows as a compact JSON array with the same values jsonify writes for the to_dict list.
+
+    The bytes can differ: orjson writes floats in their shortest form (1e16
+    rather than 1e+16) and non-ASCII strings as UTF-8 rather than \\u escapes.
+    """
+    if orjson is not None:
+        return orjson.dumps(mortgage_dicts(rows))
+    return json.dumps(mortgage_dicts(rows), separators=(',', ':')).encode()
+
+def encode_mortgage(row):
+    """Encode a single row as a compact JSON object"""
+    return encode_mortgages([row])[1:-1]
+
+def encode_mortgage_lines(rows):
+    """Encode rows as newline-delimited JSON objects"""
+    if orjson is not None:
+        dumps = orjson.dumps
+        return b''.join([dumps(item) + b'\n' for item in mortgage_dicts(rows)])
+    return ''.join([json.dumps(item, separators=(',', ':')) + '\n' for item in mortgage_dicts(rows)]).encode()
\ No newline at end of file
@@ -0,0 +1,168 @@
+"""Portfolio stress tests: how credit ratings across the book move under shock scenarios.
+
+A scenario scales loan amounts, property values, incomes and debts by
+relative shocks (-0.2 is a 20% drop) and shifts credit scores by a number of
+points. The book is read once, chunk by chunk, either from the in-memory
+snapshot or through a server-side cursor. Every scenario is applied to each
+chunk before the next is read. A scenario only recomputes the score
+components its shocks touch, and the rest are reused from the baseline.
+
+As when ratings are stored, each loan is scored against the average credit
+score of every other loan. A credit score shift moves that average by the
+same number of points.
+"""
+import numpy as np
+from sqlalchemy import select
+from models import db, Mortgage
+from credit_ratings import loan_to_value_batch, debt_to_income_batch, credit_score_check_batch, \
+    loan_type_process_batch, property_type_process_batch, average_credit_process_batch
+from portfolio import SCORING_COLUMNS, get_portfolio_totals
+from portfolio_snapshot import portfolio_snapshot
+from rules import get_rules
+from logger import setup_logger
+import Config as config
+
+# Set up logger for this module
+logger = setup_logger(__name__)
+
+# Relative shocks, keyed like the API payload
+RELATIVE_SHOCKS = ('loanAmount', 'propertyValue', 'annualIncome', 'debtAmount')
+
+def parse_scenarios(payload):
+    """Validate a request body and return its scenarios as dicts with every shock filled in.
+
+    Raises ValueError describing the first problem found.
+    """
+    scenarios = payload.get('scenarios') if isinstance(payload, dict) else None
+    if not isinstance(scenarios, list) or not scenarios:
+        raise ValueError("Body must contain a non-empty 'scenarios' list")
+    if len(scenarios) > config.STRESS_MAX_SCENARIOS:
+        raise ValueError(f"At most {config.STRESS_MAX_SCENARIOS} scenarios per request")
+
+    parsed = []
+    for index, scenario in enumerate(scenarios):
+        if not isinstance(scenario, dict):
+            raise ValueError(f"Scenario {index} must be a JSON object")
+        unknown = set(scenario) - set(RELATIVE_SHOCKS) - {'name', 'creditScore'}
+        if unknown:
+            raise ValueError(f"Scenario {index}: unknown fields {', '.join(sorted(unknown))}")
+        shocks = {}
+        for field in RELATIVE_SHOCKS + ('creditScore',):
+            value = scenario.get(field, 0)
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                raise ValueError(f"Scenario {index}: {field} must be a number")
+            if field in RELATIVE_SHOCKS and value < -1:
+                raise ValueError(f"Scenario {index}: {field} cannot fall by more than 100%")
+            shocks[field] = value
+        parsed.append({'name': str(scenario.get('name', f"scenario-{index}")), 'shocks': shocks})
+    return parsed
+
+def _snapshot_chunks(chunk_size):
+    columns = portfolio_snapshot.scoring_columns()
+    for start in range(0, len(columns['id']), chunk_size):
+        yield {name: values[start:start + chunk_size] for name, values in columns.items()}
+
+def _database_chunks(session, chunk_size):
+    result = session.execute(
+        select(*SCORING_COLUMNS).order_by(Mortgage.id).execution_options(yield_per=chunk_size)
+    )
+    for partition in result.partitions():
+        ids, credit_scores, loan_amounts, property_values, annual_incomes, debt_amounts, \
+            loan_types, property_types = zip(*partition)
+        yield {
+            'creditScore': np.asarray(credit_scores, dtype=np.int64),
+            'loanAmount': np.asarray(loan_amounts, dtype=np.float64),
+            'propertyValue': np.asarray(property_values, dtype=np.float64),
+            'annualIncome': np.asarray(annual_incomes, dtype=np.float64),
+            'debtAmount': np.asarray(debt_amounts, dtype=np.float64),
+            'loanType': np.asarray(loan_types, dtype=object),
+            'propertyType': np.asarray(property_types, dtype=object)
+        }
+
+def _stress_chunk(columns, credit_score_sum, mortgage_count, scenarios, rules, migrations):
+    """Add one chunk's baseline-to-scenario band counts to each scenario's flattened migration matrix"""
+    credit_score = columns['creditScore'].astype(np.int64)
+    loan_amount, property_value = columns['loanAmount'], columns['propertyValue']
+    annual_income, debt_amount = columns['annualIncome'], columns['debtAmount']
+
+    # Average of every other loan; a lone loan falls back to its own score
+    if mortgage_count > 1:
+        avg_credit_score = (credit_score_sum - credit_score) / (mortgage_count - 1)
+    else:
+        avg_credit_score = credit_score.astype(np.float64)
+
+    # Loan and property type scores do not move under any shock
+    fixed = loan_type_process_batch(columns['loanType'], rules) + \
+        property_type_process_batch(columns['propertyType'], rules)
+    loan_to_value = loan_to_value_batch(loan_amount, property_value, rules)
+    debt_to_income = debt_to_income_batch(debt_amount, annual_income, rules)
+    credit = credit_score_check_batch(credit_score, rules) + average_credit_process_batch(avg_credit_score, rules)
+    baseline = rules.rating.band_batch(fixed + loan_to_value + debt_to_income + credit)
+
+    bands = len(rules.rating.outcomes)
+    for scenario, migration in zip(scenarios, migrations):
+        shocks = scenario['shocks']
+        if shocks['loanAmount'] or shocks['propertyValue']:
+            shocked_loan_to_value = loan_to_value_batch(loan_amount * (1 + shocks['loanAmount']),
+                                                        property_value * (1 + shocks['propertyValue']), rules)
+        else:
+            shocked_loan_to_value = loan_to_value
+        if shocks['debtAmount'] or shocks['annualIncome']:
+            shocked_debt_to_income = debt_to_income_batch(debt_amount * (1 + shocks['debtAmount']),
+                                                          annual_income * (1 + shocks['annualIncome']), rules)
+        else:
+            shocked_debt_to_income = debt_to_income
+        if shocks['creditScore']:
+            shocked_credit = credit_score_check_batch(credit_score + shocks['creditScore'], rules) + \
+                average_credit_process_batch(avg_credit_score + shocks['creditScore'], rules)
+        else:
+            shocked_credit = credit
+        total = fixed + shocked_loan_to_value + shocked_debt_to_income + shocked_credit
+        migration += np.bincount(baseline * bands + rules.rating.band_batch(total), minlength=bands * bands)
+
+def run_stress_test(scenarios, session=None, rules=None, chunk_size=None):
+    """Rate the whole book under every scenario in one pass and return rating migration matrices"""
+    rules = rules or get_rules()
+    chunk_size = chunk_size or config.STRESS_CHUNK_SIZE
+    labels = list(rules.rating.outcomes)
+    bands = len(labels)
+
+    # The in-memory snapshot, when loaded, answers without a database round trip
+    if portfolio_snapshot.loaded and session is None:
+        source = 'snapshot'
+        credit_score_sum, mortgage_count = portfolio_snapshot.totals()
+        chunks = _snapshot_chunks(chunk_size)
+    else:
+        source = 'database'
+        session = session or db.session
+        credit_score_sum, mortgage_count = get_portfolio_totals(session)
+        chunks = _database_chunks(session, chunk_size)
+
+    migrations = [np.zeros(bands * bands, dtype=np.int64) for _ in scenarios]
+    for columns in chunks:
+        _stress_chunk(columns, credit_score_sum, mortgage_count, scenarios, rules, migrations)
+
+    results = []
+    for scenario, migration in zip(scenarios, migrations):
+        matrix = migration.reshape(bands, bands)
+        results.append({
+            "name": scenario['name'],
+            "shocks": scenario['shocks'],
+            "distribution": dict(zip(labels, matrix.sum(axis=0).tolist())),
+            "migration": {label: dict(zip(labels, row.tolist())) for label, row in zip(labels, matrix)},
+            # Bands are ordered from best to worst rating
+            "downgraded": int(np.triu(matrix, 1).sum()),
+            "upgraded": int(np.tril(matrix, -1).sum())
+        })
+
+    baseline = migrations[0].reshape(bands, bands).sum(axis=1) if migrations else np.zeros(bands, dtype=np.int64)
+    logger.info("Stress tested %s mortgages under %s scenarios from the %s", int(baseline.sum()), len(scenarios),
+                source)
+    return {
+        "loanCount": int(baseline.sum()),
+        "ratings": labels,
+        "baseline": dict(zip(labels, baseline.tolist())),
+        "scenarios": results,
+        "source": source,
+        "ruleSetVersion": rules.version
+    }
\ No newline at end of file
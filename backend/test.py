@@ -1,24 +1,56 @@
 import unittest
+import asyncio
 import json
-from app import app
-from models import db, Mortgage
+import os
+import random
+import tempfile
+import time
+from datetime import datetime, timedelta
+import Config as config
+# Log to a scratch file rather than app.log in the working tree; set before any module logger is imported
+config.LOG_FILE = os.path.join(tempfile.gettempdir(), 'credit_rating_test.log')
+from app import create_app
+from sqlalchemy import create_engine, event, insert, select, text
+from models import db, Mortgage, MortgageRatingHistory
+from rating_history import seed_rating_history
+from change_feed import Subscription, change_feed
+from db_routing import replica_binds
+from credit_ratings import (calculate_risk_score, calculate_credit_rating, calculate_risk_components,
+                            calculate_risk_scores_batch, calculate_credit_ratings_batch)
+from rating_cache import RatingCache
+from mortgage_cache import LRUTTLBackend, MortgageCache, mortgage_cache
+from mortgage_io import insert_mortgages
+from portfolio_snapshot import portfolio_snapshot
+from rating_queue import rating_queue
+from rules import RuleSet, get_rules, reload_rules
+from portfolio import (get_average_credit_score, get_portfolio_totals, rebuild_portfolio_aggregate, backfill_ratings,
+                       rate_pending_mortgages, SCORING_COLUMNS, score_stored_rows, portfolio_stats, cached_portfolio_stats)
+
+# One app and one in-memory schema for the whole module; tests empty the tables
+# afterwards instead of dropping and recreating them
+app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': 'sqlite:///:memory:'})
+with app.app_context():
+    db.create_all()
+
+def clear_tables():
+    """Delete every row, in dependency order"""
+    with db.engine.begin() as connection:
+        for table in reversed(db.metadata.sorted_tables):
+            connection.execute(table.delete())
 
 class MortgageAPITestCase(unittest.TestCase):
     def setUp(self):
         # Set up test client and configure app for testing
         app.config['TESTING'] = True
-        app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///:memory:'
         self.app = app.test_client()
-        
-        # Create database tables in memory
-        with app.app_context():
-            db.create_all()
     
     def tearDown(self):
         # Clear database after each test
         with app.app_context():
             db.session.remove()
-            db.drop_all()
+            clear_tables()
+        # IDs are reused across tests, so cached mortgages must not outlive the database
+        mortgage_cache.clear()
     
     def test_create_mortgage(self):
         # Test creating a new mortgage
@@ -242,5 +274,1758 @@ class MortgageAPITestCase(unittest.TestCase):
         for component in expected_components:
             self.assertIn(component, components)
 
+class PortfolioAggregateTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+    
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+    
+    def post_mortgage(self, credit_score):
+        return self.app.post(
+            '/api/mortgages',
+            data=json.dumps({
+                'creditScore': credit_score,
+                'loanAmount': 300000,
+                'propertyValue': 400000,
+                'annualIncome': 80000,
+                'debtAmount': 20000,
+                'loanType': 'fixed',
+                'propertyType': 'single_family'
+            }),
+            content_type='application/json'
+        )
+    
+    def scanned_average(self, exclude_id=None):
+        # The full-table average the endpoints used to compute
+        mortgages = Mortgage.query.filter(Mortgage.id != exclude_id).all()
+        if not mortgages:
+            return None
+        return sum(m.credit_score for m in mortgages) / len(mortgages)
+    
+    def test_aggregate_tracks_writes(self):
+        for credit_score in (640, 701, 733):
+            self.post_mortgage(credit_score)
+        
+        with app.app_context():
+            db.session.add(Mortgage(credit_score=655, loan_amount=200000, property_value=250000,
+                                    annual_income=65000, debt_amount=30000, loan_type='adjustable',
+                                    property_type='condo'))
+            db.session.commit()
+            self.assertEqual(get_average_credit_score(), self.scanned_average())
+        
+        self.app.put('/api/mortgages/1', data=json.dumps({'creditScore': 590}),
+                     content_type='application/json')
+        self.app.delete('/api/mortgages/2')
+        
+        with app.app_context():
+            self.assertEqual(get_average_credit_score(), self.scanned_average())
+            mortgage = db.session.get(Mortgage, 3)
+            self.assertEqual(get_average_credit_score(exclude_score=mortgage.credit_score),
+                             self.scanned_average(exclude_id=3))
+    
+    def test_exclude_only_mortgage(self):
+        self.post_mortgage(720)
+        
+        with app.app_context():
+            self.assertEqual(get_average_credit_score(), 720)
+            self.assertIsNone(get_average_credit_score(exclude_score=720))
+    
+    def test_rebuild_aggregate(self):
+        for credit_score in (610, 690):
+            self.post_mortgage(credit_score)
+        
+        with app.app_context():
+            # Rows written behind the ORM's back are picked up by a rebuild
+            db.session.execute(Mortgage.__table__.update().values(credit_score=800))
+            db.session.commit()
+            self.assertEqual(get_average_credit_score(), 650)
+            
+            self.assertEqual(rebuild_portfolio_aggregate(), (1600, 2))
+            db.session.commit()
+            self.assertEqual(get_average_credit_score(), 800)
+
+    def test_missing_row_created_once(self):
+        for credit_score in (610, 690):
+            self.post_mortgage(credit_score)
+        aggregate = db.metadata.tables['portfolio_aggregate']
+        
+        with app.app_context():
+            db.session.execute(aggregate.delete())
+            db.session.commit()
+            # A read-only caller never commits, but the row it creates is kept
+            self.assertEqual(get_portfolio_totals(), (1300, 2))
+            db.session.rollback()
+            self.assertEqual(db.session.execute(select(aggregate.c.credit_score_sum)).scalars().all(), [1300])
+    
+    def test_concurrent_first_write(self):
+        aggregate = db.metadata.tables['portfolio_aggregate']
+        
+        def create_row(connection, cursor, statement, parameters, context, executemany):
+            # Another writer creates the row just before this one tries to
+            if statement.startswith('SAVEPOINT'):
+                cursor.execute("INSERT INTO portfolio_aggregate (id, credit_score_sum, mortgage_count) VALUES (1, 1400, 2)")
+        
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', create_row)
+            try:
+                db.session.add(Mortgage(credit_score=640, loan_amount=200000, property_value=250000,
+                                        annual_income=65000, debt_amount=30000, loan_type='adjustable',
+                                        property_type='condo'))
+                db.session.commit()
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', create_row)
+            self.assertEqual(db.session.execute(
+                select(aggregate.c.credit_score_sum, aggregate.c.mortgage_count)).all(), [(2040, 3)])
+
+class BatchScoringTestCase(unittest.TestCase):
+    def random_mortgages(self, count, seed=1234):
+        rng = random.Random(seed)
+        return [{
+            'creditScore': rng.randint(550, 820),
+            # Zero denominators exercise the max-risk fallbacks
+            'loanAmount': rng.choice([0, rng.uniform(50000, 900000)]),
+            'propertyValue': rng.choice([0, rng.uniform(50000, 900000), rng.uniform(50000, 900000)]),
+            'annualIncome': rng.choice([0, rng.uniform(20000, 250000), rng.uniform(20000, 250000)]),
+            'debtAmount': rng.uniform(0, 150000),
+            'loanType': rng.choice(['fixed', 'adjustable']),
+            'propertyType': rng.choice(['single_family', 'condo'])
+        } for _ in range(count)]
+    
+    def test_batch_matches_scalar_scoring(self):
+        mortgages = self.random_mortgages(500)
+        rng = random.Random(99)
+        averages = [rng.uniform(600, 760) for _ in mortgages]
+        
+        scores = calculate_risk_scores_batch(mortgages, averages)
+        ratings = calculate_credit_ratings_batch(scores['total'])
+        
+        for i, mortgage in enumerate(mortgages):
+            risk_score = calculate_risk_score(mortgage, averages[i])
+            self.assertEqual(scores['total'][i], risk_score)
+            self.assertEqual(ratings[i], calculate_credit_rating(risk_score))
+    
+    def test_batch_accepts_column_dict(self):
+        mortgages = self.random_mortgages(200, seed=42)
+        columns = {key: [m[key] for m in mortgages] for key in mortgages[0]}
+        
+        # Without an average each loan's own credit score is used, as in the scalar path
+        scores = calculate_risk_scores_batch(columns)
+        expected = [calculate_risk_score(m) for m in mortgages]
+        self.assertEqual(scores['total'].tolist(), expected)
+        
+        expected_components = ['loanToValue', 'debtToIncome', 'creditScore',
+                               'loanType', 'propertyType', 'avgCreditScore']
+        for component in expected_components:
+            self.assertEqual(len(scores[component]), 200)
+    
+    def test_batch_zero_denominators(self):
+        scores = calculate_risk_scores_batch({
+            'loanAmount': [100000, 0],
+            'propertyValue': [0, 0],
+            'debtAmount': [0, 0],
+            'annualIncome': [0, 50000],
+            'creditScore': [700, 700]
+        })
+        self.assertEqual(scores['loanToValue'].tolist(), [2, 2])
+        self.assertEqual(scores['debtToIncome'].tolist(), [2, 0])
+
+class BulkMortgageAPITestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+    
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+    
+    def mortgage(self, credit_score, loan_type='fixed'):
+        return {
+            'creditScore': credit_score,
+            'loanAmount': 300000,
+            'propertyValue': 400000,
+            'annualIncome': 80000,
+            'debtAmount': 20000,
+            'loanType': loan_type,
+            'propertyType': 'single_family'
+        }
+    
+    def test_bulk_create_json_array(self):
+        incomplete = self.mortgage(700)
+        del incomplete['propertyValue']
+        rows = [self.mortgage(750), incomplete, self.mortgage(600, 'adjustable')]
+        
+        response = self.app.post(
+            '/api/mortgages/bulk',
+            data=json.dumps(rows),
+            content_type='application/json'
+        )
+        
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(data['inserted'], 2)
+        self.assertEqual(data['failed'], 1)
+        self.assertIn('Missing required field', data['results'][1]['error'])
+        
+        # Every row is rated against the portfolio average from before the batch
+        for index in (0, 2):
+            risk_score = calculate_risk_score(rows[index], rows[index]['creditScore'])
+            self.assertEqual(data['results'][index]['riskScore'], risk_score)
+            self.assertEqual(data['results'][index]['creditRating'], calculate_credit_rating(risk_score))
+        
+        with app.app_context():
+            self.assertEqual(Mortgage.query.count(), 2)
+            self.assertEqual(get_average_credit_score(), 675)
+    
+    def test_bulk_create_ndjson(self):
+        self.app.post('/api/mortgages', data=json.dumps(self.mortgage(720)),
+                      content_type='application/json')
+        rows = [self.mortgage(640), self.mortgage(680)]
+        
+        response = self.app.post(
+            '/api/mortgages/bulk',
+            data='\n'.join(json.dumps(row) for row in rows) + '\n',
+            content_type='application/x-ndjson'
+        )
+        
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(data['inserted'], 2)
+        for index, row in enumerate(rows):
+            self.assertEqual(data['results'][index]['riskScore'], calculate_risk_score(row, 720))
+        
+        with app.app_context():
+            self.assertEqual(Mortgage.query.count(), 3)
+            self.assertEqual(get_average_credit_score(), 680)
+    
+    def test_bulk_create_invalid_body(self):
+        response = self.app.post('/api/mortgages/bulk', data='{not json',
+                                 content_type='application/x-ndjson')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', json.loads(response.data))
+
+class MortgagePaginationTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        
+        with app.app_context():
+            for credit_score in range(600, 605):
+                db.session.add(Mortgage(credit_score=credit_score, loan_amount=300000, property_value=400000,
+                                        annual_income=80000, debt_amount=20000, loan_type='fixed',
+                                        property_type='single_family'))
+            db.session.commit()
+    
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+    
+    def test_keyset_pages(self):
+        response = self.app.get('/api/mortgages?limit=2')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['id'] for m in data], [1, 2])
+        self.assertEqual(response.headers['X-Next-After-Id'], '2')
+        
+        response = self.app.get('/api/mortgages?limit=2&after_id=4')
+        data = json.loads(response.data)
+        self.assertEqual([m['id'] for m in data], [5])
+        self.assertNotIn('X-Next-After-Id', response.headers)
+    
+    def test_stream_ndjson(self):
+        response = self.app.get('/api/mortgages?format=ndjson&after_id=1')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        
+        lines = response.data.decode().splitlines()
+        self.assertEqual([json.loads(line)['creditScore'] for line in lines], [601, 602, 603, 604])
+    
+    def test_stream_json_array(self):
+        response = self.app.get('/api/mortgages')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([m['id'] for m in data], [1, 2, 3, 4, 5])
+    
+    def test_invalid_limit(self):
+        response = self.app.get('/api/mortgages?limit=abc')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('error', json.loads(response.data))
+
+class StoredRatingTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+    
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+        mortgage_cache.clear()
+    
+    def add_unrated_mortgages(self):
+        with app.app_context():
+            db.session.add_all([
+                Mortgage(credit_score=760, loan_amount=200000, property_value=400000, annual_income=90000,
+                         debt_amount=10000, loan_type='fixed', property_type='single_family'),
+                Mortgage(credit_score=600, loan_amount=380000, property_value=400000, annual_income=50000,
+                         debt_amount=30000, loan_type='adjustable', property_type='condo'),
+                Mortgage(credit_score=680, loan_amount=340000, property_value=400000, annual_income=70000,
+                         debt_amount=30000, loan_type='adjustable', property_type='single_family')
+            ])
+            db.session.commit()
+    
+    def test_create_stores_rating(self):
+        response = self.app.post('/api/mortgages', data=json.dumps({
+            'creditScore': 600, 'loanAmount': 380000, 'propertyValue': 400000, 'annualIncome': 50000,
+            'debtAmount': 30000, 'loanType': 'adjustable', 'propertyType': 'condo'
+        }), content_type='application/json')
+        data = json.loads(response.data)
+        self.assertEqual(data['mortgage']['creditRating'], data['creditRating'])
+        
+        with app.app_context():
+            mortgage = db.session.get(Mortgage, data['mortgage']['id'])
+            self.assertEqual(mortgage.credit_rating, 'C')
+            self.assertEqual(mortgage.risk_score, 8)
+    
+    def test_backfill_matches_update(self):
+        self.add_unrated_mortgages()
+        
+        with app.app_context():
+            self.assertEqual(backfill_ratings(chunk_size=2), 3)
+            backfilled = {m.id: (m.risk_score, m.credit_rating) for m in Mortgage.query.all()}
+            # Nothing is left to backfill
+            self.assertEqual(backfill_ratings(chunk_size=2), 0)
+        
+        # Re-submitting each loan unchanged stores the same rating as the backfill
+        for mortgage_id, (risk_score, credit_rating) in backfilled.items():
+            response = self.app.get(f'/api/mortgages/{mortgage_id}')
+            response = self.app.put(f'/api/mortgages/{mortgage_id}', data=response.data,
+                                    content_type='application/json')
+            data = json.loads(response.data)
+            self.assertEqual(data['mortgage']['riskScore'], risk_score)
+            self.assertEqual(data['creditRating'], credit_rating)
+    
+    def test_partial_update_matches_backfill(self):
+        self.add_unrated_mortgages()
+        
+        # Fields left out of the request are scored from the stored record, not defaults
+        response = self.app.put('/api/mortgages/1', data=json.dumps({'creditScore': 755}),
+                                content_type='application/json')
+        data = json.loads(response.data)
+        
+        with app.app_context():
+            backfill_ratings(only_missing=False)
+            mortgage = db.session.get(Mortgage, 1)
+            self.assertEqual((data['mortgage']['riskScore'], data['creditRating']),
+                             (mortgage.risk_score, mortgage.credit_rating))
+    
+    def test_filter_by_rating(self):
+        self.add_unrated_mortgages()
+        with app.app_context():
+            backfill_ratings()
+        
+        response = self.app.get('/api/mortgages?rating=C')
+        data = json.loads(response.data)
+        self.assertEqual([m['id'] for m in data], [2])
+        
+        response = self.app.get('/api/mortgages?rating=AAA&limit=1')
+        data = json.loads(response.data)
+        self.assertEqual([m['id'] for m in data], [1])
+        self.assertEqual(response.headers['X-Next-After-Id'], '1')
+
+class RatingHistoryTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        self.mortgage = {
+            'creditScore': 760, 'loanAmount': 200000, 'propertyValue': 400000, 'annualIncome': 90000,
+            'debtAmount': 10000, 'loanType': 'fixed', 'propertyType': 'single_family'
+        }
+    
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+        mortgage_cache.clear()
+    
+    def checkpoint(self):
+        """A timestamp strictly between the writes before and after it"""
+        time.sleep(0.002)
+        moment = datetime.utcnow()
+        time.sleep(0.002)
+        return moment.isoformat()
+    
+    def ratings_as_of(self, as_of, **params):
+        response = self.app.get('/api/portfolio/ratings', query_string=dict(params, asOf=as_of))
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+    
+    def test_book_as_of_each_write(self):
+        before = self.checkpoint()
+        first = json.loads(self.app.post('/api/mortgages', json=self.mortgage).data)['mortgage']['id']
+        second = json.loads(self.app.post('/api/mortgages', json=self.mortgage).data)['mortgage']['id']
+        created = self.checkpoint()
+        response = self.app.put(f'/api/mortgages/{first}', json=dict(self.mortgage, creditScore=600, loanAmount=380000,
+                                                                    annualIncome=50000, debtAmount=30000))
+        rating = json.loads(response.data)['creditRating']
+        self.assertNotEqual(rating, 'AAA')
+        updated = self.checkpoint()
+        self.app.delete(f'/api/mortgages/{second}')
+        
+        self.assertEqual(self.ratings_as_of(before)['loanCount'], 0)
+        self.assertEqual(self.ratings_as_of(created)['distribution'], {'AAA': 2})
+        self.assertEqual(self.ratings_as_of(updated)['distribution'], {'AAA': 1, rating: 1})
+        now = datetime.utcnow().isoformat() + 'Z'
+        self.assertEqual(self.ratings_as_of(now)['distribution'], {rating: 1})
+        page = self.ratings_as_of(now, limit=10)
+        self.assertEqual([(m['id'], m['creditRating']) for m in page['mortgages']], [(first, rating)])
+        
+        # The deleted loan keeps its history
+        history = json.loads(self.app.get(f'/api/mortgages/{second}/history').data)['history']
+        self.assertEqual([entry['event'] for entry in history], ['created', 'deleted'])
+    
+    def test_pages_and_bulk_writes(self):
+        self.app.post('/api/mortgages/bulk', json=[self.mortgage] * 5)
+        with app.app_context():
+            db.session.add(Mortgage(credit_score=600, loan_amount=380000, property_value=400000, annual_income=50000,
+                                    debt_amount=30000, loan_type='adjustable', property_type='condo'))
+            db.session.commit()
+            pending = self.checkpoint()
+            rate_pending_mortgages([6])
+        
+        self.assertEqual(self.ratings_as_of(pending)['distribution'], {'AAA': 5, 'pending': 1})
+        now = datetime.utcnow().isoformat()
+        page = self.ratings_as_of(now, limit=4)
+        self.assertEqual([m['id'] for m in page['mortgages']], [1, 2, 3, 4])
+        page = self.ratings_as_of(now, limit=4, after_id=page['nextAfterId'])
+        self.assertEqual([(m['id'], m['creditRating']) for m in page['mortgages']], [(5, 'AAA'), (6, 'C')])
+        self.assertIsNone(page['nextAfterId'])
+    
+    def test_bulk_writes_without_returning(self):
+        from io import BytesIO
+        statements = []
+        
+        def capture(connection, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        
+        with app.app_context():
+            # As on MySQL, which has no INSERT .. RETURNING
+            dialect = db.engine.dialect
+            self.addCleanup(setattr, dialect, 'insert_executemany_returning', dialect.insert_executemany_returning)
+            dialect.insert_executemany_returning = False
+            event.listen(db.engine, 'before_cursor_execute', capture)
+            self.addCleanup(event.remove, db.engine, 'before_cursor_execute', capture)
+        
+        self.assertEqual(self.app.post('/api/mortgages/bulk', json=[self.mortgage] * 3).status_code, 201)
+        # One row keeps its own ID, the others are assigned one
+        lines = ['id,credit_score,loan_amount,property_value,annual_income,debt_amount,loan_type,property_type',
+                 '10,700,100000,200000,50000,1000,fixed,condo', ',650,100000,200000,50000,1000,fixed,condo',
+                 ',640,100000,200000,50000,1000,fixed,condo']
+        response = self.app.post('/api/mortgages/import?keep_ids=true',
+                                 data={'file': (BytesIO('\n'.join(lines).encode()), 'book.csv')})
+        self.assertEqual(response.status_code, 201)
+        
+        self.assertFalse([statement for statement in statements if 'RETURNING' in statement])
+        with app.app_context():
+            created = db.session.execute(
+                select(MortgageRatingHistory.mortgage_id, MortgageRatingHistory.credit_rating)
+                .where(MortgageRatingHistory.event == 'created').order_by(MortgageRatingHistory.mortgage_id)
+            ).all()
+            stored = db.session.execute(select(Mortgage.id, Mortgage.credit_rating).order_by(Mortgage.id)).all()
+        self.assertEqual([tuple(row) for row in created], [tuple(row) for row in stored])
+        self.assertEqual([row[0] for row in stored], [1, 2, 3, 10, 11, 12])
+    
+    def test_rolled_back_write_leaves_no_history(self):
+        with app.app_context():
+            db.session.add(Mortgage(credit_score=700, loan_amount=200000, property_value=400000, annual_income=90000,
+                                    debt_amount=10000, loan_type='fixed', property_type='condo'))
+            db.session.flush()
+            db.session.rollback()
+            self.assertEqual(db.session.query(MortgageRatingHistory).count(), 0)
+    
+    def test_seed_existing_book(self):
+        with app.app_context():
+            db.session.add(Mortgage(credit_score=700, loan_amount=200000, property_value=400000, annual_income=90000,
+                                    debt_amount=10000, loan_type='fixed', property_type='condo'))
+            db.session.commit()
+            # A book that predates the history table
+            db.session.query(MortgageRatingHistory).delete()
+            db.session.commit()
+        result = app.test_cli_runner().invoke(args=['seed-rating-history'])
+        self.assertIn('Seeded rating history for 1 mortgages', result.output)
+        with app.app_context():
+            self.assertEqual(seed_rating_history(), 0)
+        history = json.loads(self.app.get('/api/mortgages/1/history').data)['history']
+        self.assertEqual([entry['event'] for entry in history], ['created'])
+    
+    def test_invalid_as_of(self):
+        for params in ({}, {'asOf': 'last quarter'}, {'asOf': '2026-01-01', 'limit': 0}):
+            self.assertEqual(self.app.get('/api/portfolio/ratings', query_string=params).status_code, 400)
+        self.assertEqual(self.app.get('/api/mortgages/999/history').status_code, 404)
+
+class ChangeFeedTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        self.mortgage = {
+            'creditScore': 760, 'loanAmount': 200000, 'propertyValue': 400000, 'annualIncome': 90000,
+            'debtAmount': 10000, 'loanType': 'fixed', 'propertyType': 'single_family'
+        }
+        self.buffer_size = config.CHANGE_FEED_BUFFER_SIZE
+        self.max_subscribers = config.CHANGE_FEED_MAX_SUBSCRIBERS
+        self.reorder_window = config.CHANGE_FEED_REORDER_WINDOW
+    
+    def tearDown(self):
+        config.CHANGE_FEED_BUFFER_SIZE = self.buffer_size
+        config.CHANGE_FEED_MAX_SUBSCRIBERS = self.max_subscribers
+        config.CHANGE_FEED_REORDER_WINDOW = self.reorder_window
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+        mortgage_cache.clear()
+    
+    def open_stream(self, **kwargs):
+        response = self.app.get('/api/mortgages/changes', buffered=False, **kwargs)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.addCleanup(response.close)
+        return iter(response.response)
+    
+    def read_events(self, stream, count):
+        events = []
+        while len(events) < count:
+            message = next(stream).decode()
+            if message.startswith(':'):
+                continue
+            event_id, data = message.strip().split('\n')
+            event = json.loads(data.removeprefix('data: '))
+            self.assertEqual(event_id, f"id: {event['id']}")
+            events.append(event)
+        return events
+    
+    def test_resume_after_last_event_id(self):
+        first = json.loads(self.app.post('/api/mortgages', json=self.mortgage).data)['mortgage']['id']
+        second = json.loads(self.app.post('/api/mortgages', json=self.mortgage).data)['mortgage']['id']
+        updated = json.loads(self.app.put(f'/api/mortgages/{first}', json=dict(self.mortgage, debtAmount=20000)).data)
+        self.app.delete(f'/api/mortgages/{second}')
+        
+        events = self.read_events(self.open_stream(headers={'Last-Event-ID': '0'}), 4)
+        self.assertEqual([(event['mortgageId'], event['event']) for event in events],
+                         [(first, 'created'), (second, 'created'), (first, 'updated'), (second, 'deleted')])
+        # Replayed events carry the mortgage as it is now
+        self.assertEqual(events[0]['mortgage'], updated['mortgage'])
+        self.assertIsNone(events[1]['mortgage'])
+        
+        # With no reorder window, exactly the events after the last one seen
+        config.CHANGE_FEED_REORDER_WINDOW = 0
+        resumed = self.read_events(self.open_stream(query_string={'lastEventId': events[1]['id']}), 2)
+        self.assertEqual(resumed, events[2:])
+    
+    def test_resume_picks_up_late_commits(self):
+        # Entry 2 was written before entry 3 but committed after the client saw 3
+        now = datetime.utcnow()
+        entry = {'mortgage_id': 1, 'event': 'rated', 'risk_score': 0, 'credit_rating': 'AAA'}
+        with app.app_context():
+            db.session.execute(MortgageRatingHistory.__table__.insert(), [
+                dict(entry, id=1, created_at=now - timedelta(seconds=60)), dict(entry, id=3, created_at=now)
+            ])
+            db.session.commit()
+            db.session.execute(MortgageRatingHistory.__table__.insert(),
+                               dict(entry, id=2, created_at=now - timedelta(seconds=1)))
+            db.session.commit()
+        
+        stream = self.open_stream(headers={'Last-Event-ID': '3'})
+        self.assertEqual([event['id'] for event in self.read_events(stream, 2)], [2, 3])
+    
+    def test_stream_opened_before_commit(self):
+        with app.app_context():
+            db.session.add(Mortgage(credit_score=700, loan_amount=200000, property_value=400000, annual_income=90000,
+                                    debt_amount=10000, loan_type='fixed', property_type='condo'))
+            db.session.flush()
+            # The write is flushed, but not committed, when the stream opens
+            stream = self.open_stream()
+            db.session.commit()
+        event, = self.read_events(stream, 1)
+        self.assertEqual(event['event'], 'created')
+    
+    def test_lag_resumes_from_lowest_dropped_id(self):
+        subscription = Subscription(2)
+        self.assertFalse(subscription.push([{'id': 7}]))
+        # IDs commit out of order: 5 arrives after 7 and overflows the buffer
+        self.assertTrue(subscription.push([{'id': 5}, {'id': 6}]))
+        self.assertFalse(subscription.push([{'id': 4}]))
+        self.assertEqual(subscription.get(0), ([], 4))
+        self.assertEqual(subscription.get(0), ([], None))
+    
+    def test_live_events(self):
+        stream = self.open_stream()
+        self.assertEqual(change_feed.stats()['subscribers'], 1)
+        # A rolled-back write is never published
+        with app.app_context():
+            db.session.add(Mortgage(credit_score=700, loan_amount=200000, property_value=400000, annual_income=90000,
+                                    debt_amount=10000, loan_type='fixed', property_type='condo'))
+            db.session.flush()
+            db.session.rollback()
+        created = json.loads(self.app.post('/api/mortgages', json=self.mortgage).data)
+        
+        event, = self.read_events(stream, 1)
+        self.assertEqual(event['event'], 'created')
+        self.assertEqual(event['creditRating'], created['creditRating'])
+        self.assertEqual(event['mortgage'], created['mortgage'])
+        self.doCleanups()
+        self.assertEqual(change_feed.stats()['subscribers'], 0)
+    
+    def test_lagging_stream_catches_up(self):
+        config.CHANGE_FEED_BUFFER_SIZE = 2
+        stream = self.open_stream()
+        lagged = change_feed.stats()['lagged']
+        self.app.post('/api/mortgages/bulk', json=[self.mortgage] * 5)
+        
+        # The five events overflow the buffer, so the stream reads them from the history table
+        events = self.read_events(stream, 5)
+        self.assertEqual(change_feed.stats()['lagged'], lagged + 1)
+        self.assertEqual([event['mortgageId'] for event in events], [1, 2, 3, 4, 5])
+        self.assertEqual(events[4]['mortgage']['creditRating'], events[4]['creditRating'])
+    
+    def test_rejected_streams(self):
+        response = self.app.get('/api/mortgages/changes', headers={'Last-Event-ID': 'latest'})
+        self.assertEqual(response.status_code, 400)
+        config.CHANGE_FEED_MAX_SUBSCRIBERS = 0
+        self.assertEqual(self.app.get('/api/mortgages/changes').status_code, 503)
+
+class RatingGridTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        self.applicant = {
+            'creditScore': 690, 'loanAmount': 300000, 'propertyValue': 380000, 'annualIncome': 85000,
+            'debtAmount': 30000, 'loanType': 'adjustable', 'propertyType': 'condo'
+        }
+        self.app.post('/api/mortgages', json=dict(self.applicant, creditScore=720))
+    
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+        mortgage_cache.clear()
+    
+    def test_grid_matches_single_ratings(self):
+        response = self.app.post('/api/calculate-rating/grid', json={
+            'applicant': self.applicant,
+            'loanAmount': {'min': 200000, 'max': 400000, 'steps': 5},
+            'downPayment': {'min': 20000, 'max': 120000, 'steps': 4},
+            'debtAmount': {'min': 0, 'max': 60000, 'steps': 3}
+        })
+        self.assertEqual(response.status_code, 200)
+        # A single read of the portfolio average
+        self.assertIn('sql;desc="1 queries"', response.headers['Server-Timing'])
+        grid = json.loads(response.data)
+        self.assertEqual(grid['shape'], [5, 4, 3])
+        self.assertEqual(len(grid['creditRating']), 60)
+        
+        for i, j, k in ((0, 0, 0), (2, 1, 2), (4, 3, 1)):
+            loan_amount = grid['axes']['loanAmount'][i]
+            data = dict(self.applicant, loanAmount=loan_amount, debtAmount=grid['axes']['debtAmount'][k],
+                        propertyValue=loan_amount + grid['axes']['downPayment'][j])
+            single = json.loads(self.app.post('/api/calculate-rating', json=data).data)
+            cell = i * 12 + j * 3 + k
+            self.assertEqual(grid['creditRating'][cell], single['creditRating'])
+            self.assertEqual(grid['riskScore'][cell], single['riskScore'])
+            self.assertEqual({name: values[cell] for name, values in grid['components'].items()},
+                             single['components'])
+    
+    def test_omitted_axes_use_applicant(self):
+        grid = json.loads(self.app.post('/api/calculate-rating/grid', json={
+            'applicant': self.applicant, 'debtAmount': {'min': 0, 'max': 50000, 'steps': 6}
+        }).data)
+        self.assertEqual(grid['shape'], [1, 1, 6])
+        self.assertEqual(grid['axes']['downPayment'], [80000])
+    
+    def test_invalid_grid_rejected(self):
+        too_large = {'min': 0, 'max': 1, 'steps': 200}
+        for body in ({'loanAmount': too_large},
+                     {'applicant': {'creditScore': 700}},
+                     {'applicant': self.applicant, 'loanAmount': too_large, 'debtAmount': too_large},
+                     {'applicant': self.applicant, 'debtAmount': {'min': 5, 'max': 1, 'steps': 2}}):
+            self.assertEqual(self.app.post('/api/calculate-rating/grid', json=body).status_code, 400)
+
+class RatingCacheTestCase(unittest.TestCase):
+    def mortgage(self, **overrides):
+        mortgage = {
+            'creditScore': 720,
+            'loanAmount': 300000,
+            'propertyValue': 400000,
+            'annualIncome': 80000,
+            'debtAmount': 20000,
+            'loanType': 'fixed',
+            'propertyType': 'single_family'
+        }
+        mortgage.update(overrides)
+        return mortgage
+    
+    def test_same_bands_hit_cache(self):
+        cache = RatingCache(max_size=10)
+        first = cache.get_or_compute(self.mortgage(), 710)
+        # Slightly different inputs in the same LTV, DTI and credit bands
+        second = cache.get_or_compute(self.mortgage(loanAmount=310000, creditScore=745), 705)
+        
+        self.assertIs(first, second)
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(cache.stats()['misses'], 1)
+        
+        components, risk_score = calculate_risk_components(self.mortgage(loanAmount=310000, creditScore=745), 705)
+        self.assertEqual(second, (components, risk_score, calculate_credit_rating(risk_score)))
+    
+    def test_cached_results_match_scoring(self):
+        cache = RatingCache(max_size=3)
+        inputs = [self.mortgage(loanAmount=amount, creditScore=score, propertyValue=value)
+                  for amount in (0, 300000, 340000, 380000)
+                  for score in (600, 660, 720)
+                  for value in (0, 400000)]
+        for _ in range(2):
+            for mortgage in inputs:
+                components, risk_score, credit_rating = cache.get_or_compute(mortgage, 680)
+                self.assertEqual(risk_score, calculate_risk_score(mortgage, 680))
+                self.assertEqual(credit_rating, calculate_credit_rating(risk_score))
+        self.assertLessEqual(cache.stats()['size'], 3)
+    
+    def test_average_band_change_invalidates(self):
+        cache = RatingCache(max_size=10)
+        cache.get_or_compute(self.mortgage(), 710)
+        cache.get_or_compute(self.mortgage(), 690)
+        components, risk_score, credit_rating = cache.get_or_compute(self.mortgage(), 690)
+        
+        self.assertEqual(components['avgCreditScore'], 0)
+        self.assertEqual(cache.stats()['misses'], 2)
+        self.assertEqual(cache.stats()['invalidations'], 1)
+    
+    def test_cache_stats_endpoint(self):
+        response = app.test_client().get('/api/calculate-rating/cache')
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        for key in ('hits', 'misses', 'hitRate', 'size', 'maxSize'):
+            self.assertIn(key, data)
+
+class RuleSetTestCase(unittest.TestCase):
+    def setUp(self):
+        with open(config.RULES_FILE) as f:
+            self.spec = json.load(f)
+        self.rules_file = config.RULES_FILE
+        self.reload_interval = config.RULES_RELOAD_INTERVAL
+    
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+        config.RULES_FILE = self.rules_file
+        config.RULES_RELOAD_INTERVAL = self.reload_interval
+        reload_rules()
+    
+    def test_thresholds_match_original_branches(self):
+        rules = get_rules()
+        # Boundary values on both sides of every original cutoff
+        for ltv in (0, 79.99, 80, 80.01, 90, 90.01, 150):
+            self.assertEqual(rules.loan_to_value.lookup(ltv), 2 if ltv > 90 else 1 if ltv > 80 else 0)
+        for score in (300, 649, 650, 699, 700, 850):
+            self.assertEqual(rules.credit_score.lookup(score), -1 if score >= 700 else 0 if score >= 650 else 1)
+            self.assertEqual(rules.avg_credit_score.lookup(score), -1 if score >= 700 else 1 if score < 650 else 0)
+        for risk_score in range(-4, 10):
+            self.assertEqual(rules.rating.lookup(risk_score),
+                             "AAA" if risk_score <= 2 else "BBB" if risk_score <= 5 else "C")
+        self.assertEqual(rules.loan_type.lookup('fixed'), -1)
+        self.assertEqual(rules.loan_type.lookup('adjustable'), 1)
+        self.assertEqual(rules.loan_to_value.lookup_batch([80, 80.5, 91]).tolist(), [0, 1, 2])
+    
+    def test_invalid_rules_rejected(self):
+        self.spec['creditScore']['breakpoints'] = [700, 650]
+        with self.assertRaises(ValueError):
+            RuleSet(self.spec)
+    
+    def test_infinite_breakpoints(self):
+        # Python's json module reads Infinity, which the compiled lookup must not write out as source
+        spec = json.loads(json.dumps(self.spec).replace('"breakpoints": [80, 90]', '"breakpoints": [80, Infinity]', 1))
+        rules = RuleSet(spec)
+        for ltv in (79, 81, 1e308, float('inf')):
+            self.assertEqual(rules.loan_to_value.lookup(ltv), rules.loan_to_value.outcomes[rules.loan_to_value.band(ltv)])
+        self.assertEqual(rules.loan_to_value.lookup_batch([79, 81, float('inf')]).tolist(), [0, 1, 1])
+        
+        self.spec['creditScore']['breakpoints'] = [650, float('nan')]
+        with self.assertRaises(ValueError):
+            RuleSet(self.spec)
+    
+    def test_hot_reload(self):
+        handle, path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        with open(path, 'w') as f:
+            json.dump(self.spec, f)
+        config.RULES_FILE = path
+        config.RULES_RELOAD_INTERVAL = 0
+        reload_rules()
+        
+        # Tighten the AAA cutoff and publish a new version
+        self.spec['version'] = 'tightened'
+        self.spec['rating']['breakpoints'] = [0, 5]
+        with open(path, 'w') as f:
+            json.dump(self.spec, f)
+        os.utime(path, (time.time() + 10, time.time() + 10))
+        
+        response = app.test_client().post('/api/calculate-rating', data=json.dumps({
+            'creditScore': 600, 'loanAmount': 300000, 'propertyValue': 400000, 'annualIncome': 80000,
+            'debtAmount': 20000, 'loanType': 'fixed', 'propertyType': 'single_family'
+        }), content_type='application/json')
+        data = json.loads(response.data)
+        self.assertEqual(data['ruleSetVersion'], 'tightened')
+        self.assertEqual(data['riskScore'], 1)
+        self.assertEqual(data['creditRating'], 'BBB')
+    
+    def test_malformed_reload_keeps_last_rules(self):
+        handle, path = tempfile.mkstemp(suffix='.json')
+        os.close(handle)
+        self.addCleanup(os.remove, path)
+        with open(path, 'w') as f:
+            json.dump(self.spec, f)
+        config.RULES_FILE = path
+        config.RULES_RELOAD_INTERVAL = 0
+        version = reload_rules().version
+        
+        malformed = [
+            json.dumps(dict(self.spec, loanToValue={'breakpoints': None, 'scores': [0]})),
+            json.dumps(dict(self.spec, creditScore={'breakpoints': [650, 'high'], 'scores': [1, 0, -1]})),
+            json.dumps(dict(self.spec, rating=['AAA', 'BBB'])),
+            '{"version": '
+        ]
+        for index, content in enumerate(malformed):
+            with open(path, 'w') as f:
+                f.write(content)
+            os.utime(path, (time.time() + 10 + index, time.time() + 10 + index))
+            
+            response = app.test_client().post('/api/calculate-rating', data=json.dumps({
+                'creditScore': 600, 'loanAmount': 300000, 'propertyValue': 400000, 'annualIncome': 80000,
+                'debtAmount': 20000, 'loanType': 'fixed', 'propertyType': 'single_family'
+            }), content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data)['ruleSetVersion'], version)
+
+class AsyncReadTestCase(unittest.TestCase):
+    def setUp(self):
+        import asgi
+        self.asgi = asgi
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.database_uri = config.SQLALCHEMY_DATABASE_URI
+        config.SQLALCHEMY_DATABASE_URI = f"sqlite:///{self.path}"
+        
+        engine = create_engine(config.SQLALCHEMY_DATABASE_URI)
+        db.metadata.create_all(engine)
+        with engine.begin() as connection:
+            connection.execute(Mortgage.__table__.insert(), [
+                {'credit_score': score, 'loan_amount': 300000, 'property_value': 400000, 'annual_income': 80000,
+                 'debt_amount': 20000, 'loan_type': 'fixed', 'property_type': 'single_family'}
+                for score in (700, 710, 720)
+            ])
+        engine.dispose()
+    
+    def tearDown(self):
+        if self.asgi._engine is not None:
+            asyncio.run(self.asgi._engine.dispose())
+        self.asgi._engine = None
+        self.asgi._sessionmaker = None
+        config.SQLALCHEMY_DATABASE_URI = self.database_uri
+        os.remove(self.path)
+        mortgage_cache.clear()
+    
+    def request(self, path, query_string=b''):
+        messages = []
+        
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        
+        async def send(message):
+            messages.append(message)
+        
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query_string, 'headers': []}
+        asyncio.run(self.asgi.application(scope, receive, send))
+        headers = dict(messages[0]['headers'])
+        return messages[0]['status'], headers, json.loads(messages[1]['body'])
+    
+    def test_async_get_mortgage(self):
+        status, headers, data = self.request('/api/mortgages/2')
+        self.assertEqual(status, 200)
+        self.assertEqual(data['creditScore'], 710)
+        self.assertEqual(headers[b'access-control-allow-origin'], b'*')
+        
+        status, headers, data = self.request('/api/mortgages/99')
+        self.assertEqual(status, 404)
+        self.assertEqual(data['error'], 'Mortgage not found')
+    
+    def test_async_etag(self):
+        status, headers, data = self.request('/api/mortgages/1')
+        etag = headers[b'etag']
+        
+        messages = []
+        
+        async def receive():
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        
+        async def send(message):
+            messages.append(message)
+        
+        scope = {'type': 'http', 'method': 'GET', 'path': '/api/mortgages/1', 'query_string': b'',
+                 'headers': [(b'if-none-match', etag)]}
+        asyncio.run(self.asgi.application(scope, receive, send))
+        self.assertEqual(messages[0]['status'], 304)
+        self.assertEqual(messages[1]['body'], b'')
+    
+    def test_async_page(self):
+        status, headers, data = self.request('/api/mortgages', b'limit=2')
+        self.assertEqual(status, 200)
+        self.assertEqual([m['id'] for m in data], [1, 2])
+        self.assertEqual(headers[b'x-next-after-id'], b'2')
+        
+        status, headers, data = self.request('/api/mortgages', b'limit=0')
+        self.assertEqual(status, 400)
+
+class MortgageCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        response = self.app.post('/api/mortgages', data=json.dumps({
+            'creditScore': 700, 'loanAmount': 300000, 'propertyValue': 400000, 'annualIncome': 80000,
+            'debtAmount': 20000, 'loanType': 'fixed', 'propertyType': 'single_family'
+        }), content_type='application/json')
+        self.mortgage_id = json.loads(response.data)['mortgage']['id']
+        mortgage_cache.clear()
+    
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+        mortgage_cache.clear()
+    
+    def test_second_read_is_cached(self):
+        before = json.loads(self.app.get('/api/mortgages/cache').data)
+        first = self.app.get(f'/api/mortgages/{self.mortgage_id}')
+        second = self.app.get(f'/api/mortgages/{self.mortgage_id}')
+        self.assertEqual(first.data, second.data)
+        self.assertEqual(json.loads(second.data)['creditScore'], 700)
+        
+        stats = json.loads(self.app.get('/api/mortgages/cache').data)
+        self.assertEqual((stats['hits'] - before['hits'], stats['misses'] - before['misses']), (1, 1))
+        self.assertEqual(stats['size'], 1)
+        self.assertIn('hitRate', stats)
+    
+    def test_if_none_match_returns_304(self):
+        etag = self.app.get(f'/api/mortgages/{self.mortgage_id}').headers['ETag']
+        response = self.app.get(f'/api/mortgages/{self.mortgage_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        
+        response = self.app.get(f'/api/mortgages/{self.mortgage_id}', headers={'If-None-Match': '"stale"'})
+        self.assertEqual(response.status_code, 200)
+    
+    def test_update_and_delete_invalidate(self):
+        etag = self.app.get(f'/api/mortgages/{self.mortgage_id}').headers['ETag']
+        self.app.put(f'/api/mortgages/{self.mortgage_id}', data=json.dumps({'creditScore': 760}),
+                     content_type='application/json')
+        
+        response = self.app.get(f'/api/mortgages/{self.mortgage_id}', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['creditScore'], 760)
+        
+        self.app.delete(f'/api/mortgages/{self.mortgage_id}')
+        self.assertEqual(self.app.get(f'/api/mortgages/{self.mortgage_id}').status_code, 404)
+    
+    def test_read_started_before_invalidation_is_not_stored(self):
+        cache = MortgageCache(LRUTTLBackend(max_size=10, ttl=60))
+        entry, token = cache.get(1)
+        cache.invalidate(1)
+        cache.set(1, b'{"old": true}\n', token)
+        self.assertIsNone(cache.get(1)[0])
+    
+    def test_backend_evicts_and_expires(self):
+        backend = LRUTTLBackend(max_size=2, ttl=60)
+        backend.set(1, 'a')
+        backend.set(2, 'b')
+        backend.get(1)
+        backend.set(3, 'c')
+        self.assertIsNone(backend.get(2))
+        self.assertEqual((backend.get(1), backend.get(3)), ('a', 'c'))
+        
+        backend.ttl = 0
+        backend.set(4, 'd')
+        self.assertIsNone(backend.get(4))
+        self.assertEqual(backend.expirations, 1)
+
+class PortfolioStatsTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        self.stats_ttl = config.PORTFOLIO_STATS_TTL
+        config.PORTFOLIO_STATS_TTL = 0
+        
+        rng = random.Random(3)
+        self.rows = [
+            {'credit_score': rng.randint(550, 820), 'loan_amount': rng.choice([80000, 90000, rng.uniform(0, 120000)]),
+             'property_value': rng.choice([0, 100000, 100000]), 'annual_income': rng.choice([0, 100000, 100000]),
+             'debt_amount': rng.choice([40000, 50000, rng.uniform(0, 70000)]),
+             'loan_type': rng.choice(['fixed', 'adjustable']), 'property_type': rng.choice(['single_family', 'condo']),
+             'credit_rating': rng.choice(['AAA', 'BBB', None])}
+            for _ in range(200)
+        ]
+        with app.app_context():
+            db.session.execute(Mortgage.__table__.insert(), self.rows)
+            db.session.commit()
+    
+    def tearDown(self):
+        config.PORTFOLIO_STATS_TTL = self.stats_ttl
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+    
+    def test_stats_match_python(self):
+        response = self.app.get('/api/portfolio/stats')
+        self.assertEqual(response.status_code, 200)
+        stats = json.loads(response.data)
+        
+        scores = sorted(row['credit_score'] for row in self.rows)
+        self.assertEqual(stats['creditScore']['count'], 200)
+        self.assertAlmostEqual(stats['creditScore']['average'], sum(scores) / 200)
+        self.assertEqual((stats['creditScore']['min'], stats['creditScore']['max']), (scores[0], scores[-1]))
+        self.assertEqual(stats['creditScore']['percentiles']['p50'], scores[99])
+        self.assertEqual(stats['creditScore']['percentiles']['p99'], scores[197])
+        
+        rules = get_rules()
+        for key, rule, numerator, denominator in (
+                ('loanToValue', rules.loan_to_value, 'loan_amount', 'property_value'),
+                ('debtToIncome', rules.debt_to_income, 'debt_amount', 'annual_income')):
+            bands = [rule.band(row[numerator] / row[denominator] * 100) for row in self.rows if row[denominator]]
+            self.assertEqual([bucket['count'] for bucket in stats[key]['buckets']],
+                             [bands.count(band) for band in range(len(rule.outcomes))])
+            self.assertEqual(stats[key]['zeroDenominator'], sum(1 for row in self.rows if not row[denominator]))
+        
+        self.assertEqual(stats['byLoanType']['fixed'], sum(row['loan_type'] == 'fixed' for row in self.rows))
+        self.assertEqual(stats['byPropertyType']['condo'], sum(row['property_type'] == 'condo' for row in self.rows))
+        self.assertEqual(stats['byCreditRating']['unrated'], sum(row['credit_rating'] is None for row in self.rows))
+    
+    def test_empty_portfolio(self):
+        with app.app_context():
+            db.session.execute(Mortgage.__table__.delete())
+            stats = portfolio_stats()
+        self.assertEqual(stats['creditScore']['count'], 0)
+        self.assertIsNone(stats['creditScore']['percentiles']['p50'])
+        self.assertEqual(stats['loanToValue']['buckets'][0]['count'], 0)
+    
+    def test_cached_within_ttl(self):
+        config.PORTFOLIO_STATS_TTL = 60
+        with app.app_context():
+            first = cached_portfolio_stats()
+            db.session.execute(Mortgage.__table__.insert(), self.rows[:1])
+            db.session.commit()
+            self.assertIs(cached_portfolio_stats(), first)
+            config.PORTFOLIO_STATS_TTL = 0
+            self.assertEqual(cached_portfolio_stats()['creditScore']['count'], 201)
+
+class StressTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app.test_client()
+        rng = random.Random(11)
+        self.rows = [
+            {'credit_score': rng.randint(600, 760), 'loan_amount': rng.uniform(150000, 450000),
+             'property_value': rng.uniform(300000, 600000), 'annual_income': rng.uniform(50000, 150000),
+             'debt_amount': rng.uniform(5000, 70000), 'loan_type': rng.choice(['fixed', 'adjustable']),
+             'property_type': rng.choice(['single_family', 'condo'])}
+            for _ in range(40)
+        ]
+        with app.app_context():
+            db.session.execute(Mortgage.__table__.insert(), self.rows)
+            rebuild_portfolio_aggregate()
+            db.session.commit()
+        self.scenarios = [
+            {'name': 'calm'},
+            {'name': 'house-prices', 'propertyValue': -0.25},
+            {'name': 'recession', 'annualIncome': -0.2, 'debtAmount': 0.1, 'creditScore': -40}
+        ]
+    
+    def tearDown(self):
+        portfolio_snapshot.unload()
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+    
+    def expected_migration(self, scenario):
+        """Re-rate every loan one at a time with the scalar scoring functions"""
+        total = sum(row['credit_score'] for row in self.rows)
+        shift = scenario.get('creditScore', 0)
+        migration = {}
+        for row in self.rows:
+            data = {'creditScore': row['credit_score'], 'loanAmount': row['loan_amount'],
+                    'propertyValue': row['property_value'], 'annualIncome': row['annual_income'],
+                    'debtAmount': row['debt_amount'], 'loanType': row['loan_type'], 'propertyType': row['property_type']}
+            avg = (total - row['credit_score']) / (len(self.rows) - 1)
+            before = calculate_credit_rating(calculate_risk_score(data, avg))
+            shocked = dict(data, creditScore=data['creditScore'] + shift)
+            for field in ('loanAmount', 'propertyValue', 'annualIncome', 'debtAmount'):
+                shocked[field] = data[field] * (1 + scenario.get(field, 0))
+            after = calculate_credit_rating(calculate_risk_score(shocked, avg + shift))
+            migration[(before, after)] = migration.get((before, after), 0) + 1
+        return migration
+    
+    def check(self, result):
+        self.assertEqual(result['loanCount'], 40)
+        for scenario, outcome in zip(self.scenarios, result['scenarios']):
+            counts = {(before, after): n for before, row in outcome['migration'].items()
+                      for after, n in row.items() if n}
+            self.assertEqual(counts, self.expected_migration(scenario), scenario['name'])
+        calm = result['scenarios'][0]
+        self.assertEqual((calm['downgraded'], calm['upgraded']), (0, 0))
+        self.assertEqual(calm['distribution'], result['baseline'])
+    
+    def test_stress_matches_scalar_scoring(self):
+        response = self.app.post('/api/portfolio/stress', json={'scenarios': self.scenarios})
+        self.assertEqual(response.status_code, 200)
+        result = json.loads(response.data)
+        self.assertEqual(result['source'], 'database')
+        self.check(result)
+        self.assertGreater(result['scenarios'][1]['downgraded'], 0)
+    
+    def test_snapshot_and_small_chunks(self):
+        from stress import parse_scenarios, run_stress_test
+        with app.app_context():
+            self.check(run_stress_test(parse_scenarios({'scenarios': self.scenarios}), chunk_size=7))
+            portfolio_snapshot.load()
+            result = run_stress_test(parse_scenarios({'scenarios': self.scenarios}), chunk_size=7)
+        self.assertEqual(result['source'], 'snapshot')
+        self.check(result)
+    
+    def test_invalid_scenarios_rejected(self):
+        for body in ({}, {'scenarios': []}, {'scenarios': [{'propertyValue': 'low'}]},
+                     {'scenarios': [{'interestRate': 0.02}]}, {'scenarios': [{'annualIncome': -1.5}]}):
+            self.assertEqual(self.app.post('/api/portfolio/stress', json=body).status_code, 400, body)
+
+class PortfolioSnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        for score in (650, 700, 750):
+            self.post(score)
+        with app.app_context():
+            portfolio_snapshot.load()
+    
+    def tearDown(self):
+        portfolio_snapshot.unload()
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+        mortgage_cache.clear()
+    
+    def post(self, credit_score, **overrides):
+        payload = {'creditScore': credit_score, 'loanAmount': 300000, 'propertyValue': 400000, 'annualIncome': 80000,
+                   'debtAmount': 20000, 'loanType': 'fixed', 'propertyType': 'single_family'}
+        payload.update(overrides)
+        return self.app.post('/api/mortgages', data=json.dumps(payload), content_type='application/json')
+    
+    def assert_matches_database(self):
+        with app.app_context():
+            rows = db.session.execute(select(*SCORING_COLUMNS).order_by(Mortgage.id)).all()
+        columns = portfolio_snapshot.scoring_columns()
+        self.assertEqual(columns['id'].tolist(), [row.id for row in rows])
+        self.assertEqual(columns['creditScore'].tolist(), [row.credit_score for row in rows])
+        self.assertEqual(columns['loanType'].tolist(), [row.loan_type for row in rows])
+        self.assertEqual(portfolio_snapshot.totals(), (sum(row.credit_score for row in rows), len(rows)))
+    
+    def test_write_endpoints_keep_snapshot_current(self):
+        self.post(800, loanType='adjustable', propertyType='condo')
+        self.app.put('/api/mortgages/1', data=json.dumps({'creditScore': 600}), content_type='application/json')
+        self.app.delete('/api/mortgages/2')
+        self.app.post('/api/mortgages/bulk', data=json.dumps([
+            {'creditScore': 710, 'loanAmount': 1, 'propertyValue': 2, 'annualIncome': 3, 'debtAmount': 0,
+             'loanType': 'fixed', 'propertyType': 'condo'}
+        ] * 3), content_type='application/json')
+        self.assert_matches_database()
+        self.assertEqual(portfolio_snapshot.stats()['loanTypes'], ['fixed', 'adjustable'])
+    
+    def test_bulk_rows_below_a_concurrent_create(self):
+        # A create that commits first takes a higher ID than the bulk rows, which commit after it
+        with app.app_context():
+            db.session.add(Mortgage(id=10, credit_score=720, loan_amount=1, property_value=2, annual_income=3,
+                                    debt_amount=0, loan_type='fixed', property_type='condo'))
+            db.session.commit()
+            inserted = insert_mortgages(db.session, [
+                {'id': mortgage_id, 'credit_score': 690, 'loan_amount': 1, 'property_value': 2, 'annual_income': 3,
+                 'debt_amount': 0, 'loan_type': 'fixed', 'property_type': 'condo'}
+                for mortgage_id in (5, 6)
+            ])
+            db.session.commit()
+            self.assertEqual(portfolio_snapshot.sync_rows([row['id'] for row in inserted], db.session), 2)
+        self.assert_matches_database()
+    
+    def test_rolled_back_changes_are_not_applied(self):
+        with app.app_context():
+            mortgage = db.session.get(Mortgage, 1)
+            mortgage.credit_score = 500
+            db.session.flush()
+            db.session.rollback()
+        self.assert_matches_database()
+    
+    def test_scoring_answers_from_memory(self):
+        statements = []
+        
+        def count(conn, cursor, statement, *args):
+            statements.append(statement)
+        
+        with app.app_context():
+            engine = db.engine
+        event.listen(engine, 'before_cursor_execute', count)
+        try:
+            response = self.app.post('/api/calculate-rating', data=json.dumps({
+                'creditScore': 720, 'loanAmount': 300000, 'propertyValue': 400000, 'annualIncome': 80000,
+                'debtAmount': 20000, 'loanType': 'fixed', 'propertyType': 'single_family'
+            }), content_type='application/json')
+        finally:
+            event.remove(engine, 'before_cursor_execute', count)
+        
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(statements, [])
+        with app.app_context():
+            self.assertEqual(get_average_credit_score(), get_average_credit_score(session=db.session))
+    
+    def test_snapshot_stats(self):
+        response = self.app.get('/api/portfolio/snapshot')
+        stats = json.loads(response.data)
+        self.assertTrue(stats['loaded'])
+        self.assertEqual(stats['count'], 3)
+        self.assertLess(stats['bytesPerLoan'], 64)
+
+class InstrumentationTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+    
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+        mortgage_cache.clear()
+    
+    def create(self):
+        return self.app.post('/api/mortgages', data=json.dumps({
+            'creditScore': 700, 'loanAmount': 300000, 'propertyValue': 400000, 'annualIncome': 80000,
+            'debtAmount': 20000, 'loanType': 'fixed', 'propertyType': 'single_family'
+        }), content_type='application/json')
+    
+    def test_server_timing_phases(self):
+        response = self.create()
+        phases = [entry.split(';')[0] for entry in response.headers['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['validate', 'db_read', 'score', 'commit', 'serialize', 'sql', 'total'])
+    
+    def test_queries_counted_per_request(self):
+        self.create()
+        response = self.app.get('/api/mortgages/1')
+        self.assertIn('sql;desc="1 queries"', response.headers['Server-Timing'])
+        response = self.app.get('/api/mortgages/1')
+        self.assertIn('sql;desc="0 queries"', response.headers['Server-Timing'])
+    
+    def test_metrics_histograms(self):
+        self.create()
+        body = self.app.get('/metrics').get_data(as_text=True)
+        self.assertIn('# TYPE http_request_duration_seconds histogram', body)
+        self.assertIn('http_request_duration_seconds_bucket{route="/api/mortgages",method="POST",status="201",le="+Inf"}',
+                      body)
+        self.assertIn('http_request_phase_seconds_count{route="/api/mortgages",phase="commit"}', body)
+        self.assertIn('http_request_db_queries_bucket{route="/api/mortgages",le="0"}', body)
+    
+    def test_profile_every_nth_request(self):
+        every_n, profile_dir = config.PROFILE_EVERY_N_REQUESTS, config.PROFILE_DIR
+        with tempfile.TemporaryDirectory() as directory:
+            config.PROFILE_EVERY_N_REQUESTS, config.PROFILE_DIR = 2, directory
+            try:
+                for _ in range(4):
+                    self.app.get('/api/rules')
+            finally:
+                config.PROFILE_EVERY_N_REQUESTS, config.PROFILE_DIR = every_n, profile_dir
+            profiles = os.listdir(directory)
+        self.assertEqual(len(profiles), 2)
+        self.assertTrue(all(name.endswith('-api_rules.prof') for name in profiles))
+    
+    def test_overlapping_sampled_requests_skip_profiling(self):
+        import instrumentation
+        every_n, profile_dir = config.PROFILE_EVERY_N_REQUESTS, config.PROFILE_DIR
+        with tempfile.TemporaryDirectory() as directory:
+            config.PROFILE_EVERY_N_REQUESTS, config.PROFILE_DIR = 1, directory
+            try:
+                # As if another sampled request were still being profiled
+                with instrumentation._profile_lock:
+                    self.assertEqual(self.app.get('/api/rules').status_code, 200)
+                    self.assertEqual(os.listdir(directory), [])
+                self.assertEqual(self.app.get('/api/rules').status_code, 200)
+            finally:
+                config.PROFILE_EVERY_N_REQUESTS, config.PROFILE_DIR = every_n, profile_dir
+            self.assertEqual(len(os.listdir(directory)), 1)
+        self.assertFalse(instrumentation._profile_lock.locked())
+
+class SerializationTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        with app.app_context():
+            db.session.add_all([
+                Mortgage(credit_score=700 + i, loan_amount=300000.5 * (i + 1), property_value=400000,
+                         annual_income=80000, debt_amount=20000, loan_type='fixed', property_type='condo',
+                         risk_score=i if i % 2 else None, credit_rating='BBB' if i % 2 else None)
+                for i in range(5)
+            ])
+            db.session.commit()
+    
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+        mortgage_cache.clear()
+    
+    def expected_page(self):
+        with app.app_context():
+            mortgages = Mortgage.query.order_by(Mortgage.id).all()
+            return json.loads(app.json.response([mortgage.to_dict() for mortgage in mortgages]).get_data())
+    
+    def test_page_matches_to_dict_values(self):
+        import serialization
+        # Values whose encoding differs between encoders: a large float and non-ASCII text
+        with app.app_context():
+            db.session.add(Mortgage(credit_score=640, loan_amount=1e16, property_value=2.5e-7, annual_income=80000,
+                                    debt_amount=20000, loan_type='fixed', property_type='maisonnétte'))
+            db.session.commit()
+        orjson = serialization.orjson
+        try:
+            for encoder in (orjson, None):
+                serialization.orjson = encoder
+                response = self.app.get('/api/mortgages?limit=10')
+                # Compared field by field, with the exact types jsonify produces
+                page = json.loads(response.data)
+                self.assertEqual(page, self.expected_page())
+                for item, expected in zip(page, self.expected_page()):
+                    self.assertEqual({key: type(value) for key, value in item.items()},
+                                     {key: type(value) for key, value in expected.items()})
+        finally:
+            serialization.orjson = orjson
+    
+    def test_stream_and_single_match_to_dict(self):
+        with app.app_context():
+            expected = [mortgage.to_dict() for mortgage in Mortgage.query.order_by(Mortgage.id).all()]
+        self.assertEqual(json.loads(self.app.get('/api/mortgages').data), expected)
+        lines = self.app.get('/api/mortgages?format=ndjson').data.decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], expected)
+        self.assertEqual(json.loads(self.app.get('/api/mortgages/2').data), expected[1])
+
+class MortgageExportImportTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        with app.app_context():
+            db.session.add_all([
+                Mortgage(credit_score=650 + i, loan_amount=250000.25 * (i + 1), property_value=400000,
+                         annual_income=90000, debt_amount=15000, loan_type='adjustable', property_type='single_family',
+                         risk_score=i if i % 2 else None, credit_rating='AAA' if i % 2 else None)
+                for i in range(7)
+            ])
+            db.session.commit()
+    
+    def tearDown(self):
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+        mortgage_cache.clear()
+    
+    def stored_rows(self):
+        with app.app_context():
+            return [tuple(row) for row in db.session.execute(
+                select(Mortgage.__table__).order_by(Mortgage.id)
+            ).all()]
+    
+    def round_trip(self, file_format):
+        from io import BytesIO
+        original = self.stored_rows()
+        response = self.app.get(f'/api/mortgages/export?format={file_format}')
+        self.assertEqual(response.status_code, 200)
+        exported = response.data
+        with app.app_context():
+            db.session.execute(Mortgage.__table__.delete())
+            db.session.commit()
+        
+        response = self.app.post(f'/api/mortgages/import?format={file_format}&keep_ids=true',
+                                 data={'file': (BytesIO(exported), f'book.{file_format}')})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(json.loads(response.data)['imported'], 7)
+        self.assertEqual(self.stored_rows(), original)
+        with app.app_context():
+            self.assertEqual(get_average_credit_score(), 653)
+    
+    def test_csv_round_trip(self):
+        self.round_trip('csv')
+    
+    def test_parquet_round_trip(self):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+        self.round_trip('parquet')
+    
+    def test_import_assigns_new_ids_by_default(self):
+        from io import BytesIO
+        exported = self.app.get('/api/mortgages/export?format=csv').data
+        response = self.app.post('/api/mortgages/import', data={'file': (BytesIO(exported), 'book.csv')})
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual([row[0] for row in self.stored_rows()], list(range(1, 15)))
+    
+    def test_failed_import_keeps_aggregate_in_step(self):
+        from io import BytesIO
+        self.addCleanup(setattr, config, 'EXPORT_BATCH_SIZE', config.EXPORT_BATCH_SIZE)
+        config.EXPORT_BATCH_SIZE = 3
+        lines = ['credit_score,loan_amount,property_value,annual_income,debt_amount,loan_type,property_type']
+        lines += ['500,100000,200000,50000,1000,fixed,condo'] * 4 + ['abc,100000,200000,50000,1000,fixed,condo']
+        response = self.app.post('/api/mortgages/import',
+                                 data={'file': (BytesIO('\n'.join(lines).encode()), 'book.csv')})
+        
+        # The first batch stays imported, and the aggregate counts it
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(json.loads(response.data)['imported'], 3)
+        with app.app_context():
+            self.assertEqual(Mortgage.query.count(), 10)
+            self.assertEqual(get_average_credit_score(), (sum(range(650, 657)) + 1500) / 10)
+    
+    def test_unknown_format_rejected(self):
+        self.assertEqual(self.app.get('/api/mortgages/export?format=xlsx').status_code, 400)
+
+class RatingQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        # The workers and sweeper run on their own threads. In-memory SQLite is one connection shared by
+        # every thread, where a sweep's rollback can undo a request's uncommitted insert, so use a file
+        handle, self.path = tempfile.mkstemp(suffix='.db')
+        os.close(handle)
+        self.queue_app = create_app({'TESTING': True, 'SQLALCHEMY_DATABASE_URI': f'sqlite:///{self.path}'})
+        with self.queue_app.app_context():
+            db.create_all()
+        self.app = self.queue_app.test_client()
+        self.counters = dict(rating_queue.counters)
+        self.mortgage = {
+            'creditScore': 700, 'loanAmount': 300000, 'propertyValue': 400000, 'annualIncome': 90000,
+            'debtAmount': 20000, 'loanType': 'fixed', 'propertyType': 'condo'
+        }
+    
+    def tearDown(self):
+        rating_queue.stop()
+        with self.queue_app.app_context():
+            db.session.remove()
+            db.engine.dispose()
+        os.remove(self.path)
+        mortgage_cache.clear()
+    
+    def counted(self, name):
+        """Events counted since setUp; the queue's counters live as long as the process"""
+        return rating_queue.counters[name] - self.counters[name]
+    
+    def rating(self, mortgage_id, wait=5):
+        response = self.app.get(f'/api/mortgages/{mortgage_id}/rating?wait={wait}')
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)
+    
+    def test_pending_mortgage_is_rated_in_background(self):
+        self.app.post('/api/mortgages', json=dict(self.mortgage, creditScore=640))
+        rating_queue.start(self.queue_app, workers=1)
+        
+        response = self.app.post('/api/mortgages', json=self.mortgage)
+        self.assertEqual(response.status_code, 202)
+        data = json.loads(response.data)
+        self.assertEqual(data['ratingStatus'], 'pending')
+        self.assertIsNone(data['mortgage']['creditRating'])
+        
+        result = self.rating(data['mortgage']['id'])
+        self.assertEqual(result['ratingStatus'], 'rated')
+        # Rated against the other loans, exactly as the inline path would have
+        expected = calculate_risk_score(self.mortgage, 640)
+        self.assertEqual(result['riskScore'], expected)
+        self.assertEqual(result['creditRating'], calculate_credit_rating(expected))
+        self.assertEqual(json.loads(self.app.get('/api/mortgages/2').data)['creditRating'], result['creditRating'])
+    
+    def test_full_queue_rates_inline(self):
+        # No workers, so the single slot stays taken
+        rating_queue.start(self.queue_app, workers=0, size=1)
+        self.assertEqual(self.app.post('/api/mortgages', json=self.mortgage).status_code, 202)
+        response = self.app.post('/api/mortgages', json=self.mortgage)
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNotNone(json.loads(response.data)['creditRating'])
+        
+        stats = json.loads(self.app.get('/api/ratings/queue').data)
+        self.assertEqual((stats['depth'], stats['capacity'], self.counted('overflowed')), (1, 1, 1))
+        self.assertEqual(self.rating(1, wait=0)['ratingStatus'], 'pending')
+        self.assertIn('rating_queue_depth 1', self.app.get('/metrics').get_data(as_text=True))
+    
+    def test_pending_rows_recovered_on_start(self):
+        # Rows left unrated by a crashed process
+        with self.queue_app.app_context():
+            db.session.execute(Mortgage.__table__.insert(), [
+                {'credit_score': score, 'loan_amount': 300000, 'property_value': 400000, 'annual_income': 90000,
+                 'debt_amount': 20000, 'loan_type': 'fixed', 'property_type': 'condo'}
+                for score in (650, 700, 750)
+            ])
+            rebuild_portfolio_aggregate()
+            db.session.commit()
+        rating_queue.start(self.queue_app, workers=1)
+        
+        self.assertEqual([self.rating(i)['ratingStatus'] for i in (1, 2, 3)], ['rated'] * 3)
+        self.assertEqual(self.counted('recovered'), 3)
+
+class IdempotencyTestCase(unittest.TestCase):
+    def setUp(self):
+        app.config['TESTING'] = True
+        self.app = app.test_client()
+        self.mortgage = {
+            'creditScore': 720, 'loanAmount': 300000, 'propertyValue': 400000, 'annualIncome': 90000,
+            'debtAmount': 20000, 'loanType': 'fixed', 'propertyType': 'condo'
+        }
+        self.ttl = config.IDEMPOTENCY_KEY_TTL
+    
+    def tearDown(self):
+        config.IDEMPOTENCY_KEY_TTL = self.ttl
+        with app.app_context():
+            db.session.remove()
+            clear_tables()
+        mortgage_cache.clear()
+    
+    def post(self, key, data=None):
+        return self.app.post('/api/mortgages', json=data or self.mortgage, headers={'Idempotency-Key': key})
+    
+    def mortgage_count(self):
+        with app.app_context():
+            return Mortgage.query.count()
+    
+    def test_retry_replays_original_response(self):
+        first = self.post('key-1')
+        retry = self.post('key-1')
+        self.assertEqual(first.status_code, 201)
+        self.assertEqual(retry.status_code, 201)
+        self.assertEqual(retry.data, first.data)
+        self.assertEqual(retry.headers.get('Idempotent-Replayed'), 'true')
+        self.assertIsNone(first.headers.get('Idempotent-Replayed'))
+        self.assertEqual(self.mortgage_count(), 1)
+        self.assertEqual(self.post('key-2').status_code, 201)
+        self.assertEqual(self.mortgage_count(), 2)
+    
+    def test_key_reused_for_different_request(self):
+        self.post('key-1')
+        response = self.post('key-1', dict(self.mortgage, creditScore=600))
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.mortgage_count(), 1)
+    
+    def test_expired_key_creates_again(self):
+        config.IDEMPOTENCY_KEY_TTL = -1
+        self.post('key-1')
+        response = self.post('key-1')
+        self.assertEqual(response.status_code, 201)
+        self.assertIsNone(response.headers.get('Idempotent-Replayed'))
+        self.assertEqual(self.mortgage_count(), 2)
+        
+        from idempotency import purge_expired_keys
+        with app.app_context():
+            self.assertEqual(purge_expired_keys(), 1)
+            db.session.commit()
+    
+    def test_concurrent_duplicate_hits_unique_constraint(self):
+        import app as app_module
+        first = self.post('key-1')
+        
+        # Let the duplicate miss the lookup, as if both requests had checked before either committed
+        find_response = app_module.find_response
+        calls = []
+        def racing_find_response(key, fingerprint):
+            calls.append(key)
+            return None if len(calls) == 1 else find_response(key, fingerprint)
+        app_module.find_response = racing_find_response
+        try:
+            duplicate = self.post('key-1')
+        finally:
+            app_module.find_response = find_response
+        
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(duplicate.data, first.data)
+        self.assertEqual(duplicate.headers.get('Idempotent-Replayed'), 'true')
+        self.assertEqual(self.mortgage_count(), 1)
+
+class ReplicaRoutingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        path = self.directory.name
+        self.replica_app = create_app({
+            'TESTING': True,
+            'SQLALCHEMY_DATABASE_URI': f"sqlite:///{path}/primary.db",
+            'SQLALCHEMY_BINDS': replica_binds([f"sqlite:///{path}/replica0.db", f"sqlite:///{path}/replica1.db"])
+        })
+        # Each database holds a different version of mortgage 1, to tell which one answered
+        for key, credit_score in ((None, 700), ('replica_0', 701), ('replica_1', 702)):
+            self.reset_database(key, credit_score)
+        self.app = self.replica_app.test_client()
+        self.retry_interval = config.REPLICA_RETRY_INTERVAL
+        mortgage_cache.clear()
+    
+    def tearDown(self):
+        config.REPLICA_RETRY_INTERVAL = self.retry_interval
+        with self.replica_app.app_context():
+            db.session.remove()
+            for engine in db.engines.values():
+                engine.dispose()
+        self.directory.cleanup()
+        mortgage_cache.clear()
+    
+    def reset_database(self, key, credit_score):
+        with self.replica_app.app_context():
+            engine = db.engines[key]
+            db.metadata.drop_all(engine)
+            db.metadata.create_all(engine)
+            with engine.begin() as connection:
+                connection.execute(insert(Mortgage), [{
+                    'id': 1, 'credit_score': credit_score, 'loan_amount': 200000, 'property_value': 400000,
+                    'annual_income': 90000, 'debt_amount': 10000, 'loan_type': 'fixed', 'property_type': 'condo'
+                }])
+    
+    def break_database(self, key):
+        with self.replica_app.app_context():
+            with db.engines[key].begin() as connection:
+                connection.execute(text("DROP TABLE mortgages"))
+    
+    def credit_score(self, client=None):
+        # Reads from the primary are cached, so start each read from the database
+        mortgage_cache.clear()
+        response = (client or self.app).get('/api/mortgages/1')
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.data)['creditScore']
+    
+    def test_reads_round_robin_and_writes_pin_primary(self):
+        self.assertEqual([self.credit_score() for _ in range(4)], [701, 702, 701, 702])
+        
+        # The write goes to the primary, and the writer's own reads follow it there
+        writer = self.replica_app.test_client()
+        response = writer.put('/api/mortgages/1', json={'creditScore': 720})
+        self.assertEqual(response.status_code, 200)
+        self.assertIsNotNone(writer.get_cookie('db_primary_until'))
+        self.assertEqual(self.credit_score(writer), 720)
+        with self.replica_app.app_context():
+            self.assertEqual(db.session.get(Mortgage, 1).credit_score, 720)
+    
+    def test_failed_replica_fails_over(self):
+        config.REPLICA_RETRY_INTERVAL = 60
+        self.break_database('replica_1')
+        # replica_0, then replica_1 fails and the request is answered by the primary
+        self.assertEqual([self.credit_score() for _ in range(2)], [701, 700])
+        # replica_1 is skipped while it is marked down
+        self.assertEqual([self.credit_score() for _ in range(2)], [701, 701])
+        
+        self.break_database('replica_0')
+        self.assertEqual([self.credit_score() for _ in range(2)], [700, 700])
+        stats = json.loads(self.app.get('/api/database/replicas').data)
+        self.assertEqual([replica['healthy'] for replica in stats['replicas']], [False, False])
+        self.assertEqual((stats['failures'], stats['retries'], stats['primaryFallbacks']), (2, 2, 1))
+    
+    def test_replica_retried_after_interval(self):
+        config.REPLICA_RETRY_INTERVAL = 0
+        self.break_database('replica_0')
+        self.assertEqual(self.credit_score(), 700)
+        self.reset_database('replica_0', 701)
+        self.assertEqual([self.credit_score() for _ in range(2)], [702, 701])
+
+class RerateJobTestCase(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.database_uri = f"sqlite:///{os.path.join(self.workdir.name, 'rerate.db')}"
+        self.checkpoint = os.path.join(self.workdir.name, 'checkpoint.json')
+        
+        self.engine = create_engine(self.database_uri)
+        db.metadata.create_all(self.engine)
+        rng = random.Random(7)
+        with self.engine.begin() as connection:
+            connection.execute(Mortgage.__table__.insert(), [
+                {'credit_score': rng.randint(580, 800), 'loan_amount': rng.uniform(100000, 500000),
+                 'property_value': 450000, 'annual_income': rng.uniform(40000, 150000),
+                 'debt_amount': rng.uniform(0, 60000), 'loan_type': rng.choice(['fixed', 'adjustable']),
+                 'property_type': rng.choice(['single_family', 'condo'])}
+                for _ in range(50)
+            ])
+    
+    def tearDown(self):
+        self.engine.dispose()
+        self.workdir.cleanup()
+    
+    def stored_ratings(self):
+        with self.engine.connect() as connection:
+            return connection.execute(
+                select(Mortgage.id, Mortgage.risk_score, Mortgage.credit_rating).order_by(Mortgage.id)
+            ).all()
+    
+    def test_rerate_matches_scoring(self):
+        import rerate
+        rerate.rerate_portfolio(self.database_uri, workers=2, chunk_size=7, checkpoint_path=self.checkpoint)
+        
+        with self.engine.connect() as connection:
+            rows = connection.execute(select(*SCORING_COLUMNS).order_by(Mortgage.id)).all()
+        credit_score_sum = sum(row.credit_score for row in rows)
+        expected = score_stored_rows(rows, credit_score_sum, len(rows), get_rules())
+        self.assertEqual([(r['id'], r['risk_score'], r['credit_rating']) for r in expected],
+                         [tuple(row) for row in self.stored_ratings()])
+        
+        with open(self.checkpoint) as f:
+            self.assertEqual(json.load(f)['completedThrough'], 50)
+        
+        # Every new rating is in the history too
+        with self.engine.connect() as connection:
+            history = connection.execute(
+                select(MortgageRatingHistory.mortgage_id, MortgageRatingHistory.risk_score,
+                       MortgageRatingHistory.credit_rating)
+                .where(MortgageRatingHistory.event == 'rated').order_by(MortgageRatingHistory.mortgage_id)
+            ).all()
+        self.assertEqual([tuple(row) for row in history], [tuple(row) for row in self.stored_ratings()])
+    
+    def test_resume_from_checkpoint(self):
+        import rerate
+        rerate.save_checkpoint(self.checkpoint, get_rules().version, 40)
+        rerate.rerate_portfolio(self.database_uri, workers=2, chunk_size=7, checkpoint_path=self.checkpoint)
+        
+        # Only the IDs after the checkpoint were re-rated
+        rated = [row.id for row in self.stored_ratings() if row.credit_rating is not None]
+        self.assertEqual(rated, list(range(41, 51)))
+
+class BenchmarkSuiteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.app = app
+    
+    def tearDown(self):
+        with self.app.app_context():
+            db.session.remove()
+            clear_tables()
+        mortgage_cache.clear()
+    
+    def test_endpoint_benchmarks_run(self):
+        import benchmark
+        columns = benchmark.synthetic_columns(60)
+        with self.app.app_context():
+            benchmark.seed_mortgages(db.engine, columns, 700, chunk_size=25)
+            rebuild_portfolio_aggregate()
+            db.session.commit()
+            self.assertEqual(db.session.query(Mortgage).filter(Mortgage.credit_rating.isnot(None)).count(), 60)
+        
+        results = benchmark.bench_endpoints(self.app, 60, requests=5)
+        self.assertIn('api.get_mortgage', results)
+        self.assertEqual(results['api.list_all_stream']['rowsPerCall'], 60)
+        for result in results.values():
+            self.assertGreater(result['rowsPerSecond'], 0)
+            self.assertLessEqual(result['p50Ms'], result['p99Ms'])
+    
+    def test_compare_flags_regressions(self):
+        import benchmark
+        before = {'results': {'1000': {'api.get_mortgage': {'rowsPerSecond': 1000.0, 'p95Ms': 2.0}}}}
+        after = {'results': {'1000': {'api.get_mortgage': {'rowsPerSecond': 700.0, 'p95Ms': 2.1}}}}
+        regressions = benchmark.compare_results(before, after, tolerance=0.2)
+        self.assertEqual([(size, name) for size, name, _ in regressions], [('1000', 'api.get_mortgage')])
+        self.assertEqual(benchmark.compare_results(before, before, tolerance=0.2), [])
+
 if __name__ == '__main__':
     unittest.main()
\ No newline at end of file
@@ -1,5 +1,5 @@
 
-    import React, { useState, useEffect } from 'react';
+    import React, { useState, useEffect, useRef } from 'react';
     import axios from 'axios'; // You'll need to install axios: npm install axios
 
     const MortgageInputForm = () => {
@@ -19,22 +19,73 @@
     const [loading, setLoading] = useState(false);
     const [submitMessage, setSubmitMessage] = useState('');
 
-    // Fetch mortgages from backend on component mount
+    // Changes received while the list is loading, applied once it arrives; null when none is loading
+    const pendingChanges = useRef(null);
+    // Whether the change feed is open; without it the list is reloaded after each write
+    const feedOpen = useRef(false);
+
+    // Fetch mortgages from backend on component mount, then keep them current from the change feed.
+    // The stream is opened first and its events held until the list arrives, so no change made while
+    // the list loads is missed.
     useEffect(() => {
+        const changes = new EventSource('http://127.0.0.1:5000/api/mortgages/changes');
+        changes.onopen = () => {
+        feedOpen.current = true;
+        };
+        changes.onmessage = (message) => {
+        const change = JSON.parse(message.data);
+        if (pendingChanges.current) {
+            pendingChanges.current.push(change);
+        } else {
+            applyChange(change);
+        }
+        };
+        changes.onerror = () => {
+        // The browser reconnects by itself with Last-Event-ID, unless the server refused the stream
+        // (e.g. 503 when too many are open); then fall back to reloading the list
+        if (changes.readyState === EventSource.CLOSED) {
+            feedOpen.current = false;
+            fetchMortgages();
+        }
+        };
         fetchMortgages();
+        return () => changes.close();
     }, []);
 
+    // Apply one change event to the list instead of reloading it
+    const applyChange = (change) => {
+        setMortgages((current) => {
+        if (change.event === 'deleted') {
+            return current.filter((mortgage) => mortgage.id !== change.mortgageId);
+        }
+        if (change.mortgage) {
+            const exists = current.some((mortgage) => mortgage.id === change.mortgageId);
+            return exists
+            ? current.map((mortgage) => (mortgage.id === change.mortgageId ? change.mortgage : mortgage))
+            : [...current, change.mortgage];
+        }
+        // Ratings stored in bulk carry only the rating
+        return current.map((mortgage) => (mortgage.id === change.mortgageId
+            ? { ...mortgage, riskScore: change.riskScore, creditRating: change.creditRating }
+            : mortgage));
+        });
+    };
+
     const fetchMortgages = async () => {
+        pendingChanges.current = [];
         try {
         setLoading(true);
         const response = await axios.get('http://127.0.0.1:5000/api/mortgages');
         setMortgages(response.data);
         console.log(response.data,'HERE')
+        // Events carry the whole mortgage, so one the list already reflects changes nothing
+        pendingChanges.current.forEach(applyChange);
         setLoading(false);
         } catch (error) {
         console.error('Error fetching mortgages:', error);
         setLoading(false);
         }
+        pendingChanges.current = null;
     };
 
     const validateMortgage = (mortgage) => {
@@ -110,8 +161,10 @@
             setSubmitMessage(`Mortgage added successfully! Credit Rating: ${response.data.creditRating}`);
         }
         
-        // Refresh the mortgage list
-        fetchMortgages();
+        // The change feed updates the mortgage list; without it, reload the list
+        if (!feedOpen.current) {
+            fetchMortgages();
+        }
         
         // Reset form
         setCurrentMortgage({
@@ -139,7 +192,9 @@
         try {
             setLoading(true);
             await axios.delete(`http://127.0.0.1:5000/api/mortgages/${id}`);
+            if (!feedOpen.current) {
             fetchMortgages();
+            }
             setLoading(false);
         } catch (error) {
             console.error('Error deleting mortgage:', error);